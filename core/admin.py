@@ -1,41 +1,122 @@
 from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import PermissionDenied
+from django.http import HttpRequest, QueryDict
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils.html import format_html
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon
+from . import exports, jobs, rollups
+from .models import (
+    BULK_ORDER_ACTION_CHOICES, Item, OrderItem, Order, Address, Payment,
+    Coupon, CouponRedemption, BulkOrderJob, DailySales, StockShard,
+    StockReservation)
+from .pagination import EstimatedCountPaginator
 
 
-class OrderItemAdmin(admin.ModelAdmin):
-    list_display = ('__str__', 'item', 'quantity', 'ordered')
-    search_fields = ['item__title']
+class LargeTableAdmin(admin.ModelAdmin):
+    # No exact COUNT(*) of the whole table on every changelist load
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    ordering = ['-pk']
+
+    def get_queryset(self, request):
+        # Autocomplete results are labelled with __str__ as well
+        return super().get_queryset(request).select_related(
+            *(self.list_select_related or ()))
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    A text box in the filter sidebar, for columns with too many values to
+    list as links.
+    """
+    template = 'admin/input_filter.html'
+
+    def lookups(self, request, model_admin):
+        # The filter is only shown when there are lookups
+        return ((),)
+
+    def choices(self, changelist):
+        all_choice = next(super().choices(changelist))
+        # The other active filters, kept as hidden inputs in the form
+        all_choice['query_parts'] = [
+            (key, value)
+            for key, value in changelist.get_filters_params().items()
+            if key != self.parameter_name
+        ]
+        yield all_choice
 
 
-def accept_refund(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+class UsernameFilter(InputFilter):
+    title = 'username'
+    parameter_name = 'username'
 
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(user__username=self.value())
 
-def reject_refund(modeladmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
 
+class StockShardInline(admin.TabularInline):
+    # Use core.inventory.set_stock to restock evenly
+    model = StockShard
+    extra = 0
+
+
+class ItemAdmin(admin.ModelAdmin):
+    search_fields = ['title']
+    inlines = [StockShardInline]
+
+
+class OrderItemAdmin(LargeTableAdmin):
+    list_display = ('__str__', 'item', 'quantity', 'ordered')
+    list_select_related = ['item']
+    list_filter = [UsernameFilter, 'ordered']
+    search_fields = ['item__title']
+    autocomplete_fields = ['user', 'item']
 
-def revert_refund_to_pending(modeladmin, request, queryset):
-    queryset.update(refund_requested=True, refund_granted=False)
 
+def bulk_order_action(name):
+    """
+    Admin action that queues the selected orders for the worker instead
+    of updating them inside the request.
+    """
+    def action(modeladmin, request, queryset):
+        if request.POST.get('select_across') == '1':
+            # Every order the filters match, found again by the worker
+            selection = {'filters': request.GET.urlencode()}
+        else:
+            selection = {'pks': sorted(queryset.values_list('pk', flat=True))}
+        job = jobs.enqueue_bulk_order_job(name, selection, request.user)
+        url = reverse('admin:core_bulkorderjob_change', args=[job.pk])
+        modeladmin.message_user(request, format_html(
+            '"{}" will run in the background. <a href="{}">Follow its '
+            'progress</a>.', job.get_action_display(), url))
+    action.__name__ = name
+    action.short_description = dict(BULK_ORDER_ACTION_CHOICES)[name]
+    return action
 
-def update_to_being_delivered(modeladmin, request, queryset):
-    queryset.update(being_delivered=True)
 
+accept_refund = bulk_order_action('accept_refund')
+reject_refund = bulk_order_action('reject_refund')
+revert_refund_to_pending = bulk_order_action('revert_refund_to_pending')
+update_to_being_delivered = bulk_order_action('update_to_being_delivered')
+update_to_received = bulk_order_action('update_to_received')
 
-def update_to_received(modeladmin, request, queryset):
-    queryset.update(received=True)
 
+def export_orders_csv(modeladmin, request, queryset):
+    return exports.streaming_export(queryset, 'csv')
 
-accept_refund.short_description = 'Update orders to refund granted'
-reject_refund.short_description = 'Update orders to refund rejected'
-revert_refund_to_pending.short_description = 'Update orders to refund decision pending'
-update_to_being_delivered.short_description = 'Update to being delivered'
-update_to_received.short_description = 'Update to received'
 
+def export_orders_jsonl(modeladmin, request, queryset):
+    return exports.streaming_export(queryset, 'jsonl')
 
-class OrderAdmin(admin.ModelAdmin):
+
+export_orders_csv.short_description = 'Export as CSV'
+export_orders_jsonl.short_description = 'Export as JSON lines'
+
+
+class OrderAdmin(LargeTableAdmin):
     list_display = [
         'user',
         'ordered',
@@ -49,7 +130,7 @@ class OrderAdmin(admin.ModelAdmin):
         'coupon',
     ]
     list_filter = [
-        'user',
+        UsernameFilter,
         'ordered',
         'being_delivered',
         'received',
@@ -63,10 +144,26 @@ class OrderAdmin(admin.ModelAdmin):
         'payment',
         'coupon'
     ]
+    # Address.__str__ and Payment.__str__ show the username
+    list_select_related = [
+        'user',
+        'billing_address__user',
+        'shipping_address__user',
+        'payment__user',
+        'coupon',
+    ]
     search_fields = [
         'user__username',
         'ref_code'
     ]
+    autocomplete_fields = [
+        'user',
+        'items',
+        'billing_address',
+        'shipping_address',
+        'payment',
+        'coupon',
+    ]
 
     actions = [
         accept_refund,
@@ -74,10 +171,31 @@ class OrderAdmin(admin.ModelAdmin):
         revert_refund_to_pending,
         update_to_being_delivered,
         update_to_received,
+        export_orders_csv,
+        export_orders_jsonl,
     ]
 
+    def save_model(self, request, obj, form, change):
+        if change and 'refund_granted' in form.changed_data:
+            rollups.record_refund_changes(
+                Order.objects.filter(pk=obj.pk), obj.refund_granted)
+        super().save_model(request, obj, form, change)
+
+
+def order_changelist_queryset(filters, user=None):
+    """
+    The orders the changelist lists for the query string `filters`, with
+    its filters and search applied as they would be for `user`.
+    """
+    request = HttpRequest()
+    request.GET = QueryDict(filters)
+    request.user = user or AnonymousUser()
+    model_admin = OrderAdmin(Order, admin.site)
+    changelist = model_admin.get_changelist_instance(request)
+    return changelist.get_queryset(request)
+
 
-class AddressAdmin(admin.ModelAdmin):
+class AddressAdmin(LargeTableAdmin):
     list_display = [
         'user',
         'street_address',
@@ -88,7 +206,9 @@ class AddressAdmin(admin.ModelAdmin):
         'address_type',
         'default',
     ]
+    list_select_related = ['user']
     list_filter = [
+        UsernameFilter,
         'default',
         'address_type',
         'country',
@@ -99,11 +219,105 @@ class AddressAdmin(admin.ModelAdmin):
         'apartment_address',
         'post_code',
     ]
+    autocomplete_fields = ['user']
+
+
+class PaymentAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'stripe_charge_id', 'amount', 'timestamp']
+    list_select_related = ['user']
+    list_filter = [UsernameFilter]
+    search_fields = ['stripe_charge_id', 'user__username']
+    autocomplete_fields = ['user']
+
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ['code', 'amount', 'active', 'valid_from', 'valid_until',
+                    'redemptions', 'max_redemptions', 'max_per_user']
+    list_filter = ['active']
+    search_fields = ['code']
+    readonly_fields = ['redemptions']
+
+
+class CouponRedemptionAdmin(LargeTableAdmin):
+    list_display = ['coupon', 'user', 'order', 'created']
+    list_select_related = ['coupon', 'user', 'order__user']
+    list_filter = [UsernameFilter]
+    search_fields = ['coupon__code']
+    autocomplete_fields = ['coupon', 'user', 'order']
+
+
+class StockReservationAdmin(LargeTableAdmin):
+    list_display = ['__str__', 'item', 'order', 'shard', 'quantity',
+                    'status', 'expires_at']
+    list_select_related = ['item', 'order__user']
+    list_filter = ['status']
+    search_fields = ['item__title']
+    autocomplete_fields = ['item', 'order']
+
+
+def resume_bulk_jobs(modeladmin, request, queryset):
+    # They carry on after their checkpoint
+    queryset.filter(status='failed').update(status='pending', error='')
+
+
+resume_bulk_jobs.short_description = 'Resume failed jobs'
+
+
+class BulkOrderJobAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'created_by', 'progress', 'processed',
+                    'total', 'created', 'updated']
+    list_filter = ['status', 'action']
+    list_select_related = ['created_by']
+    readonly_fields = ['action', 'status', 'batch_size', 'last_pk',
+                       'processed', 'total', 'progress', 'error',
+                       'created_by', 'locked_at', 'created', 'updated']
+    exclude = ['selection']
+    actions = [resume_bulk_jobs]
+
+    def progress(self, job):
+        return f'{job.get_progress()}%'
+
+    def has_add_permission(self, request):
+        return False
+
+
+class SalesDashboardAdmin(admin.ModelAdmin):
+    """
+    The sales of the last ?days= days instead of a changelist, read from
+    the rollups only (see core.rollups).
+    """
+    change_list_template = 'admin/sales_dashboard.html'
+    day_choices = (7, 30, 90, 365)
+
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        days = min(max(days, 1), 366)
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Sales',
+            opts=self.model._meta,
+            day_choices=self.day_choices,
+            **rollups.sales_report(days),
+            **(extra_context or {}),
+        )
+        return TemplateResponse(request, self.change_list_template, context)
+
+    def has_add_permission(self, request):
+        return False
 
 
-admin.site.register(Item)
+admin.site.register(Item, ItemAdmin)
 admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Address, AddressAdmin)
-admin.site.register(Payment)
-admin.site.register(Coupon)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(CouponRedemption, CouponRedemptionAdmin)
+admin.site.register(BulkOrderJob, BulkOrderJobAdmin)
+admin.site.register(DailySales, SalesDashboardAdmin)
+admin.site.register(StockReservation, StockReservationAdmin)
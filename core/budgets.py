@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+Budget = namedtuple('Budget', 'queries duplicates')
+
+# Most queries a request to each URL name may run, session and auth
+# lookups included, and how many of those may repeat an earlier query
+# word for word. QueryBudgetTests requests every view against these.
+VIEW_QUERY_BUDGETS = {
+    'core:home': Budget(5, 0),
+    'core:search': Budget(5, 0),
+    'core:product': Budget(4, 0),
+    'core:order-summary': Budget(4, 0),
+    'core:checkout': Budget(6, 0),
+    # Checking the stock held for the lines and redeeming a coupon take
+    # two each; with CHARGE_JOBS_EAGER the charge, the stock commit and
+    # the sales rollup updates run inside the request too, and the first
+    # sale of a day creates the rollup rows. The order is locked and quoted
+    # again before and after the charge, repeating those two queries.
+    'core:payment': Budget(32, 4),
+    'core:payment-status': Budget(3, 0),
+    'core:add-to-cart': Budget(9, 0),
+    'core:remove-from-cart': Budget(9, 0),
+    'core:add-item-quantity-in-cart': Budget(7, 0),
+    'core:reduce-item-quantity-in-cart': Budget(7, 0),
+    'core:remove-item-in-cart': Budget(9, 0),
+    # Plus cart.new_line_queries() for the lines it may create
+    'core:update-cart': Budget(11, 0),
+    'core:add-coupon': Budget(7, 0),
+    'core:request-refund': Budget(5, 0),
+    'admin:core_order_changelist': Budget(5, 0),
+    'admin:core_dailysales_changelist': Budget(5, 0),
+}
+
+# Transaction statements. Savepoints are only issued inside nested
+# atomic blocks, which tests wrap every view in, and only SQLite sends
+# BEGIN, so counting them would make the budgets depend on both.
+UNCOUNTED_PREFIXES = ('BEGIN', 'SAVEPOINT', 'RELEASE SAVEPOINT',
+                      'ROLLBACK TO SAVEPOINT')
+
+
+# The QueryStats of the request being handled on this thread
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def register(view_name, queries, duplicates=0):
+    VIEW_QUERY_BUDGETS[view_name] = Budget(queries, duplicates)
+
+
+@contextmanager
+def uncounted():
+    # Leaves the queries run inside out of the request's budget; for
+    # development-only checks such as ORDER_TOTALS_CHECK
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        yield
+        return
+    stats.paused += 1
+    try:
+        yield
+    finally:
+        stats.paused -= 1
+
+
+def allow(request, queries):
+    # Raise this request's budget, for views whose queries grow with input
+    stats = getattr(request, 'query_stats', None)
+    if stats is not None:
+        stats.allowance += queries
+
+
+class QueryStats:
+    """
+    Database wrapper (see connection.execute_wrapper) that counts queries,
+    repeated queries and the time spent in the database.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.allowance = 0
+        self.paused = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            if not self.paused and not sql.startswith(UNCOUNTED_PREFIXES):
+                self.count += 1
+                self.statements[(sql, repr(params))] += 1
+
+    @property
+    def duplicates(self):
+        return sum(n - 1 for n in self.statements.values())
+
+    def most_repeated(self, limit=3):
+        return [(sql, n) for (sql, _), n in
+                self.statements.most_common(limit) if n > 1]
+
+    def over_budget(self, budget):
+        problems = []
+        queries = budget.queries + self.allowance
+        if self.count > queries:
+            problems.append(f'{self.count} queries (budget {queries})')
+        if self.duplicates > budget.duplicates:
+            problems.append(f'{self.duplicates} duplicate queries '
+                            f'(budget {budget.duplicates})')
+        return problems
+
+    def server_timing(self):
+        return (f'db;dur={self.duration * 1000:.1f};'
+                f'desc="{self.count} queries"')
+
+
+class QueryBudgetMiddleware:
+    """
+    Measures the queries of every request, reports them in a
+    Server-Timing header and checks them against VIEW_QUERY_BUDGETS. Over
+    budget it logs a warning, or raises QueryBudgetExceeded when
+    QUERY_BUDGET_RAISE is set (development and tests). Goes first in
+    MIDDLEWARE so session and auth queries are included.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = request.query_stats = _local.stats = QueryStats()
+        try:
+            with connection.execute_wrapper(stats):
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        response['Server-Timing'] = stats.server_timing()
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else None
+        budget = VIEW_QUERY_BUDGETS.get(view_name)
+        problems = stats.over_budget(budget) if budget else None
+        if problems:
+            message = (f'{request.method} {request.path} ({view_name}) ran '
+                       f'{" and ".join(problems)}')
+            repeated = stats.most_repeated()
+            if repeated:
+                message += '; most repeated: ' + '; '.join(
+                    f'{n}x {sql[:200]}' for sql, n in repeated)
+            if settings.QUERY_BUDGET_RAISE:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,103 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .metrics import Counter
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+CACHE_REQUESTS = Counter(
+    'cache_requests_total',
+    'Cache lookups, by cache and result (hit or miss).',
+)
+
+
+def _record(name, value):
+    CACHE_REQUESTS.inc(cache=name, result='miss' if value is None else 'hit')
+    return value
+
+
+def _initial_version():
+    # Seed from the clock so a cold or evicted cache never reuses a
+    # version that older catalog pages may still be stored under
+    return time.time_ns() // 1000
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _initial_version(), None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    # Not incr(): on some backends (the database cache) that is a get
+    # then a set, so two concurrent bumps could land on the same version. Each bump takes
+    # the clock instead, or the next version if this host's clock lags.
+    current = cache.get(CATALOG_VERSION_KEY) or 0
+    cache.set(CATALOG_VERSION_KEY, max(_initial_version(), current + 1),
+              None)
+
+
+def catalog_page_key(page_key):
+    # Hashed: the filters and cursor come from the query string, and
+    # memcached takes at most 250 characters and no spaces
+    digest = hashlib.md5(page_key.encode()).hexdigest()
+    return f'catalog:page:{get_catalog_version()}:{digest}'
+
+
+def get_catalog_page(page_key):
+    return _record('catalog_page', cache.get(catalog_page_key(page_key)))
+
+
+def set_catalog_page(page_key, html):
+    cache.set(catalog_page_key(page_key), html,
+              settings.CATALOG_CACHE_TIMEOUT)
+
+
+def cart_summary_key(user_id):
+    return f'cart:summary:{user_id}'
+
+
+def get_cached_cart_summary(user_id):
+    if settings.CART_SUMMARY_CACHE_TIMEOUT:
+        return _record('cart_summary', cache.get(cart_summary_key(user_id)))
+
+
+def set_cached_cart_summary(user_id, summary):
+    if settings.CART_SUMMARY_CACHE_TIMEOUT:
+        cache.set(cart_summary_key(user_id), summary,
+                  settings.CART_SUMMARY_CACHE_TIMEOUT)
+
+
+def invalidate_cart_summary(*user_ids):
+    if not settings.CART_SUMMARY_CACHE_TIMEOUT or not user_ids:
+        return
+    keys = [cart_summary_key(user_id) for user_id in user_ids]
+    # Delete after commit so a concurrent request can't re-cache the
+    # pre-change summary
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def coupon_key(code):
+    return f'coupon:code:{code}'
+
+
+def get_cached_coupon(code):
+    return _record('coupon', cache.get(coupon_key(code)))
+
+
+def set_cached_coupon(code, entry, timeout):
+    cache.set(coupon_key(code), entry, timeout)
+
+
+def invalidate_coupons(*codes):
+    keys = [coupon_key(code) for code in codes]
+    # Again after commit, so a concurrent request can't re-cache the
+    # pre-change row
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
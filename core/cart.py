@@ -0,0 +1,532 @@
+import functools
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import (
+    Case, Count, Exists, F, IntegerField, OuterRef, Value, When)
+from django.utils import timezone
+
+from . import inventory
+from .cache import get_cached_cart_summary, set_cached_cart_summary
+from .metrics import Counter
+from .models import CHARGING_STATUSES, ChargeJob, Item, Order, OrderItem
+
+# Outcomes of the cart operations, mapped to messages by the views
+ADDED = 'added'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+REMOVED = 'removed'
+NOT_IN_CART = 'not_in_cart'
+NO_ORDER = 'no_order'
+OUT_OF_STOCK = 'out_of_stock'
+PAYMENT_PENDING = 'payment_pending'
+
+# Most queries each operation may run, transaction statements excluded,
+# for items whose stock isn't tracked. Enforced by
+# core.tests.CartServiceTests.
+QUERY_BUDGET = {
+    'add_item': 7,
+    'remove_item': 7,
+    'increase_quantity': 5,
+    'decrease_quantity': 6,
+}
+
+# Most line changes accepted by one set_quantities call
+MAX_BATCH_CHANGES = 100
+
+CART_MUTATIONS = Counter(
+    'cart_mutations_total',
+    'Cart changes made from the views, by operation, cart kind and outcome.',
+)
+
+# Guest carts live in the session as {'v': version, 'i': {slug: quantity}}
+GUEST_CART_SESSION_KEY = 'cart'
+GUEST_CART_VERSION = 1
+
+
+class OrderBeingPaid(ValueError):
+    def __init__(self):
+        super().__init__("Your order is being paid for and can't be changed "
+                         "until the payment finishes.")
+
+
+class CartSummary:
+    # total is None for guest carts, which would need a query to price
+    def __init__(self, order_id=None, item_count=0, total=0):
+        self.order_id = order_id
+        self.item_count = item_count
+        self.total = total
+
+    def __repr__(self):
+        return (f'<CartSummary order={self.order_id} '
+                f'items={self.item_count} total={self.total}>')
+
+    def as_dict(self):
+        return {
+            'order_id': self.order_id,
+            'item_count': self.item_count,
+            'total': self.total,
+        }
+
+    @classmethod
+    def from_order(cls, order):
+        if order is None:
+            return cls()
+        # Uses the prefetched lines when the order came from with_lines()
+        return cls(order.pk, len(order.items.all()), order.get_total())
+
+
+def get_open_order(request):
+    # Memoized for the rest of the request, with the lines prefetched, so
+    # views and the navbar share a single load of the open order
+    if not hasattr(request, '_open_order'):
+        request._open_order = None
+        if request.user.is_authenticated:
+            request._open_order = Order.objects.with_lines().filter(
+                user=request.user, ordered=False).first()
+    return request._open_order
+
+
+def load_cart_summary(user):
+    summary = get_cached_cart_summary(user.pk)
+    if summary is not None:
+        return summary
+    row = Order.objects.filter(user=user, ordered=False).annotate(
+        item_count=Count('items')).values(
+        'pk', 'item_count', 'subtotal', 'discount_total',
+        'coupon_total').first()
+    if row is None:
+        summary = CartSummary()
+    else:
+        total = row['subtotal'] - row['discount_total'] - row['coupon_total']
+        summary = CartSummary(row['pk'], row['item_count'], max(total, 0))
+    set_cached_cart_summary(user.pk, summary)
+    return summary
+
+
+def get_cart_summary(request):
+    if not hasattr(request, '_cart_summary'):
+        if not request.user.is_authenticated:
+            request._cart_summary = CartSummary(
+                item_count=len(GuestCart(request.session)), total=None)
+        elif hasattr(request, '_open_order'):
+            request._cart_summary = CartSummary.from_order(
+                request._open_order)
+        else:
+            request._cart_summary = load_cart_summary(request.user)
+    return request._cart_summary
+
+
+def _lock_open_order(user):
+    # Serializes concurrent changes to the same cart, and with
+    # jobs.enqueue_charge. `of` keeps the lock off the outer-joined coupon
+    # row. `being_paid` orders must not change: the charge was quoted.
+    charging = ChargeJob.objects.filter(order=OuterRef('pk'),
+                                        status__in=CHARGING_STATUSES)
+    return Order.objects.select_for_update(of=('self',)).select_related(
+        'coupon').annotate(being_paid=Exists(charging)).filter(
+        user=user, ordered=False).first()
+
+
+def _create_open_order(user):
+    # Migration 0004 allows one open order per user. If a concurrent
+    # request opened it first, wait for its lock and use that order.
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=user, ordered_date=timezone.now())
+    except IntegrityError:
+        return _lock_open_order(user), False
+    return order, True
+
+
+def _lines(order, slug):
+    return OrderItem.objects.filter(order=order, item__slug=slug)
+
+
+def _item(slug):
+    # (pk, stock_shards), or Item.DoesNotExist
+    row = Item.objects.filter(slug=slug).values_list(
+        'pk', 'stock_shards').first()
+    if row is None:
+        raise Item.DoesNotExist(slug)
+    return row
+
+
+def new_line_queries(count):
+    # Queries _create_lines runs for `count` lines beyond the two of a
+    # bulk insert. bulk_create only hands back primary keys on some
+    # backends (PostgreSQL); elsewhere each line is its own INSERT.
+    if connection.features.can_return_ids_from_bulk_insert:
+        return 0
+    return max(count - 1, 0)
+
+
+def _create_lines(order, quantities):
+    through = Order.items.through
+    lines = [OrderItem(user_id=order.user_id, item_id=item_id,
+                       ordered=False, quantity=quantity)
+             for item_id, quantity in quantities.items()]
+    if connection.features.can_return_ids_from_bulk_insert:
+        OrderItem.objects.bulk_create(lines)
+    else:
+        for line in lines:
+            line.save()
+    through.objects.bulk_create([
+        through(order_id=order.pk, orderitem_id=line.pk) for line in lines])
+
+
+@transaction.atomic
+def add_item(user, slug):
+    """
+    Add one of the item to the user's open order, creating the order if
+    needed. Raises Item.DoesNotExist for an unknown slug.
+    """
+    item_id, shards = _item(slug)
+    order = _lock_open_order(user)
+    created = order is None
+    if created:
+        order, created = _create_open_order(user)
+    if not created and order.being_paid:
+        return PAYMENT_PENDING
+    try:
+        inventory.reserve(order, item_id, shards)
+    except inventory.OutOfStock:
+        return OUT_OF_STOCK
+    if not created and OrderItem.objects.filter(
+            order=order, item_id=item_id).update(quantity=F('quantity') + 1):
+        order.update_totals()
+        return UPDATED
+    _create_lines(order, {item_id: 1})
+    order.update_totals()
+    return ADDED
+
+
+@transaction.atomic
+def remove_item(user, slug):
+    order = _lock_open_order(user)
+    if order is None:
+        return NO_ORDER
+    if order.being_paid:
+        return PAYMENT_PENDING
+    deleted, _ = _lines(order, slug).delete()
+    if not deleted:
+        return NOT_IN_CART
+    inventory.release(order, item__slug=slug)
+    order.update_totals()
+    return REMOVED
+
+
+@transaction.atomic
+def increase_quantity(user, slug):
+    order = _lock_open_order(user)
+    if order is None:
+        return NO_ORDER
+    if order.being_paid:
+        return PAYMENT_PENDING
+    if not _lines(order, slug).update(quantity=F('quantity') + 1):
+        return NOT_IN_CART
+    item_id, shards = _item(slug)
+    try:
+        inventory.reserve(order, item_id, shards)
+    except inventory.OutOfStock:
+        # Undoes the increase
+        transaction.set_rollback(True)
+        return OUT_OF_STOCK
+    order.update_totals()
+    return UPDATED
+
+
+@transaction.atomic
+def decrease_quantity(user, slug):
+    # Never goes below one; removing the line is remove_item's job
+    order = _lock_open_order(user)
+    if order is None:
+        return NO_ORDER
+    if order.being_paid:
+        return PAYMENT_PENDING
+    if not _lines(order, slug).filter(quantity__gt=1).update(
+            quantity=F('quantity') - 1):
+        return UNCHANGED if _lines(order, slug).exists() else NOT_IN_CART
+    inventory.release(order, 1, item__slug=slug)
+    order.update_totals()
+    return UPDATED
+
+
+def _reserve_changes(order, changes, merge):
+    # Stock for the changed quantities of tracked items, in item order like
+    # every other multi-item lock. A cart merged at login keeps what
+    # doesn't fit; the payment checks it again.
+    for (item_id, shards, slug), change in sorted(changes.items()):
+        if change < 0:
+            inventory.release(order, -change, item_id=item_id)
+        elif merge:
+            try:
+                inventory.reserve(order, item_id, shards, change, slug)
+            except inventory.OutOfStock:
+                pass
+        else:
+            inventory.reserve(order, item_id, shards, change, slug)
+
+
+def _write_quantities(user, quantities, merge):
+    items = {slug: (pk, shards) for slug, pk, shards in
+             Item.objects.filter(slug__in=list(quantities)).values_list(
+                 'slug', 'pk', 'stock_shards')}
+    item_ids = {slug: pk for slug, (pk, _) in items.items()}
+    missing = set(quantities) - set(item_ids)
+    if missing and not merge:
+        raise Item.DoesNotExist(', '.join(sorted(missing)))
+
+    order = _lock_open_order(user)
+    if order is None:
+        if not any(quantities[slug] for slug in item_ids):
+            return None
+        order, created = _create_open_order(user)
+        if not created and order.being_paid:
+            raise OrderBeingPaid()
+    elif order.being_paid:
+        raise OrderBeingPaid()
+    lines = {item_id: (pk, quantity) for item_id, pk, quantity in
+             OrderItem.objects.filter(
+                 order=order, item_id__in=item_ids.values()).values_list(
+                 'item_id', 'pk', 'quantity')}
+
+    updates, deletes, creates, changes = {}, [], {}, {}
+    for slug, (item_id, shards) in items.items():
+        quantity = quantities[slug]
+        line_id, current = lines.get(item_id, (None, 0))
+        if merge:
+            quantity += current
+        if shards and quantity != current:
+            changes[item_id, shards, slug] = quantity - current
+        if line_id is None:
+            if quantity:
+                creates[item_id] = quantity
+        elif quantity:
+            updates[line_id] = quantity
+        else:
+            deletes.append(line_id)
+
+    _reserve_changes(order, changes, merge)
+    if updates:
+        OrderItem.objects.filter(pk__in=updates).update(quantity=Case(
+            *[When(pk=pk, then=Value(quantity))
+              for pk, quantity in updates.items()],
+            output_field=IntegerField(),
+        ))
+    if deletes:
+        OrderItem.objects.filter(pk__in=deletes).delete()
+    if creates:
+        _create_lines(order, creates)
+    order.update_totals()
+    return order
+
+
+@transaction.atomic
+def set_quantities(user, quantities):
+    """
+    Set the quantity of several items in the user's open order at once;
+    ``quantities`` maps slugs to quantities and 0 removes the line.
+    Raises Item.DoesNotExist naming any unknown slugs, and, changing
+    nothing, inventory.OutOfStock when an item runs out and
+    OrderBeingPaid while the order's charge is in flight.
+    Returns the order, or None when there was no order and nothing to
+    add.
+    """
+    return _write_quantities(user, quantities, merge=False)
+
+
+@transaction.atomic
+def merge_quantities(user, quantities):
+    # Adds the quantities to the open order, skipping items that no longer
+    # exist. Used to fold a guest cart into the user's order at login.
+    return _write_quantities(user, quantities, merge=True)
+
+
+def _counted(method):
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        labels = {'operation': method.__name__, 'cart': self.kind}
+        try:
+            result = method(self, *args)
+        except Item.DoesNotExist:
+            CART_MUTATIONS.inc(result='unknown_item', **labels)
+            raise
+        except inventory.OutOfStock:
+            CART_MUTATIONS.inc(result=OUT_OF_STOCK, **labels)
+            raise
+        except OrderBeingPaid:
+            CART_MUTATIONS.inc(result=PAYMENT_PENDING, **labels)
+            raise
+        # set_quantities returns the order
+        CART_MUTATIONS.inc(
+            result=result if isinstance(result, str) else UPDATED, **labels)
+        return result
+    return wrapper
+
+
+class UserCart:
+    kind = 'user'
+
+    def __init__(self, user):
+        self.user = user
+
+    @_counted
+    def add_item(self, slug):
+        return add_item(self.user, slug)
+
+    @_counted
+    def remove_item(self, slug):
+        return remove_item(self.user, slug)
+
+    @_counted
+    def increase_quantity(self, slug):
+        return increase_quantity(self.user, slug)
+
+    @_counted
+    def decrease_quantity(self, slug):
+        return decrease_quantity(self.user, slug)
+
+    @_counted
+    def set_quantities(self, quantities):
+        return set_quantities(self.user, quantities)
+
+
+class GuestLines:
+    # Stands in for the Order.items manager in templates
+    def __init__(self, order_items):
+        self._order_items = order_items
+
+    def all(self):
+        return self._order_items
+
+    def count(self):
+        return len(self._order_items)
+
+
+class GuestOrder:
+    # Unsaved, template-compatible view of a guest cart
+    pk = id = None
+    coupon = coupon_id = None
+
+    def __init__(self, order_items):
+        self.items = GuestLines(order_items)
+
+    def get_total(self):
+        total = sum(line.get_final_price() for line in self.items.all())
+        return total if total > 0 else 0
+
+    def get_total_quantity(self):
+        return sum(line.quantity for line in self.items.all())
+
+
+class GuestCart:
+    """
+    Cart for anonymous visitors, kept in the session. Only item lookups
+    touch the database; the cart becomes Order rows when its owner logs in.
+    """
+    kind = 'guest'
+
+    def __init__(self, session):
+        self.session = session
+        data = session.get(GUEST_CART_SESSION_KEY) or {}
+        if data.get('v') != GUEST_CART_VERSION:
+            data = {}
+        self.lines = dict(data.get('i', {}))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def save(self):
+        if self.lines:
+            self.session[GUEST_CART_SESSION_KEY] = {
+                'v': GUEST_CART_VERSION, 'i': self.lines}
+        else:
+            self.session.pop(GUEST_CART_SESSION_KEY, None)
+
+    def clear(self):
+        self.lines = {}
+        self.save()
+
+    @_counted
+    def add_item(self, slug):
+        if slug in self.lines:
+            self.lines[slug] += 1
+            result = UPDATED
+        else:
+            if not Item.objects.filter(slug=slug).exists():
+                raise Item.DoesNotExist(slug)
+            self.lines[slug] = 1
+            result = ADDED
+        self.save()
+        return result
+
+    @_counted
+    def remove_item(self, slug):
+        if not self.lines:
+            return NO_ORDER
+        if slug not in self.lines:
+            return NOT_IN_CART
+        del self.lines[slug]
+        self.save()
+        return REMOVED
+
+    @_counted
+    def increase_quantity(self, slug):
+        if not self.lines:
+            return NO_ORDER
+        if slug not in self.lines:
+            return NOT_IN_CART
+        self.lines[slug] += 1
+        self.save()
+        return UPDATED
+
+    @_counted
+    def decrease_quantity(self, slug):
+        if not self.lines:
+            return NO_ORDER
+        if slug not in self.lines:
+            return NOT_IN_CART
+        if self.lines[slug] <= 1:
+            return UNCHANGED
+        self.lines[slug] -= 1
+        self.save()
+        return UPDATED
+
+    @_counted
+    def set_quantities(self, quantities):
+        known = set(Item.objects.filter(
+            slug__in=list(quantities)).values_list('slug', flat=True))
+        missing = set(quantities) - known
+        if missing:
+            raise Item.DoesNotExist(', '.join(sorted(missing)))
+        for slug, quantity in quantities.items():
+            if quantity:
+                self.lines[slug] = quantity
+            else:
+                self.lines.pop(slug, None)
+        self.save()
+        return self.as_order()
+
+    def as_order(self):
+        if not self.lines:
+            return None
+        items = {item.slug: item for item in
+                 Item.objects.filter(slug__in=list(self.lines))}
+        return GuestOrder([
+            OrderItem(item=items[slug], quantity=quantity)
+            for slug, quantity in self.lines.items() if slug in items
+        ])
+
+
+def for_request(request):
+    if request.user.is_authenticated:
+        return UserCart(request.user)
+    return GuestCart(request.session)
+
+
+def get_cart_order(request):
+    # The open order, or the guest cart dressed up as one
+    if request.user.is_authenticated:
+        return get_open_order(request)
+    return GuestCart(request.session).as_order()
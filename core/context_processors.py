@@ -0,0 +1,10 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import get_cart_summary
+
+
+def cart(request):
+    # Lazy so pages that never show the cart badge don't pay for it
+    return {
+        'cart': SimpleLazyObject(lambda: get_cart_summary(request)),
+    }
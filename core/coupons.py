@@ -0,0 +1,176 @@
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .cache import get_cached_coupon, invalidate_coupons, set_cached_coupon
+from .models import Coupon, CouponRedemption
+
+CODE_PATTERN = re.compile(r'[\w-]{1,15}')
+CACHED_FIELDS = ('pk', 'code', 'amount', 'active', 'valid_from',
+                 'valid_until', 'max_redemptions', 'max_per_user',
+                 'redemptions')
+# Cached for codes that don't exist, told apart from a miss (None)
+MISSING = {}
+
+# Per process: a flash sale hits the same few codes from every request
+_local = {}
+_local_lock = threading.Lock()
+LOCAL_CACHE_SIZE = 1000
+
+
+class CouponUnavailable(Exception):
+    pass
+
+
+def _get_local(code):
+    hit = _local.get(code)
+    if hit is not None and hit[0] > time.monotonic():
+        return hit[1]
+    return None
+
+
+def _set_local(code, entry):
+    with _local_lock:
+        if len(_local) >= LOCAL_CACHE_SIZE:
+            _local.clear()
+        expires = time.monotonic() + settings.COUPON_LOCAL_CACHE_TIMEOUT
+        _local[code] = (expires, entry)
+
+
+def invalidate(*codes):
+    # Other processes drop their copies within COUPON_LOCAL_CACHE_TIMEOUT
+    for code in codes:
+        _local.pop(code, None)
+    invalidate_coupons(*codes)
+
+
+def clear_local_cache():
+    _local.clear()
+
+
+def find_coupon(code):
+    """
+    The coupon with this code, or None. It is built from the cache, so
+    never save it. Unknown codes are cached too, for
+    COUPON_NEGATIVE_CACHE_TIMEOUT, so guessing codes doesn't reach the
+    database. `redemptions` may be a little behind.
+    """
+    if not code or not CODE_PATTERN.fullmatch(code):
+        return None
+    entry = _get_local(code)
+    if entry is None:
+        entry = get_cached_coupon(code)
+        if entry is None:
+            try:
+                coupon = Coupon.objects.get(code=code)
+            except Coupon.DoesNotExist:
+                entry = MISSING
+                timeout = settings.COUPON_NEGATIVE_CACHE_TIMEOUT
+            else:
+                entry = {name: getattr(coupon, name)
+                         for name in CACHED_FIELDS}
+                timeout = settings.COUPON_CACHE_TIMEOUT
+            set_cached_coupon(code, entry, timeout)
+        _set_local(code, entry)
+    if entry == MISSING:
+        return None
+    return Coupon(**entry)
+
+
+def user_redemptions(coupon, user_id, exclude_order=None):
+    redemptions = CouponRedemption.objects.filter(coupon_id=coupon.pk,
+                                                  user_id=user_id)
+    if exclude_order is not None:
+        redemptions = redemptions.exclude(order_id=exclude_order.pk)
+    return redemptions.count()
+
+
+def check_coupon(coupon, user, order=None, now=None):
+    """
+    Raise CouponUnavailable, with a message for the shopper, if the
+    coupon can't be applied. The limits are checked again, atomically,
+    when the order is paid.
+    """
+    now = now or timezone.now()
+    if coupon is None or not coupon.active:
+        raise CouponUnavailable('This coupon does not exist.')
+    if coupon.valid_from and now < coupon.valid_from:
+        raise CouponUnavailable('This coupon is not valid yet.')
+    if coupon.valid_until and now >= coupon.valid_until:
+        raise CouponUnavailable('This coupon has expired.')
+    if (coupon.max_redemptions is not None and
+            coupon.redemptions >= coupon.max_redemptions):
+        raise CouponUnavailable('This coupon has run out.')
+    if (coupon.max_per_user is not None and
+            user_redemptions(coupon, user.pk, order) >= coupon.max_per_user):
+        raise CouponUnavailable('You have already used this coupon.')
+
+
+def _redeemable(user_id, now):
+    used = CouponRedemption.objects.filter(
+        coupon_id=OuterRef('pk'), user_id=user_id).order_by().values(
+        'coupon_id').annotate(n=Count('pk')).values('n')
+    return (
+        Q(active=True) &
+        (Q(valid_from__isnull=True) | Q(valid_from__lte=now)) &
+        (Q(valid_until__isnull=True) | Q(valid_until__gt=now)) &
+        (Q(max_redemptions__isnull=True) |
+         Q(redemptions__lt=F('max_redemptions'))) &
+        (Q(max_per_user__isnull=True) |
+         Q(max_per_user__gt=Coalesce(Subquery(used), Value(0))))
+    )
+
+
+def redeem(order):
+    """
+    Take one redemption of the order's coupon for it, or raise
+    CouponUnavailable. The count only moves through a single conditional
+    UPDATE, so however many shoppers pay at once, no more than
+    max_redemptions succeed. The row stays locked until the surrounding
+    transaction commits; keep that short.
+    """
+    if not order.coupon_id:
+        return None
+    with transaction.atomic():
+        claimed = Coupon.objects.filter(
+            _redeemable(order.user_id, timezone.now()),
+            pk=order.coupon_id,
+        ).update(redemptions=F('redemptions') + 1)
+        if claimed:
+            return CouponRedemption.objects.create(
+                coupon_id=order.coupon_id, user_id=order.user_id,
+                order=order)
+    coupon = Coupon.objects.filter(pk=order.coupon_id).first()
+    if coupon is not None:
+        # Next lookups see it is used up
+        invalidate(coupon.code)
+    # Says why, or falls back on a generic reason
+    check_coupon(coupon, order.user, order)
+    raise CouponUnavailable('This coupon can no longer be used.')
+
+
+def release(order):
+    # Give back the redemption of an order whose charge failed
+    with transaction.atomic():
+        redemption = CouponRedemption.objects.select_related(
+            'coupon').filter(order=order).first()
+        if redemption is None:
+            return False
+        redemption.delete()
+        Coupon.objects.filter(pk=redemption.coupon_id).update(
+            redemptions=F('redemptions') - 1)
+        invalidate(redemption.coupon.code)
+    return True
+
+
+def remove_from_order(order):
+    with transaction.atomic():
+        order.coupon = None
+        order.save(update_fields=['coupon'])
+        order.update_totals()
@@ -0,0 +1,173 @@
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Q, When
+
+from .models import CATEGORY_CHOICES, LABEL_CHOICES, FacetCount, Item
+
+# Lower bound inclusive, upper bound exclusive; None means no upper bound
+PRICE_BUCKETS = ((0, 500), (500, 1000), (1000, 2500), (2500, 5000),
+                 (5000, None))
+PRICE_CHOICES = tuple(
+    (f'{low}-{high or ""}',
+     f'৳{low} - ৳{high}' if high else f'৳{low}+')
+    for low, high in PRICE_BUCKETS
+)
+DISCOUNT_CHOICES = (
+    ('1', 'On discount'),
+)
+FACETS = (
+    ('category', 'Category', CATEGORY_CHOICES),
+    ('label', 'Label', LABEL_CHOICES),
+    ('price', 'Price', PRICE_CHOICES),
+    ('discount', 'Offers', DISCOUNT_CHOICES),
+)
+FACET_NAMES = tuple(name for name, _, _ in FACETS)
+FACET_FIELDS = ('category', 'label', 'price', 'discount_price')
+
+# The price customers pay, as OrderItem.get_final_price works it out
+EFFECTIVE_PRICE = Case(
+    When(Q(discount_price__isnull=False) & ~Q(discount_price=0),
+         then=F('discount_price')),
+    default=F('price'),
+    output_field=IntegerField(),
+)
+
+
+def effective_price(price, discount_price):
+    return discount_price or price
+
+
+def price_bucket(price):
+    for (low, high), (value, _) in zip(PRICE_BUCKETS, PRICE_CHOICES):
+        if price >= low and (high is None or price < high):
+            return value
+    return PRICE_CHOICES[0][0]
+
+
+def facet_values(category, label, price, discount_price):
+    return {
+        'category': category,
+        'label': label,
+        'price': price_bucket(effective_price(price, discount_price)),
+        'discount': '1' if discount_price is not None else '0',
+    }
+
+
+def item_facet_values(item):
+    return facet_values(*(getattr(item, name) for name in FACET_FIELDS))
+
+
+def stored_facet_values(pk):
+    # The row stays locked until the save or delete commits, so a
+    # concurrent change of the item waits and then reads the new values
+    row = Item.objects.select_for_update().filter(pk=pk).values_list(
+        *FACET_FIELDS).first()
+    return facet_values(*row) if row else None
+
+
+def _adjust(values, delta):
+    rows = FacetCount.objects.filter(**values)
+    if rows.update(count=F('count') + delta) or delta < 0:
+        return
+    try:
+        with transaction.atomic():
+            FacetCount.objects.create(count=delta, **values)
+    except IntegrityError:
+        # Created by a concurrent write
+        rows.update(count=F('count') + delta)
+
+
+def update_facet_counts(old, new):
+    """
+    Move one item from the combination of facet values `old` to `new`.
+    Either side may be None for an item being created or deleted.
+    """
+    if old == new:
+        return
+    if old:
+        _adjust(old, -1)
+    if new:
+        _adjust(new, 1)
+
+
+def count_facets(rows):
+    # Items per combination of facet values, keyed in FACET_NAMES order
+    counts = Counter()
+    for row in rows:
+        values = facet_values(*row)
+        counts[tuple(values[name] for name in FACET_NAMES)] += 1
+    return counts
+
+
+@transaction.atomic
+def rebuild_facet_counts():
+    counts = count_facets(
+        Item.objects.values_list(*FACET_FIELDS).iterator())
+    FacetCount.objects.all().delete()
+    FacetCount.objects.bulk_create([
+        FacetCount(count=count, **dict(zip(FACET_NAMES, values)))
+        for values, count in counts.items()
+    ])
+
+
+def get_facet_counts(filters):
+    """
+    For each facet, how many items each of its values would list along
+    with the other active filters, summed from the per-combination rows
+    so the catalog itself is never counted.
+    """
+    counts = {name: Counter() for name in FACET_NAMES}
+    for row in FacetCount.objects.filter(count__gt=0).values(
+            *FACET_NAMES, 'count'):
+        for name in FACET_NAMES:
+            if all(row[other] == value for other, value in filters.items()
+                   if other != name):
+                counts[name][row[name]] += row['count']
+    return counts
+
+
+def filter_items(queryset, filters):
+    if 'category' in filters:
+        queryset = queryset.filter(category=filters['category'])
+    if 'label' in filters:
+        queryset = queryset.filter(label=filters['label'])
+    if 'price' in filters:
+        low, high = filters['price'].split('-')
+        queryset = queryset.annotate(effective_price=EFFECTIVE_PRICE).filter(
+            effective_price__gte=int(low))
+        if high:
+            queryset = queryset.filter(effective_price__lt=int(high))
+    if filters.get('discount') == '1':
+        queryset = queryset.filter(discount_price__isnull=False)
+    return queryset
+
+
+def filter_query(filters):
+    return urlencode(sorted(filters.items()))
+
+
+def build_facets(filters, counts):
+    """
+    Everything the facet bar needs: for each facet its options with their
+    counts, whether they are selected, and the link that toggles them.
+    """
+    facets = []
+    for name, title, choices in FACETS:
+        options = []
+        for value, label in choices:
+            active = filters.get(name) == value
+            toggled = {key: val for key, val in filters.items()
+                       if key != name}
+            if not active:
+                toggled[name] = value
+            options.append({
+                'value': value,
+                'label': label,
+                'count': counts.get(name, {}).get(value, 0),
+                'active': active,
+                'url': f'?{filter_query(toggled)}',
+            })
+        facets.append({'name': name, 'title': title, 'options': options})
+    return facets
@@ -2,6 +2,9 @@ from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
+from .facets import DISCOUNT_CHOICES, PRICE_CHOICES
+from .models import CATEGORY_CHOICES, LABEL_CHOICES
+
 PAYMENT_CHOICES = (
     ('S', 'Stripe'),
     ('P', 'PayPal')
@@ -53,3 +56,14 @@ class RefundForm(forms.Form):
     message = forms.CharField(widget=forms.Textarea(attrs={
         'rows': 4
     }))
+
+
+class ItemFilterForm(forms.Form):
+    category = forms.ChoiceField(choices=CATEGORY_CHOICES, required=False)
+    label = forms.ChoiceField(choices=LABEL_CHOICES, required=False)
+    price = forms.ChoiceField(choices=PRICE_CHOICES, required=False)
+    discount = forms.ChoiceField(choices=DISCOUNT_CHOICES, required=False)
+
+    def get_filters(self):
+        return {name: value for name, value in self.cleaned_data.items()
+                if value}
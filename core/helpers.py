@@ -1,2 +1,10 @@
+import random
+import string
+
+
 def replace_dash_with_slash(val):
     return '/'.join(val.split('-'))
+
+
+def create_ref_code(rng=random):
+    return ''.join(rng.choices(string.ascii_lowercase + string.digits, k=20))
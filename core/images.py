@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .cache import bump_catalog_version
+from .models import ImageVariantJob, Item
+from .storage import HASHED_NAME
+
+logger = logging.getLogger(__name__)
+
+VARIANT_DIR = 'variants'
+SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'optimize': True,
+             'progressive': True},
+}
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+
+def _variant_name(source_name, width, fmt):
+    # The media storage adds a content hash to the name on save
+    stem = HASHED_NAME.sub('', os.path.basename(source_name))
+    stem = os.path.splitext(stem)[0]
+    return f'{VARIANT_DIR}/{stem}-{width}w.{EXTENSIONS[fmt]}'
+
+
+def _encode(image, fmt):
+    if fmt == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = BytesIO()
+    image.save(buffer, **SAVE_OPTIONS[fmt])
+    return buffer.getvalue()
+
+
+def render_variants(source_name, storage=default_storage):
+    """
+    Write resized copies of `source_name` at each configured width and in
+    each configured format, and return their manifest. Widths at or above
+    the original size are skipped; the original width is always included.
+    """
+    with storage.open(source_name, 'rb') as f:
+        data = f.read()
+    original = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    original.load()
+
+    widths = sorted({width for width in settings.IMAGE_VARIANT_WIDTHS
+                     if width < original.width} | {original.width})
+    variants = []
+    for width in widths:
+        height = max(1, round(original.height * width / original.width))
+        resized = (original if width == original.width else
+                   original.resize((width, height), Image.LANCZOS))
+        for fmt in settings.IMAGE_VARIANT_FORMATS:
+            name = storage.save(_variant_name(source_name, width, fmt),
+                                ContentFile(_encode(resized, fmt)))
+            variants.append({
+                'name': name,
+                'width': width,
+                'height': height,
+                'format': fmt,
+            })
+    return {
+        'source': source_name,
+        'width': original.width,
+        'height': original.height,
+        'variants': variants,
+    }
+
+
+def _variant_names(manifest):
+    return {variant['name'] for variant in manifest.get('variants', [])}
+
+
+def delete_variants(names, storage=default_storage):
+    # Files are named after their content, so items with the same image
+    # share them; only delete the ones no manifest mentions any more
+    for name in names:
+        if not Item.objects.filter(
+                image_variants__contains=json.dumps(name)).exists():
+            storage.delete(name)
+
+
+def generate_variants(item_id):
+    """
+    Build the variants for an item's current image, store the manifest and
+    delete the files of the one it replaces. Returns True if the manifest
+    was written.
+    """
+    row = Item.objects.filter(pk=item_id).values_list(
+        'image', 'image_variants').first()
+    if not row or not row[0]:
+        return False
+    source_name, old_variants = row
+    manifest = render_variants(source_name)
+    # Conditional, so a slow job can't overwrite the manifest of an image
+    # replaced in the meantime; update() also skips the Item signals
+    updated = Item.objects.filter(pk=item_id, image=source_name).update(
+        image_variants=json.dumps(manifest))
+    if updated:
+        bump_catalog_version()
+        old = json.loads(old_variants) if old_variants else {}
+        delete_variants(_variant_names(old) - _variant_names(manifest))
+    else:
+        delete_variants(_variant_names(manifest))
+    return bool(updated)
+
+
+def needs_variants(item):
+    return bool(item.image) and (
+        item.get_image_variants().get('source') != item.image.name)
+
+
+def schedule_variants(item):
+    """
+    Queue the variants of the item's image for the worker, in the
+    transaction saving the item.
+    """
+    if not needs_variants(item):
+        return
+    job, _ = ImageVariantJob.objects.update_or_create(
+        item=item, defaults={'source': item.image.name, 'attempts': 0,
+                             'error': '', 'locked_at': None})
+    if settings.IMAGE_VARIANTS_EAGER:
+        transaction.on_commit(lambda: run_variant_job(job.pk))
+
+
+def claim_variant_job(job_id=None):
+    # Jobs left locked by a worker that died are handed out again
+    cutoff = timezone.now() - timedelta(seconds=settings.IMAGE_JOB_TIMEOUT)
+    ready = ImageVariantJob.objects.filter(
+        attempts__lt=settings.IMAGE_JOB_MAX_ATTEMPTS).filter(
+        Q(locked_at__isnull=True) | Q(locked_at__lt=cutoff))
+    if job_id is not None:
+        ready = ready.filter(pk=job_id)
+    for pk, locked_at in ready.order_by('pk').values_list(
+            'pk', 'locked_at')[:10]:
+        claimed = ImageVariantJob.objects.filter(
+            pk=pk, locked_at=locked_at).update(
+            locked_at=timezone.now(), attempts=F('attempts') + 1)
+        if claimed:
+            return ImageVariantJob.objects.get(pk=pk)
+    return None
+
+
+def run_variant_job(job_id=None):
+    job = claim_variant_job(job_id)
+    if job is None:
+        return None
+    # Left for the next run if the image changed while this one was busy
+    same_source = ImageVariantJob.objects.filter(pk=job.pk,
+                                                 source=job.source)
+    try:
+        generate_variants(job.item_id)
+    except Exception as e:
+        logger.exception('Could not build image variants for item %s',
+                         job.item_id)
+        same_source.update(locked_at=None,
+                           error=f'{type(e).__name__}: {e}'[:255])
+    else:
+        same_source.delete()
+    return job
+
+
+def run_pending_variants(limit=None):
+    done = 0
+    while limit is None or done < limit:
+        if run_variant_job() is None:
+            break
+        done += 1
+    return done
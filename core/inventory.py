@@ -0,0 +1,201 @@
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import (
+    CHARGING_STATUSES, Item, OrderItem, StockReservation, StockShard)
+
+# Shards tried at random before falling back on reading them all. Every
+# path that can hold more than one shard lock takes them by item, then
+# shard, so two transactions sharing items can't deadlock.
+PROBES = 2
+SWEEP_LIMIT = 500
+
+
+class OutOfStock(ValueError):
+    pass
+
+
+def _out_of_stock(name):
+    if name:
+        return OutOfStock(f'Not enough "{name}" in stock.')
+    return OutOfStock('Not enough in stock.')
+
+
+def set_stock(item, quantity, shards=None):
+    """
+    Spread `quantity` units of the item over `shards` rows and start
+    tracking its stock. Units already in carts come on top of these.
+    """
+    shards = shards or settings.INVENTORY_SHARDS
+    with transaction.atomic():
+        for shard in range(shards):
+            share = quantity // shards + (shard < quantity % shards)
+            if not StockShard.objects.filter(
+                    item=item, shard=shard).update(available=share):
+                StockShard.objects.create(item=item, shard=shard,
+                                          available=share)
+        StockShard.objects.filter(item=item, shard__gte=shards).delete()
+        Item.objects.filter(pk=item.pk).update(stock_shards=shards)
+    item.stock_shards = shards
+
+
+def stock_level(item_id):
+    return StockShard.objects.filter(item_id=item_id).aggregate(
+        total=Sum('available'))['total'] or 0
+
+
+def _take(item_id, shard, quantity):
+    # Locks only this shard's row until the transaction commits
+    return StockShard.objects.filter(
+        item_id=item_id, shard=shard, available__gte=quantity).update(
+        available=F('available') - quantity)
+
+
+def _give_back(item_id, shard, quantity):
+    # Shards past the item's current count, after set_stock shrank it,
+    # hand their units to shard 0
+    if not StockShard.objects.filter(item_id=item_id, shard=shard).update(
+            available=F('available') + quantity):
+        StockShard.objects.filter(item_id=item_id, shard=0).update(
+            available=F('available') + quantity)
+
+
+def _hold(order, seconds):
+    StockReservation.objects.filter(order=order, status='reserved').update(
+        expires_at=timezone.now() + timedelta(seconds=seconds))
+
+
+def reserve(order, item_id, shards, quantity=1, name=None):
+    """
+    Take `quantity` units of the item for the order, or raise OutOfStock
+    taking nothing. A random shard is tried first so concurrent shoppers
+    spread over the item's rows; only when shards run low are they read
+    and drained one by one. Holds all the order's units for another
+    INVENTORY_RESERVATION_TIMEOUT seconds.
+    """
+    if quantity <= 0 or not shards:
+        return
+    start = random.randrange(shards)
+    with transaction.atomic():
+        taken = []
+        # A probe that finds too few units locks nothing
+        for shard in [(start + n) % shards
+                      for n in range(min(PROBES, shards))]:
+            if _take(item_id, shard, quantity):
+                taken.append((shard, quantity))
+                break
+        else:
+            remaining = quantity
+            for shard, available in StockShard.objects.filter(
+                    item_id=item_id, available__gt=0).order_by(
+                    'shard').values_list('shard', 'available'):
+                share = min(available, remaining)
+                if _take(item_id, shard, share):
+                    taken.append((shard, share))
+                    remaining -= share
+                    if not remaining:
+                        break
+            if remaining:
+                # Rolls back what was taken
+                raise _out_of_stock(name)
+        StockReservation.objects.bulk_create([
+            StockReservation(item_id=item_id, order=order, shard=shard,
+                             quantity=share)
+            for shard, share in taken])
+        _hold(order, settings.INVENTORY_RESERVATION_TIMEOUT)
+
+
+def _release_rows(rows, quantity=None):
+    # Rows already given back, by the sweeper or a concurrent request,
+    # are skipped by the conditional delete/update
+    released = 0
+    for pk, item_id, shard, reserved in rows:
+        share = reserved if quantity is None else min(
+            reserved, quantity - released)
+        if share <= 0:
+            break
+        held = StockReservation.objects.filter(pk=pk, status='reserved')
+        if share == reserved:
+            done = held.delete()[0]
+        else:
+            done = held.filter(quantity__gt=share).update(
+                quantity=F('quantity') - share)
+        if done:
+            _give_back(item_id, shard, share)
+            released += share
+    return released
+
+
+def release(order, quantity=None, **lookups):
+    """
+    Give back up to `quantity` of the order's reserved units matching
+    `lookups` (all of them without a quantity), in item and shard order.
+    Returns the number of units given back.
+    """
+    rows = StockReservation.objects.filter(
+        order=order, status='reserved', **lookups).order_by(
+        'item_id', 'shard', '-pk').values_list(
+        'pk', 'item_id', 'shard', 'quantity')
+    with transaction.atomic():
+        return _release_rows(list(rows), quantity)
+
+
+def reserve_order(order):
+    """
+    Make the order's reservations cover its tracked lines exactly, held
+    for INVENTORY_PAYMENT_HOLD while it is paid. Raises OutOfStock, with
+    the order untouched, if an item ran out since it went in the cart.
+    """
+    wanted = {item_id: (shards, title, quantity)
+              for item_id, shards, title, quantity in OrderItem.objects.filter(
+                  order=order, item__stock_shards__gt=0).values_list(
+                  'item_id', 'item__stock_shards', 'item__title').annotate(
+                  quantity=Sum('quantity')).order_by()}
+    held = dict(StockReservation.objects.filter(
+        order=order, status='reserved').values_list('item_id').annotate(
+        quantity=Sum('quantity')).order_by())
+    if not wanted and not held:
+        return
+    with transaction.atomic():
+        for item_id in sorted(wanted.keys() | held.keys()):
+            shards, title, quantity = wanted.get(item_id, (0, None, 0))
+            missing = quantity - held.get(item_id, 0)
+            if missing > 0:
+                reserve(order, item_id, shards, missing, title)
+            elif missing < 0:
+                release(order, -missing, item_id=item_id)
+        _hold(order, settings.INVENTORY_PAYMENT_HOLD)
+
+
+def commit_order(order):
+    # The units are sold; call in the transaction that marks it ordered
+    return StockReservation.objects.filter(
+        order=order, status='reserved').update(
+        status='committed', expires_at=None)
+
+
+def release_expired(limit=SWEEP_LIMIT, now=None):
+    """
+    Give back reservations past their expiry, except those of orders
+    being charged. Safe to run from several workers at once. Returns the
+    number of reservations released.
+    """
+    now = now or timezone.now()
+    rows = StockReservation.objects.filter(
+        status='reserved', expires_at__lt=now).exclude(
+        order__chargejob__status__in=CHARGING_STATUSES).order_by(
+        'expires_at').values_list('pk', 'item_id', 'shard', 'quantity')
+    released = 0
+    for pk, item_id, shard, quantity in rows[:limit]:
+        with transaction.atomic():
+            # Extended or released since it was read
+            if StockReservation.objects.filter(
+                    pk=pk, status='reserved', expires_at__lt=now).delete()[0]:
+                _give_back(item_id, shard, quantity)
+                released += 1
+    return released
@@ -0,0 +1,380 @@
+import hashlib
+import json
+import logging
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import coupons, helpers, inventory, payments, rollups
+from .metrics import Counter
+from .models import BulkOrderJob, ChargeJob, Order, Payment
+
+logger = logging.getLogger(__name__)
+
+CHARGE_RESULTS = Counter(
+    'payment_charges_total',
+    'Charge attempts, by outcome (succeeded, retry, failed) and error class.',
+)
+
+# A job in one of these states blocks a second charge for the same order
+ACTIVE_CHARGE_STATUSES = ('pending', 'processing', 'succeeded')
+
+ORDER_CHANGED_MESSAGE = ("Your order changed while it was being paid for. "
+                         "You were not charged; please check it and pay "
+                         "again.")
+CHARGED_ORDER_CHANGED_MESSAGE = (
+    "Your order changed while it was being paid for. The payment was "
+    "refunded; please check it and pay again.")
+REFUND_FAILED_MESSAGE = (
+    "Your order changed while it was being paid for. We couldn't refund "
+    "the payment right away and will do so shortly; please check your "
+    "order and pay again.")
+
+
+class OrderChanged(Exception):
+    pass
+
+
+def lock_order(order):
+    """
+    The order again, its row locked until the transaction ends, with its
+    totals worked out from the lines as they are now (with_totals()).
+    """
+    return Order.objects.with_totals().select_for_update().get(pk=order.pk)
+
+
+def quote_order(order):
+    # Tells apart any two carts that would charge differently, or for
+    # different things. `order` comes from lock_order().
+    lines = sorted(order.items.values_list('item_id', 'quantity'))
+    quote = [lines, order.coupon_id, order.computed_total]
+    return hashlib.sha256(json.dumps(quote).encode()).hexdigest()
+
+
+# The fields each bulk order action sets, see BULK_ORDER_ACTION_CHOICES
+BULK_ORDER_UPDATES = {
+    'accept_refund': {'refund_requested': False, 'refund_granted': True},
+    'reject_refund': {'refund_requested': False, 'refund_granted': False},
+    'revert_refund_to_pending': {'refund_requested': True,
+                                 'refund_granted': False},
+    'update_to_being_delivered': {'being_delivered': True},
+    'update_to_received': {'received': True},
+}
+
+
+def enqueue_charge(order, token):
+    """
+    Queue a Stripe charge for the order's current total and return the
+    job. Submitting twice returns the job already in flight. Reserves the
+    stock of the order's lines for the payment, raising
+    inventory.OutOfStock if some ran out. Redeems the order's coupon, or
+    takes it off the order and raises coupons.CouponUnavailable when it
+    can't be used any more.
+    """
+    job = ChargeJob.objects.filter(
+        order=order, status__in=ACTIVE_CHARGE_STATUSES).first()
+    if job is not None:
+        return job
+    attempt = ChargeJob.objects.filter(order=order).count() + 1
+    try:
+        with transaction.atomic():
+            # Cart changes wait for the order's row, and are refused once
+            # the job exists, so the quote holds until the job finishes
+            order = lock_order(order)
+            # Charge what the order adds up to right now, not a stale total
+            totals = order.get_computed_totals()
+            Order.objects.filter(pk=order.pk).update(**totals)
+            for name, value in totals.items():
+                setattr(order, name, value)
+            # The stock shards and coupon row stay locked until this
+            # commits, so the charge itself runs afterwards
+            inventory.reserve_order(order)
+            coupons.redeem(order)
+            job = ChargeJob.objects.create(
+                order=order,
+                user_id=order.user_id,
+                idempotency_key=f'order-{order.pk}-charge-{attempt}',
+                token=token or '',
+                amount=order.get_total(),
+                quote=quote_order(order),
+            )
+    except IntegrityError:
+        # A concurrent submit for the same order won the race
+        return ChargeJob.objects.filter(order=order).latest('pk')
+    except coupons.CouponUnavailable:
+        # Nothing is charged; the shopper sees the total without it
+        coupons.remove_from_order(order)
+        raise
+    if settings.CHARGE_JOBS_EAGER:
+        job = run_charge_job(job.pk) or job
+    return job
+
+
+def charge_retry_delay(attempts):
+    # Exponential backoff, jittered so jobs failed together spread out
+    ceiling = settings.CHARGE_JOB_RETRY_DELAY * 2 ** (attempts - 1)
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def claim_charge_job(job_id=None):
+    # The conditional UPDATE makes the claim atomic on every backend, so
+    # two workers can never pick up the same job
+    pending = ChargeJob.objects.filter(status='pending').filter(
+        Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()))
+    if job_id is not None:
+        pending = pending.filter(pk=job_id)
+    for pk in pending.order_by('pk').values_list('pk', flat=True)[:10]:
+        claimed = ChargeJob.objects.filter(pk=pk, status='pending').update(
+            status='processing',
+            locked_at=timezone.now(),
+            attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return ChargeJob.objects.select_related('order', 'user').get(
+                pk=pk)
+    return None
+
+
+def _finish(job, status, **fields):
+    job.status = status
+    job.locked_at = None
+    if status != 'pending':
+        # Tokens are single use; don't keep them around
+        job.token = ''
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.save()
+
+
+def check_quote(job):
+    """
+    Lock the job's order and return it, or raise OrderChanged if it no
+    longer matches what the job was quoted for. Jobs queued before quotes
+    existed are not checked.
+    """
+    order = lock_order(job.order)
+    if job.quote and quote_order(order) != job.quote:
+        raise OrderChanged(f'Order {order.pk} no longer matches {job}')
+    return order
+
+
+def complete_order(job, charge_id):
+    # Raises OrderChanged, recording nothing, unless the order is still
+    # what was charged for
+    order = check_quote(job)
+    amount = job.amount
+    payment = Payment.objects.create(
+        stripe_charge_id=charge_id,
+        user_id=order.user_id,
+        amount=amount,
+    )
+    order.items.mark_ordered()
+    order.ordered = True
+    order.payment = payment
+    order.ref_code = helpers.create_ref_code()
+    order.save(update_fields=['ordered', 'payment', 'ref_code'])
+    inventory.commit_order(order)
+    rollups.record_order(order, amount)
+    return payment
+
+
+def _fail_changed(job, message, **fields):
+    with transaction.atomic():
+        _finish(job, 'failed', error=message, **fields)
+        coupons.release(job.order)
+    CHARGE_RESULTS.inc(outcome='failed', error='OrderChanged')
+    return job
+
+
+def process_charge_job(job):
+    order = job.order
+    try:
+        with transaction.atomic():
+            check_quote(job)
+    except OrderChanged:
+        return _fail_changed(job, ORDER_CHANGED_MESSAGE)
+    description = f"Charge for {job.user.username} on order ID {order.id}"
+    try:
+        charge = payments.create_charge(
+            amount=job.amount,
+            currency="bdt",
+            source=job.token,
+            description=description,
+            idempotency_key=job.idempotency_key,
+        )
+    except Exception as e:
+        if (payments.is_retryable(e) and
+                job.attempts < settings.CHARGE_JOB_MAX_ATTEMPTS):
+            _finish(job, 'pending', error=payments.charge_error_message(e),
+                    run_after=timezone.now() + timedelta(
+                        seconds=charge_retry_delay(job.attempts)))
+            outcome = 'retry'
+        else:
+            if not isinstance(e, payments.stripe.error.StripeError):
+                logger.exception('Charge job %s crashed', job.pk)
+            with transaction.atomic():
+                _finish(job, 'failed',
+                        error=payments.charge_error_message(e))
+                coupons.release(order)
+            outcome = 'failed'
+        CHARGE_RESULTS.inc(outcome=outcome, error=type(e).__name__)
+        return job
+
+    try:
+        with transaction.atomic():
+            complete_order(job, charge['id'])
+            _finish(job, 'succeeded', charge_id=charge['id'], error='')
+    except OrderChanged:
+        # Only an admin price change can get here: the cart is locked
+        return _refund_changed(job, charge['id'])
+    CHARGE_RESULTS.inc(outcome='succeeded', error='')
+    return job
+
+
+def _refund_changed(job, charge_id):
+    # The charge went through for an order that no longer matches it, so
+    # none of it is recorded and the money goes back
+    try:
+        refund = payments.refund_charge(
+            charge_id, idempotency_key=f'{job.idempotency_key}-refund')
+    except Exception:
+        logger.exception('Order %s changed while charge %s was made and '
+                         'the refund failed; refund it by hand',
+                         job.order_id, charge_id)
+        return _fail_changed(job, REFUND_FAILED_MESSAGE, charge_id=charge_id)
+    logger.warning('Order %s changed while charge %s was made; refunded '
+                   'as %s', job.order_id, charge_id, refund['id'])
+    return _fail_changed(job, CHARGED_ORDER_CHANGED_MESSAGE,
+                         charge_id=charge_id, refund_id=refund['id'])
+
+
+def run_charge_job(job_id=None):
+    job = claim_charge_job(job_id)
+    if job is not None:
+        return process_charge_job(job)
+
+
+def run_pending_charges(limit=None):
+    done = 0
+    while limit is None or done < limit:
+        if run_charge_job() is None:
+            break
+        done += 1
+    return done
+
+
+def requeue_stale_charge_jobs():
+    # Jobs left 'processing' by a worker that died are safe to run again
+    # thanks to the idempotency key
+    cutoff = timezone.now() - timedelta(seconds=settings.CHARGE_JOB_TIMEOUT)
+    return ChargeJob.objects.filter(
+        status='processing', locked_at__lt=cutoff).update(
+        status='pending', locked_at=None)
+
+
+def enqueue_bulk_order_job(action, selection, user=None):
+    """
+    Queue `action` over the orders in `selection`, either {'pks': [...]}
+    or {'filters': query_string} with the admin changelist's filters.
+    """
+    if action not in BULK_ORDER_UPDATES:
+        raise ValueError(f'Unknown bulk order action {action}')
+    job = BulkOrderJob.objects.create(
+        action=action,
+        selection=json.dumps(selection),
+        batch_size=settings.BULK_JOB_BATCH_SIZE,
+        created_by=user if user and user.is_authenticated else None,
+    )
+    if settings.BULK_JOBS_EAGER:
+        transaction.on_commit(lambda: run_bulk_order_job(job.pk,
+                                                         max_batches=None))
+    return job
+
+
+def bulk_job_queryset(job):
+    selection = json.loads(job.selection)
+    if 'pks' in selection:
+        return Order.objects.filter(pk__in=selection['pks'])
+    # Imported here: the admin module queues the jobs
+    from .admin import order_changelist_queryset
+    return order_changelist_queryset(selection['filters'], job.created_by)
+
+
+def claim_bulk_order_job(job_id=None):
+    # Like claim_charge_job; 'running' jobs whose worker stopped
+    # heartbeating are handed out again
+    cutoff = timezone.now() - timedelta(seconds=settings.BULK_JOB_TIMEOUT)
+    claimable = BulkOrderJob.objects.filter(
+        Q(status='pending') | Q(status='running', locked_at__lt=cutoff))
+    if job_id is not None:
+        claimable = claimable.filter(pk=job_id)
+    for pk in claimable.order_by('pk').values_list('pk', flat=True)[:10]:
+        claimed = BulkOrderJob.objects.filter(
+            Q(status='pending') | Q(status='running', locked_at__lt=cutoff),
+            pk=pk,
+        ).update(status='running', locked_at=timezone.now())
+        if claimed:
+            return BulkOrderJob.objects.get(pk=pk)
+    return None
+
+
+def process_bulk_order_batch(job, queryset):
+    """
+    Apply the job's action to the next batch of orders after `last_pk`
+    and move the checkpoint, in one transaction. Returns the number of
+    orders in the batch.
+    """
+    with transaction.atomic():
+        pks = list(queryset.filter(pk__gt=job.last_pk).order_by(
+            'pk').values_list('pk', flat=True)[:job.batch_size])
+        if pks:
+            updates = BULK_ORDER_UPDATES[job.action]
+            batch = Order.objects.filter(pk__in=pks)
+            if 'refund_granted' in updates:
+                rollups.record_refund_changes(batch,
+                                              updates['refund_granted'])
+            batch.update(**updates)
+            job.last_pk = pks[-1]
+            job.processed += len(pks)
+        job.locked_at = timezone.now()
+        job.save(update_fields=['last_pk', 'processed', 'locked_at',
+                                'updated'])
+    return len(pks)
+
+
+def process_bulk_order_job(job, max_batches=None):
+    """
+    Run up to `max_batches` batches of a claimed job (all of them for
+    None). A job with batches left goes back to 'pending', so charges
+    and other jobs get a turn before it resumes from its checkpoint.
+    """
+    try:
+        queryset = bulk_job_queryset(job)
+        if job.total is None:
+            job.total = queryset.count()
+            job.save(update_fields=['total', 'updated'])
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            if process_bulk_order_batch(job, queryset) < job.batch_size:
+                job.status = 'done'
+                break
+            batches += 1
+        else:
+            job.status = 'pending'
+    except Exception as e:
+        logger.exception('Bulk order job %s crashed', job.pk)
+        job.status = 'failed'
+        job.error = str(e)[:255]
+    job.locked_at = None
+    job.save(update_fields=['status', 'error', 'locked_at', 'updated'])
+    return job
+
+
+def run_bulk_order_job(job_id=None, max_batches=None):
+    job = claim_bulk_order_job(job_id)
+    if job is not None:
+        return process_bulk_order_job(job, max_batches)
@@ -0,0 +1,116 @@
+import json
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core import inventory
+from core.metrics import percentile
+from core.models import Item, Order, StockReservation
+
+
+class Command(BaseCommand):
+    help = ('Benchmark concurrent stock reservations of a single item for '
+            'each shard count and print the results as JSON. Each '
+            'reservation keeps its shard locked for --hold seconds, as the '
+            'rest of a cart transaction would.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', default='1,2,4,8,16',
+                            help='Comma separated shard counts to compare.')
+        parser.add_argument('--reservations', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--hold', type=float, default=0.002)
+        parser.add_argument('--stock', type=int, default=0,
+                            help='Units on sale, --reservations by default.')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stderr.write(self.style.WARNING(
+                'SQLite locks the whole database for each write, so more '
+                'shards cannot help here; run against PostgreSQL to see '
+                'them scale.'))
+        users = [get_user_model().objects.create_user(f'bench-inventory-{n}')
+                 for n in range(options['concurrency'])]
+        orders = [Order.objects.create(user=user, ordered_date=timezone.now())
+                  for user in users]
+        results = []
+        try:
+            for shards in [int(n) for n in options['shards'].split(',')]:
+                results.append(self.run(orders, shards, options))
+        finally:
+            StockReservation.objects.filter(order__in=orders).delete()
+            get_user_model().objects.filter(
+                pk__in=[user.pk for user in users]).delete()
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def reserve(self, order, item, hold):
+        started = time.monotonic()
+        try:
+            with transaction.atomic():
+                inventory.reserve(order, item.pk, item.stock_shards)
+                if hold:
+                    time.sleep(hold)
+            outcome = 'ok'
+        except Exception as e:
+            outcome = type(e).__name__
+        return time.monotonic() - started, outcome
+
+    def run(self, orders, shards, options):
+        total = options['reservations']
+        stock = options['stock'] or total
+        item = Item.objects.create(
+            title=f'Benchmark drop ({shards} shards)', price=1,
+            category='S', label='P', slug=f'bench-inventory-{shards}',
+            description='Benchmark item', image='bench.jpg')
+        inventory.set_stock(item, stock, shards=shards)
+        samples = []
+        lock = threading.Lock()
+
+        def worker(order, count):
+            mine = [self.reserve(order, item, options['hold'])
+                    for _ in range(count)]
+            connection.close()
+            with lock:
+                samples.extend(mine)
+
+        share, extra = divmod(total, len(orders))
+        threads = [threading.Thread(target=worker,
+                                    args=(order, share + (n < extra)))
+                   for n, order in enumerate(orders)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        latencies = [latency * 1000 for latency, _ in samples]
+        outcomes = Counter(outcome for _, outcome in samples)
+        held = sum(StockReservation.objects.filter(item=item).values_list(
+            'quantity', flat=True))
+        left = inventory.stock_level(item.pk)
+        StockReservation.objects.filter(item=item).delete()
+        item.delete()
+        return {
+            'shards': shards,
+            'reservations': total,
+            'concurrency': len(orders),
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(total / elapsed, 1),
+            'latency_ms': {
+                'mean': round(statistics.mean(latencies), 2),
+                'p50': round(percentile(latencies, 0.50), 2),
+                'p95': round(percentile(latencies, 0.95), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+            },
+            'outcomes': dict(outcomes),
+            # Every unit is either still on sale or in exactly one cart
+            'stock_left': left,
+            'oversold': held + left != stock,
+        }
@@ -0,0 +1,89 @@
+import json
+import statistics
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from core import payments
+from core.metrics import percentile
+from core.stripe_stub import start_stub_server
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the pooled Stripe client against the local stub '
+            'server and print the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--latency', type=float, default=0.02)
+        parser.add_argument('--error-rate', type=float, default=0.05)
+        parser.add_argument('--pool-size', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        server = start_stub_server(
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+        )
+        overrides = override_settings(
+            STRIPE_BACKEND='stripe',
+            STRIPE_API_BASE=server.url,
+            STRIPE_SECRET_KEY='sk_test_stub',
+            STRIPE_POOL_SIZE=options['pool_size'],
+        )
+        with overrides:
+            payments.configure_http_client(force=True)
+            payments.STRIPE_LATENCY.reset()
+            results = self.run(options['requests'], options['concurrency'])
+        payments.configure_http_client(force=True)
+        server.shutdown()
+        server.server_close()
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def charge(self, i):
+        started = time.monotonic()
+        try:
+            payments.create_charge(
+                amount=1000,
+                currency='bdt',
+                source='tok_visa',
+                description=f'Benchmark charge {i}',
+                idempotency_key=f'bench-{uuid.uuid4().hex}',
+            )
+            outcome = 'ok'
+        except Exception as e:
+            outcome = type(e).__name__
+        return time.monotonic() - started, outcome
+
+    def run(self, total, concurrency):
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(self.charge, range(total)))
+        elapsed = time.monotonic() - started
+
+        latencies = [latency * 1000 for latency, _ in samples]
+        outcomes = Counter(outcome for _, outcome in samples)
+        attempts = Counter()
+        for key, series in payments.STRIPE_LATENCY.snapshot().items():
+            attempts[dict(key)['outcome']] += sum(series['counts'])
+        return {
+            'requests': total,
+            'concurrency': concurrency,
+            'elapsed_s': round(elapsed, 3),
+            'throughput_rps': round(total / elapsed, 1),
+            'latency_ms': {
+                'mean': round(statistics.mean(latencies), 2),
+                'p50': round(percentile(latencies, 0.50), 2),
+                'p95': round(percentile(latencies, 0.95), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+            },
+            'outcomes': dict(outcomes),
+            'http_attempts': dict(attempts),
+            'retries': sum(attempts.values()) - total,
+        }
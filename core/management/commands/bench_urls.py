@@ -0,0 +1,462 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.urls import get_resolver
+
+from core import payments
+from core.metrics import percentile
+from core.models import Coupon, Item, Order
+from core.seeding import seed_shop
+from core.stripe_stub import start_stub_server
+
+BENCH_PASSWORD = 'bench-password-1'
+QUERY_HEADER = 'X-Bench-Queries'
+
+# name, core URL name, HTTP method, request builder and an optional setup
+# step that runs before each request without being timed
+Scenario = namedtuple('Scenario', 'name url_name method build setup')
+
+
+class QueryCountingApp:
+    """
+    WSGI wrapper that reports the number of queries each request ran in a
+    response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        queries = []
+
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        def start(status, headers, exc_info=None):
+            headers.append((QUERY_HEADER, str(len(queries))))
+            return start_response(status, headers, exc_info)
+
+        with connection.execute_wrapper(count):
+            return self.app(environ, start)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class BenchClient:
+    """
+    One simulated shopper: a logged-in session plus the ids it works on.
+    """
+
+    def __init__(self, base_url, username, data):
+        self.base_url = base_url
+        self.username = username
+        self.data = data
+        self.session = requests.Session()
+        self.job_path = None
+
+    def url(self, path):
+        return self.base_url + path
+
+    def request(self, method, path, data=None, json=None):
+        headers = {}
+        if method == 'POST':
+            headers['X-CSRFToken'] = self.session.cookies.get('csrftoken', '')
+        return self.session.request(
+            method, self.url(path), data=data, json=json, headers=headers,
+            allow_redirects=False, timeout=60)
+
+    def login(self):
+        self.session.get(self.url('/accounts/login/'))
+        response = self.request('POST', '/accounts/login/', data={
+            'login': self.username, 'password': BENCH_PASSWORD})
+        if response.status_code != 302:
+            raise CommandError(f'Could not log in as {self.username}')
+
+    def slug(self, i):
+        slugs = self.data['slugs']
+        return slugs[i % len(slugs)]
+
+    def fill_cart(self, i=0):
+        self.request('GET', f'/add-to-cart/{self.slug(i)}')
+
+    def check_out(self, i=0):
+        self.fill_cart(i)
+        self.request('POST', '/checkout/', data=CHECKOUT_FORM)
+
+    def pay(self, i=0):
+        self.check_out(i)
+        response = self.request('POST', '/payment/stripe',
+                                data={'stripeToken': 'tok_visa'})
+        self.job_path = response.headers.get('Location')
+        return response
+
+
+CHECKOUT_FORM = {
+    'shipping_address': '1 Bench Street',
+    'shipping_address2': 'Apt 1',
+    'shipping_country': 'BD',
+    'shipping_city': 'Dhaka',
+    'shipping_post': '1000',
+    'same_billing_address': 'on',
+    'payment_option': 'S',
+}
+
+
+def _get(path):
+    return lambda client, i: ('GET', path(client, i), {})
+
+
+def _post(path, **kwargs):
+    return lambda client, i: ('POST', path(client, i), {
+        key: value(client, i) for key, value in kwargs.items()})
+
+
+def _ensure_job(client, i):
+    if client.job_path is None:
+        client.pay(i)
+
+
+SCENARIOS = [
+    Scenario('home', 'home', 'GET', _get(lambda c, i: '/'), None),
+    Scenario('home:filtered', 'home', 'GET',
+             _get(lambda c, i: '/?category=S&discount=1'), None),
+    Scenario('search', 'search', 'GET',
+             _get(lambda c, i: f'/search/?q=item+{i % 50}'), None),
+    Scenario('product', 'product', 'GET',
+             _get(lambda c, i: f'/product/{c.slug(i)}'), None),
+    Scenario('add-to-cart', 'add-to-cart', 'GET',
+             _get(lambda c, i: f'/add-to-cart/{c.slug(i)}'), None),
+    Scenario('add-item-quantity-in-cart', 'add-item-quantity-in-cart', 'GET',
+             _get(lambda c, i: f'/add-item-quantity-in-cart/{c.slug(i)}'),
+             None),
+    Scenario('reduce-item-quantity-in-cart', 'reduce-item-quantity-in-cart',
+             'GET',
+             _get(lambda c, i: f'/reduce-item-quantity-in-cart/{c.slug(i)}'),
+             None),
+    Scenario('update-cart', 'update-cart', 'POST',
+             _post(lambda c, i: '/update-cart/', json=lambda c, i: {
+                 'changes': [{'slug': c.slug(i + n), 'quantity': 2}
+                             for n in range(3)]}),
+             None),
+    Scenario('order-summary', 'order-summary', 'GET',
+             _get(lambda c, i: '/order-summary/'), None),
+    Scenario('add-coupon', 'add-coupon', 'POST',
+             _post(lambda c, i: '/add-coupon/checkout',
+                   data=lambda c, i: {'code': c.data['coupon']}),
+             None),
+    Scenario('checkout', 'checkout', 'GET',
+             _get(lambda c, i: '/checkout/'), None),
+    Scenario('checkout:post', 'checkout', 'POST',
+             _post(lambda c, i: '/checkout/',
+                   data=lambda c, i: CHECKOUT_FORM),
+             None),
+    Scenario('payment', 'payment', 'GET',
+             _get(lambda c, i: '/payment/stripe'),
+             lambda c, i: c.check_out(i)),
+    Scenario('payment:post', 'payment', 'POST',
+             _post(lambda c, i: '/payment/stripe',
+                   data=lambda c, i: {'stripeToken': 'tok_visa'}),
+             lambda c, i: c.check_out(i)),
+    Scenario('payment-status', 'payment-status', 'GET',
+             _get(lambda c, i: c.job_path), _ensure_job),
+    Scenario('remove-item-in-cart', 'remove-item-in-cart', 'GET',
+             _get(lambda c, i: f'/remove-item-in-cart/{c.slug(i)}'),
+             lambda c, i: c.fill_cart(i)),
+    Scenario('remove-from-cart', 'remove-from-cart', 'GET',
+             _get(lambda c, i: f'/remove-from-cart/{c.slug(i)}'),
+             lambda c, i: c.fill_cart(i)),
+    Scenario('request-refund', 'request-refund', 'GET',
+             _get(lambda c, i: '/request-refund/'), None),
+    Scenario('request-refund:post', 'request-refund', 'POST',
+             _post(lambda c, i: '/request-refund/', data=lambda c, i: {
+                 'ref_code': c.data['ref_codes'][i % len(c.data['ref_codes'])],
+                 'email': 'bench@example.com',
+                 'message': 'Benchmark refund request'}),
+             None),
+]
+
+
+def core_url_names():
+    resolver = get_resolver()
+    core = resolver.namespace_dict['core'][1]
+    return {name for name in core.reverse_dict if isinstance(name, str)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Per-route changes against an earlier run. A route regresses when its
+    p95 grows by more than `threshold` or it runs more queries.
+    """
+    rows = {}
+    for name, route in results['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+        p95, old_p95 = route['latency_ms']['p95'], before['latency_ms']['p95']
+        queries, old_queries = (route['queries']['mean'],
+                                before['queries']['mean'])
+        rows[name] = {
+            'p50_change': _change(route['latency_ms']['p50'],
+                                  before['latency_ms']['p50']),
+            'p95_change': _change(p95, old_p95),
+            'queries_before': old_queries,
+            'queries_after': queries,
+            'regressed': (p95 > old_p95 * (1 + threshold) or
+                          queries > old_queries),
+        }
+    return rows
+
+
+def _change(new, old):
+    if not old:
+        return None
+    return round(new / old - 1, 3)
+
+
+class Command(BaseCommand):
+    help = ('Seed a throwaway test database, serve the site from a local '
+            'threaded WSGI server and load-test every route in core/urls.py '
+            'with Stripe stubbed out. Prints throughput, latency percentiles '
+            'and queries per request as JSON; --compare diffs against an '
+            'earlier run. SQLite serializes writers, so expect "database is '
+            'locked" errors on cart routes above --concurrency 1 there.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100,
+                            help='Timed requests per route.')
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--warmup', type=int, default=2,
+                            help='Untimed requests per client and route.')
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--items', type=int, default=500)
+        parser.add_argument('--orders', type=int, default=5000)
+        parser.add_argument('--coupons', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--routes', nargs='*',
+                            help='Only run these scenarios.')
+        parser.add_argument('--stripe', choices=('stub', 'fake'),
+                            default='stub',
+                            help='Local Stripe API stub or in-process fake.')
+        parser.add_argument('--stripe-latency', type=float, default=0.05)
+        parser.add_argument('--output', help='Write the JSON here.')
+        parser.add_argument('--compare', help='JSON of an earlier run.')
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Allowed p95 growth for --compare.')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        scenarios = SCENARIOS
+        if options['routes']:
+            scenarios = [s for s in SCENARIOS if s.name in options['routes']]
+            if not scenarios:
+                raise CommandError('No scenario matches --routes.')
+
+        test_name = None
+        if connection.vendor == 'sqlite':
+            # The in-memory test database can't be shared with the server
+            # threads, so use a file
+            fd, test_name = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(fd)
+            connection.settings_dict['TEST']['NAME'] = test_name
+            connection.settings_dict.setdefault('OPTIONS', {})['timeout'] = 30
+        old_config = setup_databases(verbosity=0, interactive=False,
+                                     keepdb=False)
+        stub = None
+        try:
+            overrides = {
+                'DEBUG': False,
+                'ALLOWED_HOSTS': ['*'],
+                'ORDER_TOTALS_CHECK': False,
+                'QUERY_BUDGET_RAISE': False,
+                'CHARGE_JOBS_EAGER': True,
+                # The manifest storage needs collectstatic to have run
+                'STATICFILES_STORAGE':
+                    'django.contrib.staticfiles.storage.StaticFilesStorage',
+            }
+            if options['stripe'] == 'stub':
+                stub = start_stub_server(latency=options['stripe_latency'])
+                overrides.update(STRIPE_BACKEND='stripe',
+                                 STRIPE_API_BASE=stub.url,
+                                 STRIPE_SECRET_KEY='sk_test_stub')
+            else:
+                overrides.update(STRIPE_BACKEND='fake',
+                                 FAKE_STRIPE_LATENCY=options['stripe_latency'])
+            # Views print to stdout, which has to stay clean for the JSON
+            with override_settings(**overrides), redirect_stdout(sys.stderr):
+                payments.configure_http_client(force=True)
+                results = self.run(scenarios, options)
+        finally:
+            payments.configure_http_client(force=True)
+            if stub is not None:
+                stub.shutdown()
+                stub.server_close()
+            teardown_databases(old_config, verbosity=0)
+            if test_name and os.path.exists(test_name):
+                os.remove(test_name)
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            results['comparison'] = {
+                'baseline': baseline.get('meta', {}).get('revision'),
+                'routes': compare(results, baseline, options['threshold']),
+            }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options['fail_on_regression'] and options['compare']:
+            regressed = [name for name, row in
+                         results['comparison']['routes'].items()
+                         if row['regressed']]
+            if regressed:
+                raise CommandError(f"Regressed: {', '.join(regressed)}")
+
+    def seed(self, options):
+        started = time.monotonic()
+        seed_shop(users=options['users'], items=options['items'],
+                  orders=options['orders'], coupons=options['coupons'],
+                  seed=options['seed'])
+        User = get_user_model()
+        usernames = []
+        for n in range(options['concurrency']):
+            username = f'bench{n}'
+            User.objects.create_user(username, f'{username}@example.com',
+                                     BENCH_PASSWORD)
+            usernames.append(username)
+        data = {
+            'slugs': list(Item.objects.order_by('pk').values_list(
+                'slug', flat=True)[:200]),
+            'coupon': Coupon.objects.order_by('pk').values_list(
+                'code', flat=True).first(),
+            'ref_codes': list(Order.objects.filter(ordered=True).order_by(
+                'pk').values_list('ref_code', flat=True)[:200]),
+        }
+        return usernames, data, time.monotonic() - started
+
+    def run(self, scenarios, options):
+        usernames, data, seeded = self.seed(options)
+        server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler,
+                                    allow_reuse_address=False)
+        server.set_app(QueryCountingApp(WSGIHandler()))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        base_url = 'http://%s:%s' % server.server_address[:2]
+        try:
+            clients = [BenchClient(base_url, username, data)
+                       for username in usernames]
+            for client in clients:
+                client.login()
+            routes = {}
+            for scenario in scenarios:
+                routes[scenario.name] = self.run_scenario(
+                    scenario, clients, options)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        covered = {scenario.url_name for scenario in SCENARIOS}
+        return {
+            'meta': {
+                'revision': git_revision(),
+                'vendor': connection.vendor,
+                'requests_per_route': options['requests'],
+                'concurrency': options['concurrency'],
+                'stripe': options['stripe'],
+                'stripe_latency_s': options['stripe_latency'],
+                'dataset': {key: options[key] for key in
+                            ('users', 'items', 'orders', 'coupons', 'seed')},
+                'seed_s': round(seeded, 2),
+            },
+            'routes': routes,
+            'uncovered_urls': sorted(core_url_names() - covered),
+        }
+
+    def run_scenario(self, scenario, clients, options):
+        total = options['requests']
+
+        def work(worker):
+            client = clients[worker]
+            samples = []
+            for i in range(-options['warmup'], total):
+                if i >= 0 and i % len(clients) != worker:
+                    continue
+                if scenario.setup:
+                    scenario.setup(client, i)
+                method, path, kwargs = scenario.build(client, i)
+                started = time.perf_counter()
+                try:
+                    response = client.request(method, path, **kwargs)
+                    outcome = response.status_code
+                    queries = int(response.headers.get(QUERY_HEADER, 0))
+                except requests.RequestException as e:
+                    outcome, queries = type(e).__name__, None
+                elapsed = time.perf_counter() - started
+                if scenario.name == 'payment:post' and outcome == 302:
+                    client.job_path = response.headers.get('Location')
+                if i >= 0:
+                    samples.append((elapsed * 1000, outcome, queries))
+            return samples
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            samples = [sample for worker_samples in
+                       pool.map(work, range(len(clients)))
+                       for sample in worker_samples]
+        elapsed = time.perf_counter() - started
+
+        latencies = [latency for latency, _, _ in samples]
+        queries = [count for _, _, count in samples if count is not None]
+        outcomes = Counter(str(outcome) for _, outcome, _ in samples)
+        return {
+            'url_name': scenario.url_name,
+            'method': scenario.method,
+            'requests': len(samples),
+            'errors': sum(count for outcome, count in outcomes.items()
+                          if not outcome.isdigit() or int(outcome) >= 500),
+            'statuses': dict(outcomes),
+            'throughput_rps': round(len(samples) / elapsed, 1),
+            'latency_ms': {
+                'mean': round(statistics.mean(latencies), 2),
+                'p50': round(percentile(latencies, 0.50), 2),
+                'p95': round(percentile(latencies, 0.95), 2),
+                'p99': round(percentile(latencies, 0.99), 2),
+            },
+            'queries': {
+                'mean': round(statistics.mean(queries), 1) if queries else None,
+                'max': max(queries) if queries else None,
+            },
+        }
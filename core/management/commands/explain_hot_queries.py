@@ -0,0 +1,137 @@
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from core.models import Address, Coupon, Order, OrderItem
+from core.seeding import seed_shop
+
+# Added by migration 0004, as (table, index name or indexed column); the
+# db_index fields get generated names, so those are matched by column
+HOT_PATH_INDEXES = [
+    ('core_order', 'core_order_user_ordered_idx'),
+    ('core_order', 'core_order_one_open_per_user'),
+    ('core_order', 'ref_code'),
+    ('core_orderitem', 'core_orderitem_item_user_idx'),
+    ('core_address', 'core_address_user_type_idx'),
+    ('core_coupon', 'code'),
+]
+
+
+class Command(BaseCommand):
+    help = ('Seed a large shop inside a transaction, print the query plans '
+            'and timings of the cart, checkout and refund lookups with and '
+            'without the hot path indexes, then roll everything back. '
+            'Dropping the indexes locks the tables, so keep this away from '
+            'production databases.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--items', type=int, default=500)
+        parser.add_argument('--orders', type=int, default=50000)
+        parser.add_argument('--coupons', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--json', action='store_true',
+                            help='Print the results as JSON.')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            started = time.monotonic()
+            seed_shop(users=options['users'], items=options['items'],
+                      orders=options['orders'], coupons=options['coupons'],
+                      seed=options['seed'])
+            seeded = time.monotonic() - started
+            queries = self.hot_queries()
+
+            self.analyze()
+            after = self.measure(queries, options['repeat'])
+            dropped = self.drop_indexes()
+            self.analyze()
+            before = self.measure(queries, options['repeat'])
+            transaction.set_rollback(True)
+
+        results = {
+            'vendor': connection.vendor,
+            'seed_s': round(seeded, 2),
+            'dropped_indexes': dropped,
+            'queries': {
+                name: {'before': before[name], 'after': after[name]}
+                for name in queries
+            },
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.report(results)
+
+    def hot_queries(self):
+        order = Order.objects.filter(ordered=False).order_by('-pk').first()
+        line = OrderItem.objects.filter(user_id=order.user_id).first()
+        ref_code = Order.objects.filter(ordered=True).order_by(
+            '-pk').values_list('ref_code', flat=True).first()
+        code = Coupon.objects.order_by('-pk').values_list(
+            'code', flat=True).first()
+        return {
+            'open order': Order.objects.filter(
+                user_id=order.user_id, ordered=False),
+            'cart line': OrderItem.objects.filter(
+                item_id=line.item_id, user_id=order.user_id, ordered=False),
+            'default address': Address.objects.filter(
+                user_id=order.user_id, address_type='S', default=True),
+            'refund lookup': Order.objects.filter(ref_code=ref_code),
+            'coupon lookup': Coupon.objects.filter(code=code),
+        }
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def drop_indexes(self):
+        names = []
+        with connection.cursor() as cursor:
+            for table, target in HOT_PATH_INDEXES:
+                constraints = connection.introspection.get_constraints(
+                    cursor, table)
+                names += [
+                    name for name, constraint in constraints.items()
+                    if constraint['index'] and not constraint['primary_key']
+                    and target in (name, ''.join(constraint['columns']))
+                ]
+            for name in names:
+                cursor.execute(
+                    f'DROP INDEX {connection.ops.quote_name(name)}')
+        return names
+
+    def measure(self, queries, repeat):
+        results = {}
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - started) * 1000)
+            results[name] = {
+                'plan': queryset.explain().splitlines(),
+                'median_ms': round(statistics.median(timings), 3),
+                'max_ms': round(max(timings), 3),
+            }
+        return results
+
+    def report(self, results):
+        self.stdout.write(
+            f"{results['vendor']}: seeded in {results['seed_s']}s, "
+            f"dropped {len(results['dropped_indexes'])} indexes for the "
+            f"baseline")
+        for name, result in results['queries'].items():
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for label in ('before', 'after'):
+                measured = result[label]
+                self.stdout.write(
+                    f"  {label}: median {measured['median_ms']} ms, "
+                    f"max {measured['max_ms']} ms")
+                for line in measured['plan']:
+                    self.stdout.write(f'    {line}')
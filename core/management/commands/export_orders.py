@@ -0,0 +1,62 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from core.exports import CHUNK_SIZE, EXPORT_FORMATS, export_lines
+from core.models import Order
+
+
+def _moment(value):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f'Not a date or datetime: {value}')
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = ('Write orders with their lines, addresses, payment, coupon and '
+            'refunds as CSV or JSON lines. Orders are read in chunks through '
+            'a server-side cursor, so memory stays flat however many there '
+            'are.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+                            default='csv')
+        parser.add_argument('--output', default='-',
+                            help='File to write, standard output by default.')
+        parser.add_argument('--since',
+                            help='Orders placed at or after this date.')
+        parser.add_argument('--until',
+                            help='Orders placed before this date.')
+        parser.add_argument('--include-open', action='store_true',
+                            help='Include carts that were never ordered.')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if not options['include_open']:
+            orders = orders.filter(ordered=True)
+        if options['since']:
+            orders = orders.filter(ordered_date__gte=_moment(options['since']))
+        if options['until']:
+            orders = orders.filter(ordered_date__lt=_moment(options['until']))
+
+        lines = export_lines(orders, options['format'], options['chunk_size'])
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+        written = -1 if options['format'] == 'csv' else 0
+        with open(options['output'], 'w', newline='') as f:
+            for line in lines:
+                f.write(line)
+                written += 1
+        self.stderr.write(self.style.SUCCESS(
+            f'Exported {max(written, 0)} orders to {options["output"]}'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from core.images import generate_variants, needs_variants
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = ('Build the resized image variants of every item that is '
+            'missing them, or of all items with --all.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Rebuild items that already have variants.')
+
+    def handle(self, *args, **options):
+        built = failed = 0
+        for item in Item.objects.exclude(image='').only(
+                'pk', 'image', 'image_variants').iterator():
+            if not options['all'] and not needs_variants(item):
+                continue
+            try:
+                if generate_variants(item.pk):
+                    built += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f'Item {item.pk} ({item.image.name}): {e}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Built variants for {built} items, {failed} failed'))
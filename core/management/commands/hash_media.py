@@ -0,0 +1,32 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from core.images import generate_variants
+from core.models import Item
+from core.storage import content_hash
+
+
+class Command(BaseCommand):
+    help = ('Copy item images uploaded before HashedMediaStorage to '
+            'content-hashed names, so they get immutable caching, and '
+            'rebuild their variants.')
+
+    def handle(self, *args, **options):
+        renamed = missing = 0
+        for pk, name in Item.objects.exclude(image='').values_list(
+                'pk', 'image').iterator():
+            if content_hash(name):
+                continue
+            if not default_storage.exists(name):
+                missing += 1
+                self.stderr.write(f'Item {pk}: {name} does not exist')
+                continue
+            with default_storage.open(name, 'rb') as f:
+                hashed = default_storage.save(name, f)
+            # update() leaves the Item signals alone; the variants are
+            # rebuilt right here instead
+            if Item.objects.filter(pk=pk, image=name).update(image=hashed):
+                generate_variants(pk)
+                renamed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Renamed {renamed} images, {missing} missing'))
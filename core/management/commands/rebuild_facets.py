@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.cache import bump_catalog_version
+from core.facets import rebuild_facet_counts
+
+
+class Command(BaseCommand):
+    help = ('Recount the catalog facets from scratch, e.g. after items '
+            'were changed with bulk_create or QuerySet.update().')
+
+    def handle(self, *args, **options):
+        rebuild_facet_counts()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS('Facet counts rebuilt'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from core.rollups import CHUNK_SIZE, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = ('Recount the sales rollups (daily sales, item sales, coupon '
+            'usage) from the orders, e.g. after a backfill or after orders '
+            'were changed with QuerySet.update(). Orders are scanned in '
+            'primary key chunks so checkout is not held up, and payments '
+            'recorded meanwhile are kept.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to wait between chunks.')
+
+    def handle(self, *args, **options):
+        def progress(done, last):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{done}/{last}')
+
+        last = rebuild_rollups(chunk_size=options['chunk_size'],
+                               pause=options['pause'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rollups rebuilt from orders up to {last}'))
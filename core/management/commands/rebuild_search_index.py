@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from core.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the product search index, e.g. after items were '
+            'loaded with bulk_create or raw SQL.')
+
+    def handle(self, *args, **options):
+        rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt'))
@@ -0,0 +1,51 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core import images, inventory, jobs
+
+
+class Command(BaseCommand):
+    help = ('Process queued background jobs (Stripe charges, admin bulk '
+            'order actions and image variants) and give back expired stock '
+            'reservations')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help='Exit once the queue is empty instead of polling.',
+        )
+        parser.add_argument(
+            '--poll', type=float, default=1.0,
+            help='Seconds to wait between polls of an empty queue.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            jobs.requeue_stale_charge_jobs()
+            released = inventory.release_expired()
+            if released:
+                self.stdout.write(
+                    f'Released {released} expired stock reservation(s)')
+            done = jobs.run_pending_charges(limit=100)
+            if done:
+                self.stdout.write(f'Processed {done} charge job(s)')
+                continue
+            # A slice of one bulk job, then back to the charges
+            job = jobs.run_bulk_order_job(
+                max_batches=settings.BULK_JOB_MAX_BATCHES)
+            if job is not None:
+                self.stdout.write(
+                    f'Bulk order job {job.pk}: {job.status}, '
+                    f'{job.processed}/{job.total} orders')
+                continue
+            built = images.run_pending_variants(limit=10)
+            if built:
+                self.stdout.write(f'Processed {built} image variant job(s)')
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll'])
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Item, Order
+from core.seeding import seed_shop
+
+
+class Command(BaseCommand):
+    help = ('Fill the database with a synthetic shop: users, addresses, '
+            'items, coupons and orders with their lines, payments and '
+            'refunds. The same arguments on an empty database always give '
+            'the same rows. Rows are written with chunked bulk inserts and '
+            'memory stays flat, so millions of orders are fine.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--items', type=int, default=20000)
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--coupons', type=int, default=500)
+        parser.add_argument('--addresses-per-user', type=int, default=2)
+        parser.add_argument('--days', type=int, default=365,
+                            help='Spread the orders over this many days.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--force', action='store_true',
+                            help='Seed even if the shop already has data.')
+
+    def handle(self, *args, **options):
+        if not options['force'] and (Item.objects.exists() or
+                                     Order.objects.exists()):
+            raise CommandError(
+                'The database already has items or orders; the rows would '
+                'not match the seed. Use --force to add them anyway.')
+
+        def progress(step, seconds):
+            self.stdout.write(f'{step}: {seconds:.1f}s')
+
+        started = time.monotonic()
+        # Orders are committed chunk by chunk; an interrupted run leaves
+        # the rows made so far, and needs --force to seed again
+        seed_shop(users=options['users'], items=options['items'],
+                  orders=options['orders'], coupons=options['coupons'],
+                  seed=options['seed'],
+                  addresses_per_user=options['addresses_per_user'],
+                  days=options['days'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded in {time.monotonic() - started:.1f}s'))
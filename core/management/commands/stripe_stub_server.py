@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from core.stripe_stub import StripeStubServer
+
+
+class Command(BaseCommand):
+    help = ('Serve a local Stripe API stub. Point STRIPE_API_BASE at it to '
+            'exercise the payment client without network access.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument(
+            '--latency', type=float, default=0.05,
+            help='Seconds to wait before answering each request.',
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0,
+            help='Share of requests answered with a 429 or 500.',
+        )
+        parser.add_argument('--seed', type=int, default=None)
+
+    def handle(self, *args, **options):
+        server = StripeStubServer(
+            (options['host'], options['port']),
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+        )
+        self.stdout.write(f'Stripe stub listening on {server.url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,142 @@
+import mimetypes
+import os
+import re
+import stat
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (
+    FileResponse, Http404, HttpResponse, HttpResponseNotModified,
+    StreamingHttpResponse)
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_etags
+from django.views.decorators.http import require_safe
+
+from .storage import content_hash
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def media_etag(name, st):
+    # Hashed names already identify the bytes; older uploads fall back to
+    # size and mtime, which change whenever the file is replaced
+    digest = content_hash(name)
+    if digest:
+        return f'"{digest}"'
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def media_cache_control(name):
+    if content_hash(name):
+        return (f'public, max-age={settings.MEDIA_IMMUTABLE_MAX_AGE}, '
+                f'immutable')
+    return f'public, max-age={settings.MEDIA_MAX_AGE}'
+
+
+def etag_matches(header, etag):
+    # If-None-Match uses the weak comparison
+    tags = parse_etags(header)
+    return '*' in tags or etag in (
+        tag[2:] if tag.startswith('W/') else tag for tag in tags)
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single byte range, inclusive, or None to send the
+    whole file. Multiple ranges are answered with the whole file too.
+    Raises RangeNotSatisfiable for ranges past the end of the file.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        suffix = int(last)
+        if not suffix or not size:
+            raise RangeNotSatisfiable
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, min(end, size - 1)
+
+
+def _read_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve an uploaded file from MEDIA_ROOT with validators, long-lived
+    caching for content-hashed names and single byte ranges. Whole files
+    go out through FileResponse, so the WSGI server can use sendfile.
+    """
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+        st = os.stat(fullpath)
+    except (SuspiciousFileOperation, ValueError, OSError):
+        raise Http404('File not found.')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('File not found.')
+
+    etag = media_etag(path, st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+        'Cache-Control': media_cache_control(path),
+        'Accept-Ranges': 'bytes',
+    }
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and etag_matches(if_none_match, etag):
+        response = HttpResponseNotModified()
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    # A stale If-Range validator means the client wants the whole file
+    if range_header and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        try:
+            byte_range = parse_range(range_header, st.st_size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{st.st_size}'
+            return response
+
+    content_type = (mimetypes.guess_type(fullpath)[0] or
+                    'application/octet-stream')
+    f = open(fullpath, 'rb')
+    if byte_range is None:
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = st.st_size
+    else:
+        start, end = byte_range
+        f.seek(start)
+        response = StreamingHttpResponse(
+            _read_range(f, end - start + 1), status=206,
+            content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{st.st_size}'
+    for header, value in headers.items():
+        response[header] = value
+    return response
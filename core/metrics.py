@@ -0,0 +1,404 @@
+import atexit
+import bisect
+import fcntl
+import glob
+import hmac
+import json
+import math
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_safe
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Where the values of exited processes are folded, see Registry.compact
+EXITED_FILE = 'exited.json'
+
+
+def percentile(values, q):
+    # Nearest-rank percentile of raw samples, for the benchmark commands
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Registry:
+    """
+    The metrics of this process. With METRICS_DIR set, every process
+    (gunicorn workers, run_worker) writes its values to <pid>.json there
+    at most every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up
+    the files of all of them.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flusher_pid = None
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Duplicate metric {metric.name}')
+            self._metrics[metric.name] = metric
+
+    def collect(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.describe() for metric in metrics}
+
+    def changed(self):
+        self._dirty = True
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+
+    def _start_flusher(self):
+        # Once per process, so forked workers get their own thread
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        if not settings.METRICS_DIR:
+            return
+        thread = threading.Thread(target=self._flush_forever, daemon=True,
+                                  name='metrics-flush')
+        thread.start()
+        atexit.register(self.flush)
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            if self._dirty:
+                self.flush()
+
+    def path(self, pid=None):
+        return os.path.join(settings.METRICS_DIR, f'{pid or os.getpid()}.json')
+
+    def flush(self):
+        if not settings.METRICS_DIR:
+            return
+        self._dirty = False
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = self.path()
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.collect(), f)
+        os.replace(tmp, path)
+
+    def _read(self, paths):
+        merged = {}
+        for path in paths:
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, metric in snapshot.items():
+                merge_metric(merged, name, metric)
+        return merged
+
+    def compact(self):
+        """
+        Fold the files of processes that have exited into EXITED_FILE, so
+        counters never go backwards but METRICS_DIR doesn't grow with
+        every worker restart. The processes must share this host.
+        """
+        directory = settings.METRICS_DIR
+        with open(os.path.join(directory, 'compact.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            exited = [path for path in glob.glob(
+                os.path.join(directory, '*.json'))
+                if _exited(os.path.basename(path)[:-len('.json')])]
+            if not exited:
+                return 0
+            archive = os.path.join(directory, EXITED_FILE)
+            merged = self._read([archive] + exited)
+            tmp = f'{archive}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(merged, f)
+            os.replace(tmp, archive)
+            for path in exited:
+                os.remove(path)
+        return len(exited)
+
+    def gather(self):
+        """
+        Values of every process writing to METRICS_DIR, or of this one
+        alone without it.
+        """
+        if not settings.METRICS_DIR:
+            return self.collect()
+        self.flush()
+        self.compact()
+        return self._read(sorted(glob.glob(
+            os.path.join(settings.METRICS_DIR, '*.json'))))
+
+
+def _exited(name):
+    # Files are named after the pid of the process writing them
+    if not name.isdigit():
+        return False
+    try:
+        os.kill(int(name), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def merge_metric(merged, name, metric):
+    target = merged.setdefault(name, dict(metric, series=[]))
+    if target['type'] != metric['type']:
+        return
+    series = {tuple(map(tuple, labels)): value
+              for labels, value in target['series']}
+    for labels, value in metric['series']:
+        key = tuple(map(tuple, labels))
+        current = series.get(key)
+        if current is None:
+            series[key] = value
+        elif metric['type'] == 'counter':
+            series[key] = current + value
+        elif len(current['counts']) == len(value['counts']):
+            series[key] = {
+                'counts': [a + b for a, b in zip(current['counts'],
+                                                  value['counts'])],
+                'sum': current['sum'] + value['sum'],
+            }
+    target['series'] = [[list(key), value] for key, value in series.items()]
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """
+    Thread-safe monotonically increasing count, kept per set of label
+    values.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation='', registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._series = {}
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+        if self.registry is not None:
+            self.registry.changed()
+
+    def value(self, **labels):
+        return sum(value for key, value in self.snapshot().items()
+                   if all(dict(key).get(k) == v for k, v in labels.items()))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._series)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def describe(self):
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'series': [[list(key), value]
+                       for key, value in self.snapshot().items()],
+        }
+
+
+class Histogram:
+    """
+    Thread-safe latency histogram with Prometheus-style cumulative
+    buckets, kept per set of label values.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation='', buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._series = {}
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    'counts': [0] * (len(self.buckets) + 1),
+                    'sum': 0.0,
+                }
+            series['counts'][index] += 1
+            series['sum'] += value
+        if self.registry is not None:
+            self.registry.changed()
+
+    def snapshot(self):
+        with self._lock:
+            return {key: {'counts': list(series['counts']),
+                          'sum': series['sum']}
+                    for key, series in self._series.items()}
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def describe(self):
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'buckets': list(self.buckets),
+            'series': [[list(key), value]
+                       for key, value in self.snapshot().items()],
+        }
+
+    def quantile(self, q, **labels):
+        # Estimated by linear interpolation inside the bucket holding the
+        # q-th observation, like Prometheus' histogram_quantile()
+        counts = [0] * (len(self.buckets) + 1)
+        for key, series in self.snapshot().items():
+            if all(dict(key).get(k) == v for k, v in labels.items()):
+                counts = [a + b for a, b in zip(counts, series['counts'])]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (
+                    (rank - seen) / count)
+            seen += count
+
+
+def _label_value(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(f'{name}="{_label_value(value)}"'
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics):
+    # Prometheus text exposition format 0.0.4
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["type"]}')
+        for labels, value in sorted(metric['series']):
+            labels = [tuple(pair) for pair in labels]
+            if metric['type'] == 'counter':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            bounds = metric['buckets'] + [math.inf]
+            for bound, count in zip(bounds, value['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket'
+                             f'{_labels(labels + [("le", _number(bound))])} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} '
+                         f'{_number(value["sum"])}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds',
+    'Time to respond to a request, by URL name, method and status class.',
+)
+REQUEST_DB_TIME = Histogram(
+    'http_request_db_duration_seconds',
+    'Time a request spent waiting on the database, by URL name.',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+REQUEST_QUERIES = Counter(
+    'http_request_db_queries_total',
+    'Database queries run by requests, by URL name.',
+)
+# Any other method is recorded as 'other', since clients can send
+# arbitrary ones
+KNOWN_METHODS = frozenset(
+    ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+
+class MetricsMiddleware:
+    """
+    Records the latency and database time of every request by URL name.
+    Goes first in MIDDLEWARE; the database figures come from
+    QueryBudgetMiddleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        match = getattr(request, 'resolver_match', None)
+        # Unresolved paths share one label to keep the series bounded
+        view = match.view_name if match else 'unmatched'
+        method = (request.method if request.method in KNOWN_METHODS
+                  else 'other')
+        REQUEST_LATENCY.observe(
+            duration, view=view, method=method,
+            status=f'{response.status_code // 100}xx')
+        stats = getattr(request, 'query_stats', None)
+        if stats is not None:
+            REQUEST_DB_TIME.observe(stats.duration, view=view)
+            REQUEST_QUERIES.inc(stats.count, view=view)
+        return response
+
+
+@require_safe
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    if not token and not settings.DEBUG:
+        # Traffic, error rates and charge outcomes aren't for everyone
+        return HttpResponseForbidden()
+    if token:
+        expected = f'Bearer {token}'
+        given = request.META.get('HTTP_AUTHORIZATION', '')
+        if not hmac.compare_digest(given.encode(), expected.encode()):
+            return HttpResponseForbidden()
+    response = HttpResponse(render(REGISTRY.gather()),
+                            content_type=CONTENT_TYPE)
+    response['Cache-Control'] = 'no-store'
+    return response
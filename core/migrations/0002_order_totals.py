@@ -0,0 +1,71 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:05
+
+from django.db import migrations, models
+from django.db.models import (
+    Case, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    # One UPDATE from correlated subqueries, like
+    # OrderQuerySet.update_totals; historical models don't have the
+    # custom queryset, so the expressions are spelled out here
+    Order = apps.get_model('core', 'Order')
+    Coupon = apps.get_model('core', 'Coupon')
+    quantity = F('orderitem__quantity')
+    price = F('orderitem__item__price')
+    discount_price = F('orderitem__item__discount_price')
+    line_totals = {
+        'subtotal': Sum(quantity * price),
+        'discount_total': Sum(Case(
+            When(Q(orderitem__item__discount_price__isnull=False) &
+                 ~Q(orderitem__item__discount_price=0),
+                 then=quantity * (price - discount_price)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )),
+        'total_quantity': Sum(quantity),
+    }
+    lines = Order.items.through.objects.filter(
+        order_id=OuterRef('pk')).values('order_id')
+    totals = {
+        name: Coalesce(Subquery(
+            lines.annotate(value=expression).values('value'),
+            output_field=IntegerField()), 0)
+        for name, expression in line_totals.items()
+    }
+    totals['coupon_total'] = Coalesce(Subquery(
+        Coupon.objects.filter(pk=OuterRef('coupon_id')).values(
+            'amount')[:1]), 0)
+    Order.objects.update(**totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='coupon_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='discount_total',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:13
+
+from django.db import migrations, models
+
+
+def merge_duplicate_open_orders(apps, schema_editor):
+    # The views used to pick an arbitrary open order, so a user may have
+    # several. Fold the extra carts into the oldest one before the unique
+    # index below goes in.
+    Order = apps.get_model('core', 'Order')
+    Through = Order.items.through
+    user_ids = (Order.objects.filter(ordered=False)
+                .values('user_id')
+                .annotate(open_orders=models.Count('id'))
+                .filter(open_orders__gt=1)
+                .values_list('user_id', flat=True))
+    for user_id in list(user_ids):
+        orders = list(Order.objects.filter(user_id=user_id, ordered=False)
+                      .select_related('coupon').order_by('id'))
+        keep, extra = orders[0], orders[1:]
+        extra_ids = [order.pk for order in extra]
+        Through.objects.filter(order_id__in=extra_ids).update(order_id=keep.pk)
+        Order.objects.filter(pk__in=extra_ids).delete()
+
+        totals = {
+            'subtotal': 0,
+            'discount_total': 0,
+            'coupon_total': keep.coupon.amount if keep.coupon else 0,
+            'total_quantity': 0,
+        }
+        for order_item in keep.items.select_related('item'):
+            price = order_item.quantity * order_item.item.price
+            final_price = price
+            if order_item.item.discount_price:
+                final_price = (order_item.quantity *
+                               order_item.item.discount_price)
+            totals['subtotal'] += price
+            totals['discount_total'] += price - final_price
+            totals['total_quantity'] += order_item.quantity
+        Order.objects.filter(pk=keep.pk).update(**totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_chargejob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(db_index=True, max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, db_index=True, max_length=20, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'address_type', 'default'], name='core_address_user_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered'], name='core_order_user_ordered_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(fields=['item', 'user', 'ordered'], name='core_orderitem_item_user_idx'),
+        ),
+        # Kept last: AlterField rebuilds the table on SQLite and only
+        # restores the indexes Django knows about
+        migrations.RunPython(merge_duplicate_open_orders,
+                             migrations.RunPython.noop),
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX core_order_one_open_per_user '
+            'ON core_order (user_id) WHERE NOT ordered',
+            'DROP INDEX core_order_one_open_per_user',
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+from core import search
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = search.SQLITE_SCHEMA + search.SQLITE_REBUILD
+    elif vendor == 'postgresql':
+        statements = search.POSTGRES_SCHEMA
+    else:
+        statements = []
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    statements = {
+        'sqlite': search.SQLITE_DROP,
+        'postgresql': search.POSTGRES_DROP,
+    }.get(schema_editor.connection.vendor, [])
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
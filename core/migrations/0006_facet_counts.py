@@ -0,0 +1,45 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:20
+
+from collections import Counter
+
+from django.db import migrations, models
+
+from core.facets import FACET_FIELDS, facet_values
+
+
+def backfill_facet_counts(apps, schema_editor):
+    # Counts per facet value, the shape of FacetCount until 0016
+    Item = apps.get_model('core', 'Item')
+    FacetCount = apps.get_model('core', 'FacetCount')
+    counts = Counter()
+    for row in Item.objects.values_list(*FACET_FIELDS).iterator():
+        counts.update(facet_values(*row).items())
+    FacetCount.objects.bulk_create([
+        FacetCount(facet=facet, value=value, count=count)
+        for (facet, value), count in counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_item_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=20)),
+                ('value', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='facetcount',
+            unique_together={('facet', 'value')},
+        ),
+        migrations.RunPython(backfill_facet_counts,
+                             migrations.RunPython.noop),
+    ]
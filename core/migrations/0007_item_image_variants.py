@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_facet_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_variants',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
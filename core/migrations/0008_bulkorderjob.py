@@ -0,0 +1,34 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0007_item_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkOrderJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('accept_refund', 'Update orders to refund granted'), ('reject_refund', 'Update orders to refund rejected'), ('revert_refund_to_pending', 'Update orders to refund decision pending'), ('update_to_being_delivered', 'Update to being delivered'), ('update_to_received', 'Update to received')], max_length=30)),
+                ('query', models.BinaryField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('batch_size', models.IntegerField(default=1000)),
+                ('last_pk', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('total', models.IntegerField(blank=True, null=True)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
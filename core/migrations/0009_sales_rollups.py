@@ -0,0 +1,57 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_bulkorderjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('orders', models.IntegerField(default=0)),
+                ('amount', models.IntegerField(default=0)),
+                ('coupon', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='core.Coupon')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('orders', models.IntegerField(default=0)),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.IntegerField(default=0)),
+                ('discount_total', models.IntegerField(default=0)),
+                ('coupon_total', models.IntegerField(default=0)),
+                ('refunds', models.IntegerField(default=0)),
+                ('refunded_amount', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'daily sales',
+            },
+        ),
+        migrations.CreateModel(
+            name='ItemSales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('units', models.IntegerField(default=0)),
+                ('revenue', models.IntegerField(default=0)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Item')),
+            ],
+            options={
+                'verbose_name_plural': 'item sales',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='itemsales',
+            unique_together={('day', 'item')},
+        ),
+    ]
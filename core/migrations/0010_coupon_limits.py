@@ -0,0 +1,77 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0009_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_per_user',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_redemptions',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='redemptions',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.AddField(
+            model_name='couponredemption',
+            name='coupon',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Coupon'),
+        ),
+        migrations.AddField(
+            model_name='couponredemption',
+            name='order',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='core.Order'),
+        ),
+        migrations.AddField(
+            model_name='couponredemption',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='couponredemption',
+            index=models.Index(fields=['coupon', 'user'], name='core_redemption_coupon_user'),
+        ),
+    ]
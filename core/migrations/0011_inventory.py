@@ -0,0 +1,65 @@
+# Generated by Django 2.1.5 on 2026-10-18 14:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_coupon_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField()),
+                ('quantity', models.IntegerField()),
+                ('status', models.CharField(choices=[('reserved', 'Reserved'), ('committed', 'Committed')], default='reserved', max_length=10)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField()),
+                ('available', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='stock_shards',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stockshard',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Item'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='item',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Item'),
+        ),
+        migrations.AddField(
+            model_name='stockreservation',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Order'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stockshard',
+            unique_together={('item', 'shard')},
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['order', 'item'], name='core_reservation_order_item'),
+        ),
+        migrations.AddIndex(
+            model_name='stockreservation',
+            index=models.Index(fields=['status', 'expires_at'], name='core_reservation_expiry'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_inventory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chargejob',
+            name='quote',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
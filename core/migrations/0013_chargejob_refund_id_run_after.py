@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_chargejob_quote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chargejob',
+            name='refund_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='chargejob',
+            name='run_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
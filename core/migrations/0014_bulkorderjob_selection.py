@@ -0,0 +1,32 @@
+# Generated by Django 2.1.5 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+def fail_pickled_jobs(apps, schema_editor):
+    # Their pickled queries are gone with the column
+    BulkOrderJob = apps.get_model('core', 'BulkOrderJob')
+    BulkOrderJob.objects.filter(status__in=('pending', 'running')).update(
+        status='failed', locked_at=None,
+        error='Queued before an upgrade; run the action again.')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_chargejob_refund_id_run_after'),
+    ]
+
+    operations = [
+        migrations.RunPython(fail_pickled_jobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='bulkorderjob',
+            name='query',
+        ),
+        migrations.AddField(
+            model_name='bulkorderjob',
+            name='selection',
+            field=models.TextField(default='{}'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0014_bulkorderjob_selection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='paid_price',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
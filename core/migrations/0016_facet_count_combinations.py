@@ -0,0 +1,45 @@
+# Generated by Django 2.1.5 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+from core.facets import FACET_FIELDS, FACET_NAMES, count_facets
+
+
+def backfill_facet_counts(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    FacetCount = apps.get_model('core', 'FacetCount')
+    counts = count_facets(Item.objects.values_list(*FACET_FIELDS).iterator())
+    FacetCount.objects.bulk_create([
+        FacetCount(count=count, **dict(zip(FACET_NAMES, values)))
+        for values, count in counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_orderitem_paid_price'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='FacetCount',
+        ),
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=2)),
+                ('label', models.CharField(max_length=1)),
+                ('price', models.CharField(max_length=20)),
+                ('discount', models.CharField(max_length=1)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='facetcount',
+            unique_together={('category', 'label', 'price', 'discount')},
+        ),
+        migrations.RunPython(backfill_facet_counts,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.1.5 on 2026-10-18 15:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_facet_count_combinations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariantJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=100)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='core.Item')),
+            ],
+        ),
+    ]
@@ -1,8 +1,16 @@
+import json
+
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (
+    Case, F, IntegerField, OuterRef, Prefetch, Q, Subquery, Sum, Value, When)
+from django.db.models.functions import Coalesce, Greatest
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
 
+from .budgets import uncounted
+from .cache import invalidate_cart_summary
+
 CATEGORY_CHOICES = (
     ('S', 'Shirt'),
     ('SW', 'Sport Wear'),
@@ -20,6 +28,39 @@ ADDRESS_CHOICES = (
     ('S', 'Shipping'),
 )
 
+CHARGE_STATUS_CHOICES = (
+    ('pending', 'Pending'),
+    ('processing', 'Processing'),
+    ('succeeded', 'Succeeded'),
+    ('failed', 'Failed'),
+)
+# The charge may still go through: the order's cart can't change and the
+# stock it holds doesn't expire
+CHARGING_STATUSES = ('pending', 'processing')
+
+BULK_ORDER_ACTION_CHOICES = (
+    ('accept_refund', 'Update orders to refund granted'),
+    ('reject_refund', 'Update orders to refund rejected'),
+    ('revert_refund_to_pending', 'Update orders to refund decision pending'),
+    ('update_to_being_delivered', 'Update to being delivered'),
+    ('update_to_received', 'Update to received'),
+)
+
+ORDER_TOTAL_FIELDS = ('subtotal', 'discount_total', 'coupon_total',
+                      'total_quantity')
+
+RESERVATION_STATUS_CHOICES = (
+    ('reserved', 'Reserved'),
+    ('committed', 'Committed'),
+)
+
+BULK_JOB_STATUS_CHOICES = (
+    ('pending', 'Pending'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
@@ -30,10 +71,24 @@ class Item(models.Model):
     slug = models.SlugField()
     description = models.TextField()
     image = models.ImageField()
+    # JSON manifest of the resized copies of `image`, see core.images
+    image_variants = models.TextField(blank=True, default='', editable=False)
+    # Number of StockShard rows holding the item's stock; 0 means stock
+    # isn't tracked and the item never runs out
+    stock_shards = models.IntegerField(default=0)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        # The facet signals lock the row to read its stored values, which
+        # needs a transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def get_image_variants(self):
+        return json.loads(self.image_variants) if self.image_variants else {}
+
     def get_absolute_url(self):
         # Return a reverse to 'core' namespace
         # and 'product' url name
@@ -52,17 +107,54 @@ class Item(models.Model):
         })
 
 
+def _discounted(prefix=''):
+    # A falsy discount_price (NULL or 0) means no discount
+    return (Q(**{f'{prefix}item__discount_price__isnull': False}) &
+            ~Q(**{f'{prefix}item__discount_price': 0}))
+
+
+class OrderItemQuerySet(models.QuerySet):
+    def with_prices(self):
+        # computed_total_item_price and computed_final_price, worked out
+        # in SQL as get_total_item_price() and get_final_price() do
+        quantity = F('quantity')
+        return self.annotate(
+            computed_total_item_price=quantity * F('item__price'),
+            computed_final_price=Case(
+                When(_discounted(),
+                     then=quantity * F('item__discount_price')),
+                default=quantity * F('item__price'),
+                output_field=IntegerField(),
+            ),
+        )
+
+    def mark_ordered(self):
+        # Flags the lines ordered and keeps what each one costs right now
+        prices = self.with_prices().values_list('pk', 'computed_final_price')
+        return self.update(ordered=True, paid_price=Case(
+            *[When(pk=pk, then=Value(price)) for pk, price in prices],
+            output_field=IntegerField(),
+        ))
+
+
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
     ordered = models.BooleanField(default=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # get_final_price() when the order was paid, so the sales rollups
+    # don't change with later price changes. Unset for older orders.
+    paid_price = models.IntegerField(blank=True, null=True)
+
+    objects = OrderItemQuerySet.as_manager()
 
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
 
     def get_total_item_price(self):
+        if hasattr(self, 'computed_total_item_price'):
+            return self.computed_total_item_price
         return self.quantity * self.item.price
 
     def get_total_discount_item_price(self):
@@ -73,16 +165,86 @@ class OrderItem(models.Model):
         return self.get_total_item_price() - self.get_total_discount_item_price()
 
     def get_final_price(self):
+        if hasattr(self, 'computed_final_price'):
+            return self.computed_final_price
         if self.item.discount_price:
             return self.get_total_discount_item_price()
         else:
             return self.get_total_item_price()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['item', 'user', 'ordered'],
+                         name='core_orderitem_item_user_idx'),
+        ]
+
+
+def _line_totals(prefix=''):
+    # Aggregates over OrderItem rows reproducing OrderItem.get_final_price:
+    # a falsy discount_price (NULL or 0) falls back to the full price
+    quantity = F(f'{prefix}quantity')
+    price = F(f'{prefix}item__price')
+    discount_price = F(f'{prefix}item__discount_price')
+    return {
+        'subtotal': Coalesce(Sum(quantity * price), 0),
+        'discount_total': Coalesce(Sum(Case(
+            When(_discounted(prefix),
+                 then=quantity * (price - discount_price)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )), 0),
+        'total_quantity': Coalesce(Sum(quantity), 0),
+    }
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_lines(self):
+        return self.select_related('coupon').prefetch_related(Prefetch(
+            'items', queryset=OrderItem.objects.select_related('item')))
+
+    def _totals(self):
+        # The totals of each order as correlated subqueries, which unlike
+        # a join on the lines combine with any other annotation
+        through = Order.items.through
+        lines = through.objects.filter(order_id=OuterRef('pk')).values(
+            'order_id')
+        totals = {
+            name: Coalesce(Subquery(
+                lines.annotate(value=expression).values('value'),
+                output_field=IntegerField()), 0)
+            for name, expression in _line_totals('orderitem__').items()
+        }
+        coupon = Coupon.objects.filter(pk=OuterRef('coupon_id'))
+        totals['coupon_total'] = Coalesce(
+            Subquery(coupon.values('amount')[:1]), 0)
+        return totals
+
+    def with_totals(self):
+        """
+        Annotate computed_subtotal, computed_discount_total,
+        computed_coupon_total, computed_total_quantity and computed_total,
+        worked out from the lines in SQL exactly as recompute_totals() and
+        get_total() do, whatever the stored totals say. get_total(),
+        get_total_quantity() and check_totals() use them when present.
+        """
+        totals = {f'computed_{name}': expression
+                  for name, expression in self._totals().items()}
+        return self.annotate(**totals).annotate(computed_total=Greatest(
+            F('computed_subtotal') - F('computed_discount_total') -
+            F('computed_coupon_total'), Value(0)))
+
+    def update_totals(self):
+        # Recalculate the stored totals of every order in the queryset with
+        # a single UPDATE built from correlated subqueries
+        invalidate_cart_summary(*self.values_list('user_id', flat=True))
+        return self.update(**self._totals())
+
 
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
-    ref_code = models.CharField(max_length=20, blank=True, null=True)
+    ref_code = models.CharField(
+        max_length=20, blank=True, null=True, db_index=True)
     items = models.ManyToManyField(OrderItem, )
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
@@ -99,6 +261,22 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # Denormalized cart totals, kept in step with every cart change by
+    # update_totals() so pages don't walk the order items to render them
+    subtotal = models.IntegerField(default=0)
+    discount_total = models.IntegerField(default=0)
+    coupon_total = models.IntegerField(default=0)
+    total_quantity = models.IntegerField(default=0)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        # Migration 0004 also adds a partial unique index on user_id
+        # WHERE NOT ordered: each user has at most one open order
+        indexes = [
+            models.Index(fields=['user', 'ordered'],
+                         name='core_order_user_ordered_idx'),
+        ]
 
     '''
     --- Stages of an Order ---
@@ -116,18 +294,71 @@ class Order(models.Model):
         return self.user.username
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
-            total -= self.coupon.amount
+        if settings.ORDER_TOTALS_CHECK:
+            self.check_totals()
+        if hasattr(self, 'computed_total'):
+            return self.computed_total
+        total = self.subtotal - self.discount_total - self.coupon_total
         return total if total > 0 else 0
 
     def get_total_quantity(self):
-        total_quantity = 0
-        for order_item in self.items.all():
-            total_quantity += order_item.quantity
-        return total_quantity
+        if settings.ORDER_TOTALS_CHECK:
+            self.check_totals()
+        if hasattr(self, 'computed_total_quantity'):
+            return self.computed_total_quantity
+        return self.total_quantity
+
+    def get_computed_totals(self):
+        # The with_totals() annotations, None without them
+        if not hasattr(self, 'computed_total'):
+            return None
+        return {name: getattr(self, f'computed_{name}')
+                for name in ORDER_TOTAL_FIELDS}
+
+    def calculate_totals(self):
+        totals = self.items.aggregate(**_line_totals())
+        totals['coupon_total'] = self.coupon.amount if self.coupon_id else 0
+        return totals
+
+    def update_totals(self):
+        # Call inside the transaction that changed the cart
+        totals = self.calculate_totals()
+        Order.objects.filter(pk=self.pk).update(**totals)
+        for name, value in totals.items():
+            setattr(self, name, value)
+        invalidate_cart_summary(self.user_id)
+
+    def recompute_totals(self):
+        # Reference implementation walking the items in Python
+        lines = self.items.all()
+        if 'items' not in getattr(self, '_prefetched_objects_cache', {}):
+            lines = lines.select_related('item')
+        totals = {
+            'subtotal': 0,
+            'discount_total': 0,
+            'coupon_total': self.coupon.amount if self.coupon else 0,
+            'total_quantity': 0,
+        }
+        for order_item in lines:
+            totals['subtotal'] += order_item.get_total_item_price()
+            totals['discount_total'] += (order_item.get_total_item_price() -
+                                         order_item.get_final_price())
+            totals['total_quantity'] += order_item.quantity
+        return totals
+
+    def check_totals(self):
+        # Ordered carts keep the totals they were paid at, whatever the
+        # prices became since
+        if self.ordered:
+            return
+        stored = {name: getattr(self, name) for name in ORDER_TOTAL_FIELDS}
+        # A development check; its queries don't count against the budgets
+        with uncounted():
+            expected = self.get_computed_totals() or self.recompute_totals()
+        if stored != expected:
+            raise AssertionError(
+                f'Stored totals of order {self.pk} are stale: '
+                f'{stored} != {expected}')
 
 
 class Address(models.Model):
@@ -147,6 +378,10 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            models.Index(fields=['user', 'address_type', 'default'],
+                         name='core_address_user_type_idx'),
+        ]
 
 
 class Payment(models.Model):
@@ -161,13 +396,40 @@ class Payment(models.Model):
 
 
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
+    code = models.CharField(max_length=15, unique=True)
     amount = models.IntegerField()
+    active = models.BooleanField(default=True)
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    # Blank for no limit
+    max_redemptions = models.IntegerField(blank=True, null=True)
+    max_per_user = models.IntegerField(blank=True, null=True)
+    # Orders paid, or being paid, with the coupon; only ever changed with
+    # conditional UPDATEs by core.coupons so it can't pass max_redemptions
+    redemptions = models.IntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.code
 
 
+class CouponRedemption(models.Model):
+    # Taken when the charge is queued, released again if it fails
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    order = models.OneToOneField(Order, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['coupon', 'user'],
+                         name='core_redemption_coupon_user'),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon_id} by {self.user_id}'
+
+
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     reason = models.TextField()
@@ -176,3 +438,213 @@ class Refund(models.Model):
 
     def __str__(self):
         return f'{self.pk}'
+
+
+class ChargeJob(models.Model):
+    """
+    A Stripe charge waiting for, or done by, the background worker
+    (manage.py run_worker). The idempotency key is sent to Stripe, so a
+    job that is retried after a crash or a network error is charged once.
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    token = models.CharField(max_length=255, blank=True)
+    amount = models.IntegerField()
+    # Digest of the lines, coupon and total `amount` was worked out from;
+    # see core.jobs.quote_order
+    quote = models.CharField(max_length=64, blank=True, editable=False)
+    status = models.CharField(
+        max_length=10, choices=CHARGE_STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    charge_id = models.CharField(max_length=50, blank=True)
+    # Set when the charge was given back because the order changed
+    refund_id = models.CharField(max_length=50, blank=True)
+    error = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    # A job retried after a transient error waits until then
+    run_after = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.idempotency_key}: {self.status}'
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+
+class BulkOrderJob(models.Model):
+    """
+    An admin action over a selection of orders, applied by the worker in
+    primary key order, one committed batch at a time. `last_pk` is the
+    checkpoint: a job that stopped half way resumes after it.
+    """
+    action = models.CharField(max_length=30,
+                              choices=BULK_ORDER_ACTION_CHOICES)
+    # JSON: {"pks": [...]} for the orders ticked in the changelist, or
+    # {"filters": "<query string>"} when all the filtered ones were chosen
+    selection = models.TextField()
+    status = models.CharField(
+        max_length=10, choices=BULK_JOB_STATUS_CHOICES, default='pending')
+    batch_size = models.IntegerField(default=1000)
+    last_pk = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(blank=True, null=True)
+    error = models.CharField(max_length=255, blank=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True,
+        null=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.get_action_display()}: {self.status}'
+
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def get_progress(self):
+        if self.status == 'done':
+            return 100
+        if not self.total:
+            return 0
+        return min(100, self.processed * 100 // self.total)
+
+
+class ImageVariantJob(models.Model):
+    """
+    An item image waiting for its resized variants, built by the worker
+    (manage.py run_worker). Done jobs are deleted; one that kept failing
+    stays with its error until the item's image changes again.
+    """
+    item = models.OneToOneField(Item, on_delete=models.CASCADE)
+    # The Item.image name the variants are for
+    source = models.CharField(max_length=100)
+    attempts = models.IntegerField(default=0)
+    error = models.CharField(max_length=255, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.item_id}: {self.source}'
+
+
+class FacetCount(models.Model):
+    """
+    Number of items per combination of facet values (category, label,
+    price bucket, discount), kept current by the Item signals so listing
+    pages never have to GROUP BY the catalog, whatever the filters.
+    rebuild_facets recounts from scratch.
+    """
+    category = models.CharField(max_length=2)
+    label = models.CharField(max_length=1)
+    price = models.CharField(max_length=20)
+    discount = models.CharField(max_length=1)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('category', 'label', 'price', 'discount')
+
+    def __str__(self):
+        return (f'{self.category}/{self.label}/{self.price}/'
+                f'{self.discount}: {self.count}')
+
+
+class DailySales(models.Model):
+    """
+    Paid orders by the day they were placed, with their refunds. Kept
+    current by core.rollups as charges succeed and refunds are granted,
+    so reports never scan the orders; rebuild_rollups recounts it.
+    """
+    day = models.DateField(unique=True)
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.IntegerField(default=0)
+    discount_total = models.IntegerField(default=0)
+    coupon_total = models.IntegerField(default=0)
+    refunds = models.IntegerField(default=0)
+    refunded_amount = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'daily sales'
+
+    def __str__(self):
+        return f'{self.day}: {self.orders} orders'
+
+    def get_refund_rate(self):
+        return self.refunds / self.orders if self.orders else 0
+
+
+class ItemSales(models.Model):
+    # Units and revenue (after item discounts) of an item per day
+    day = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    units = models.IntegerField(default=0)
+    revenue = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'item')
+        verbose_name_plural = 'item sales'
+
+    def __str__(self):
+        return f'{self.day} {self.item_id}: {self.units}'
+
+
+class CouponUsage(models.Model):
+    coupon = models.OneToOneField(Coupon, on_delete=models.CASCADE)
+    orders = models.IntegerField(default=0)
+    amount = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.coupon_id}: {self.orders}'
+
+
+class StockShard(models.Model):
+    """
+    A slice of an item's stock. core.inventory takes from one shard per
+    reservation with a conditional UPDATE, so shoppers buying the same
+    item at once mostly lock different rows. The stock left is the sum
+    over the item's shards.
+    """
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    shard = models.IntegerField()
+    available = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('item', 'shard')
+
+    def __str__(self):
+        return f'{self.item_id}/{self.shard}: {self.available}'
+
+
+class StockReservation(models.Model):
+    """
+    Units of an item taken from one of its shards for an open order.
+    Reserved rows expire and are given back by the worker's sweeper;
+    paying for the order commits them.
+    """
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE)
+    shard = models.IntegerField()
+    quantity = models.IntegerField()
+    status = models.CharField(max_length=10,
+                              choices=RESERVATION_STATUS_CHOICES,
+                              default='reserved')
+    expires_at = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order', 'item'],
+                         name='core_reservation_order_item'),
+            models.Index(fields=['status', 'expires_at'],
+                         name='core_reservation_expiry'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} of {self.item_id} for {self.order_id}'
@@ -0,0 +1,202 @@
+import base64
+import binascii
+import json
+from functools import reduce
+
+from django.core.paginator import InvalidPage, Paginator
+from django.db import connection
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+from django.utils.translation import gettext as _
+
+PAGINATION_MODES = ('keyset', 'page')
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(direction, values):
+    payload = json.dumps([direction, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        direction, values = json.loads(
+            base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, TypeError, binascii.Error):
+        raise InvalidCursor(_('That cursor is not valid'))
+    if direction not in ('next', 'prev') or not isinstance(values, list):
+        raise InvalidCursor(_('That cursor is not valid'))
+    return direction, values
+
+
+def keyset_filter(fields, values, lookup):
+    # (a, b) > (x, y)  ==>  a > x OR (a = x AND b > y)
+    clauses = []
+    for i, field in enumerate(fields):
+        equal = {f: v for f, v in zip(fields[:i], values[:i])}
+        clauses.append(Q(**equal, **{f'{field}__{lookup}': values[i]}))
+    return reduce(lambda a, b: a | b, clauses)
+
+
+class KeysetPage:
+    def __init__(self, object_list, fields, has_next, has_previous):
+        self.object_list = object_list
+        self.fields = fields
+        self.has_next_page = has_next
+        self.has_previous_page = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def _cursor(self, direction, obj):
+        return encode_cursor(direction, [getattr(obj, f) for f in self.fields])
+
+    def has_next(self):
+        return self.has_next_page
+
+    def has_previous(self):
+        return self.has_previous_page
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_cursor(self):
+        if self.has_next():
+            return self._cursor('next', self.object_list[-1])
+
+    def previous_cursor(self):
+        if self.has_previous():
+            return self._cursor('prev', self.object_list[0])
+
+
+class KeysetPaginator:
+    """
+    Paginates on an ordered set of unique-together fields, e.g. ('id',) or
+    ('category', 'id'). Pages are found with a WHERE on the last seen key
+    instead of OFFSET, and no total count is ever taken.
+    """
+
+    def __init__(self, object_list, per_page, fields=('id',)):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+        self.fields = tuple(fields)
+
+    def page(self, cursor=None):
+        qs = self.object_list
+        if not cursor:
+            rows = list(qs.order_by(*self.fields)[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], self.fields,
+                              has_next=len(rows) > self.per_page,
+                              has_previous=False)
+
+        direction, values = decode_cursor(cursor)
+        if len(values) != len(self.fields):
+            raise InvalidCursor(_('That cursor is not valid'))
+        try:
+            # The fields turn values of the wrong type away here
+            qs = qs.filter(keyset_filter(
+                self.fields, values, 'gt' if direction == 'next' else 'lt'))
+        except (ValueError, TypeError):
+            raise InvalidCursor(_('That cursor is not valid'))
+        if direction == 'next':
+            rows = list(qs.order_by(*self.fields)[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], self.fields,
+                              has_next=len(rows) > self.per_page,
+                              has_previous=True)
+
+        rows = list(qs.order_by(
+            *[f'-{f}' for f in self.fields])[:self.per_page + 1])
+        has_previous = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        rows.reverse()
+        return KeysetPage(rows, self.fields,
+                          has_next=True, has_previous=has_previous)
+
+
+class KeysetPaginationMixin:
+    """
+    ListView mixin that switches between cursor pages and Django's numbered
+    pages. Set ``pagination_mode = 'page'`` (or pass it to ``as_view()``)
+    for views that need page numbers, e.g. for SEO.
+    """
+    pagination_mode = 'keyset'
+    keyset_fields = ('id',)
+    cursor_kwarg = 'cursor'
+
+    def get_pagination_mode(self):
+        if self.pagination_mode not in PAGINATION_MODES:
+            raise ValueError(
+                f'pagination_mode must be one of {PAGINATION_MODES}')
+        return self.pagination_mode
+
+    def get_ordering(self):
+        return self.ordering or list(self.keyset_fields)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.get_pagination_mode() == 'page':
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size, self.keyset_fields)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor as e:
+            raise Http404(str(e))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault('pagination_mode', self.get_pagination_mode())
+        return super().get_context_data(**kwargs)
+
+
+def estimate_count(model):
+    """
+    Rows in the model's table according to the planner statistics (kept
+    by autovacuum on PostgreSQL, by ANALYZE on SQLite), or None when the
+    database has none.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                'SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)',
+                [connection.ops.quote_name(table)])
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] > 0 else None
+        if connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master "
+                           "WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            # The first number of each entry is the row count
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s',
+                           [table])
+            counts = [int(stat.split()[0]) for stat, in cursor.fetchall()]
+            return max(counts) if counts else None
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for tables too big for an exact COUNT(*) on every page
+    load. Unfiltered lists of more than `estimate_threshold` rows use the
+    planner's estimate; filtered ones count at most `count_limit` rows,
+    so pages past that are reached by narrowing the filter instead.
+    """
+    estimate_threshold = 10000
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_count(queryset.model)
+            if estimate is not None and estimate > self.estimate_threshold:
+                return estimate
+        return queryset.order_by()[:self.count_limit].count()
@@ -0,0 +1,292 @@
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import requests
+import stripe
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .metrics import Histogram
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+STRIPE_LATENCY = Histogram(
+    'stripe_request_duration_seconds',
+    'Time spent in Stripe API calls, by operation and outcome.',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0),
+)
+
+# Test tokens the fake backend declines, mirroring Stripe's test tokens
+FAKE_DECLINED_TOKENS = {
+    'tok_chargeDeclined': ('Your card was declined.', 'card_declined'),
+    'tok_chargeDeclinedInsufficientFunds': (
+        'Your card has insufficient funds.', 'card_declined'),
+    'tok_chargeDeclinedExpiredCard': (
+        'Your card has expired.', 'expired_card'),
+}
+
+
+class FakeStripe:
+    """
+    In-process stand-in for stripe.Charge used when STRIPE_BACKEND is
+    'fake', so checkout can be load-tested without network access. Only
+    the last ``ledger_size`` charges and refunds are kept, so a long load
+    test doesn't grow the process without bound.
+    """
+
+    def __init__(self, latency=0, ledger_size=10000):
+        self.latency = latency
+        self.ledger_size = ledger_size
+        self.charges = OrderedDict()
+        self.refunds = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _record(self, ledger, key, entry):
+        with self._lock:
+            ledger[key] = entry
+            while len(ledger) > self.ledger_size:
+                ledger.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.charges.clear()
+            self.refunds.clear()
+
+    def create_charge(self, amount, currency, source, description,
+                      idempotency_key=None):
+        if idempotency_key in self.charges:
+            return self.charges[idempotency_key]
+        if self.latency:
+            time.sleep(self.latency)
+        if source in FAKE_DECLINED_TOKENS:
+            message, code = FAKE_DECLINED_TOKENS[source]
+            raise stripe.error.CardError(
+                message, None, code, http_status=402, json_body={'error': {
+                    'type': 'card_error', 'code': code, 'message': message,
+                }})
+        charge = {
+            'id': f'ch_fake_{uuid.uuid4().hex[:20]}',
+            'object': 'charge',
+            'amount': amount,
+            'currency': currency,
+            'description': description,
+            'paid': True,
+            'status': 'succeeded',
+        }
+        if idempotency_key:
+            self._record(self.charges, idempotency_key, charge)
+        return charge
+
+    def create_refund(self, charge, idempotency_key=None):
+        if idempotency_key in self.refunds:
+            return self.refunds[idempotency_key]
+        with self._lock:
+            charged = next((c for c in self.charges.values()
+                            if c['id'] == charge), None)
+        if charged is None or charged.get('refunded'):
+            raise stripe.error.InvalidRequestError(
+                f'No such charge: {charge}', 'charge', http_status=400)
+        charged['refunded'] = True
+        refund = {
+            'id': f're_fake_{uuid.uuid4().hex[:20]}',
+            'object': 'refund',
+            'amount': charged['amount'],
+            'charge': charge,
+            'status': 'succeeded',
+        }
+        if idempotency_key:
+            self._record(self.refunds, idempotency_key, refund)
+        return refund
+
+
+_fake_stripe = None
+
+
+def get_fake_stripe():
+    global _fake_stripe
+    if _fake_stripe is None:
+        _fake_stripe = FakeStripe(
+            latency=settings.FAKE_STRIPE_LATENCY,
+            ledger_size=settings.FAKE_STRIPE_LEDGER_SIZE)
+    return _fake_stripe
+
+
+class RetryBudget:
+    """
+    Caps retries at ``ratio`` of the calls made in the last ``window``
+    seconds, plus ``min_retries`` per window so a quiet process can still
+    retry. When Stripe is struggling this stops every worker from
+    multiplying its load with retries.
+    """
+
+    def __init__(self, ratio, min_retries, window):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._calls = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        for events in (self._calls, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_call(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._calls.append(now)
+
+    def try_spend(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            allowed = self.min_retries + self.ratio * len(self._calls)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+_client_lock = threading.Lock()
+_client_pid = None
+_retry_budget = None
+
+
+def configure_http_client(force=False):
+    """
+    Point the stripe library at a keep-alive connection pool with bounded
+    connect/read timeouts. Runs once per process; after a fork (gunicorn
+    workers) the pool is rebuilt so sockets are never shared.
+    """
+    global _client_pid, _retry_budget
+    if _client_pid == os.getpid() and not force:
+        return
+    with _client_lock:
+        if _client_pid == os.getpid() and not force:
+            return
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings.STRIPE_POOL_SIZE,
+            max_retries=0,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        stripe.default_http_client = stripe.http_client.RequestsClient(
+            timeout=(settings.STRIPE_CONNECT_TIMEOUT,
+                     settings.STRIPE_READ_TIMEOUT),
+            session=session,
+        )
+        # Retries are ours, with jitter and a budget
+        stripe.max_network_retries = 0
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        stripe.api_base = settings.STRIPE_API_BASE or 'https://api.stripe.com'
+        _retry_budget = RetryBudget(
+            ratio=settings.STRIPE_RETRY_BUDGET_RATIO,
+            min_retries=settings.STRIPE_RETRY_BUDGET_MIN,
+            window=settings.STRIPE_RETRY_BUDGET_WINDOW,
+        )
+        _client_pid = os.getpid()
+
+
+def retry_delay(attempt):
+    # Exponential backoff with full jitter
+    ceiling = min(settings.STRIPE_RETRY_MAX_DELAY,
+                  settings.STRIPE_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def call_stripe(operation, func, retry=True, **params):
+    """
+    Call a stripe library function, recording its latency. Retryable
+    errors are retried up to STRIPE_MAX_RETRIES times while the process
+    retry budget allows; only pass retry=True for idempotent calls.
+    """
+    configure_http_client()
+    _retry_budget.record_call()
+    attempt = 0
+    while True:
+        started = time.monotonic()
+        try:
+            result = func(**params)
+        except Exception as e:
+            STRIPE_LATENCY.observe(time.monotonic() - started,
+                                   operation=operation,
+                                   outcome=type(e).__name__)
+            if (not retry or not is_retryable(e) or
+                    attempt >= settings.STRIPE_MAX_RETRIES or
+                    not _retry_budget.try_spend()):
+                raise
+            time.sleep(retry_delay(attempt))
+            attempt += 1
+            continue
+        STRIPE_LATENCY.observe(time.monotonic() - started,
+                               operation=operation, outcome='ok')
+        return result
+
+
+def create_charge(amount, currency, source, description,
+                  idempotency_key=None):
+    if settings.STRIPE_BACKEND == 'fake':
+        func = get_fake_stripe().create_charge
+    else:
+        func = stripe.Charge.create
+    # Without an idempotency key a retry could charge twice
+    return call_stripe(
+        'charge.create', func, retry=bool(idempotency_key),
+        amount=amount,
+        currency=currency,
+        source=source,
+        description=description,
+        idempotency_key=idempotency_key,
+    )
+
+
+def refund_charge(charge_id, idempotency_key):
+    if settings.STRIPE_BACKEND == 'fake':
+        func = get_fake_stripe().create_refund
+    else:
+        func = stripe.Refund.create
+    return call_stripe('refund.create', func, charge=charge_id,
+                       idempotency_key=idempotency_key)
+
+
+def charge_error_message(e):
+    # The message shown to the shopper for a failed charge
+    if isinstance(e, stripe.error.CardError):
+        # Since it's a decline, stripe.error.CardError will be caught
+        return e.user_message or "Your card was declined."
+    elif isinstance(e, stripe.error.RateLimitError):
+        # Too many requests made to the API too quickly
+        return "Rate limit error"
+    elif isinstance(e, stripe.error.InvalidRequestError):
+        # Invalid parameters were supplied to Stripe's API
+        return "Invalid parameters"
+    elif isinstance(e, stripe.error.AuthenticationError):
+        # Authentication with Stripe's API failed
+        # (maybe you changed API keys recently)
+        return "Not authenticated"
+    elif isinstance(e, stripe.error.APIConnectionError):
+        # Network communication with Stripe failed
+        return "Network error"
+    elif isinstance(e, stripe.error.StripeError):
+        # Display a very generic error to the user, and maybe send
+        # yourself an email
+        return "Something went wrong. You were not charged. Please try again."
+    # Something else happened, completely unrelated to Stripe
+    return ("A serious error occured. "
+            "Technical team has been automatically notified.")
+
+
+def is_retryable(e):
+    # Safe to try again with the same idempotency key
+    if isinstance(e, stripe.error.APIError):
+        return (e.http_status or 500) >= 500
+    return isinstance(e, (stripe.error.RateLimitError,
+                          stripe.error.APIConnectionError))
@@ -0,0 +1,211 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import (
+    Case, Count, F, IntegerField, Max, Q, Sum, When)
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import CouponUsage, DailySales, ItemSales, Order, OrderItem
+
+CHUNK_SIZE = 5000
+DAILY_FIELDS = ('orders', 'units', 'revenue', 'discount_total',
+                'coupon_total', 'refunds', 'refunded_amount')
+
+# What a line brought in: its price when paid, or for lines paid before
+# that was kept, what OrderItem.get_final_price works out today
+LINE_REVENUE = Sum(Coalesce(F('paid_price'), F('quantity') * Case(
+    When(Q(item__discount_price__isnull=False) & ~Q(item__discount_price=0),
+         then=F('item__discount_price')),
+    default=F('item__price'),
+    output_field=IntegerField(),
+)))
+ROLLUPS = (
+    (DailySales, ('day',), DAILY_FIELDS),
+    (ItemSales, ('day', 'item_id'), ('units', 'revenue')),
+    (CouponUsage, ('coupon_id',), ('orders', 'amount')),
+)
+
+
+def _add(model, keys, **deltas):
+    deltas = {name: value for name, value in deltas.items() if value}
+    if not deltas:
+        return
+    increments = {name: F(name) + value for name, value in deltas.items()}
+    if model.objects.filter(**keys).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**keys, **deltas)
+    except IntegrityError:
+        # Created by a concurrent write
+        model.objects.filter(**keys).update(**increments)
+
+
+def record_order(order, amount):
+    """
+    Add a freshly paid order to the rollups. Call in the transaction that
+    marks it ordered, after its totals are final.
+    """
+    day = timezone.localdate(order.ordered_date)
+    _add(DailySales, {'day': day}, orders=1, units=order.total_quantity,
+         revenue=amount, discount_total=order.discount_total,
+         coupon_total=order.coupon_total)
+    for line in order.items.select_related('item'):
+        revenue = line.paid_price
+        if revenue is None:
+            revenue = line.get_final_price()
+        _add(ItemSales, {'day': day, 'item_id': line.item_id},
+             units=line.quantity, revenue=revenue)
+    if order.coupon_id:
+        _add(CouponUsage, {'coupon_id': order.coupon_id}, orders=1,
+             amount=order.coupon_total)
+
+
+def record_refund_changes(queryset, granted):
+    """
+    Count the paid orders of `queryset` whose refund_granted is about to
+    become `granted` in (or out of) the refunds of their day. Call in the
+    transaction that changes the flag, before the change.
+    """
+    sign = 1 if granted else -1
+    flipping = queryset.filter(ordered=True).exclude(refund_granted=granted)
+    for row in flipping.annotate(day=TruncDate('ordered_date')).values(
+            'day').annotate(orders=Count('pk'),
+                            amount=Sum('payment__amount')).order_by():
+        _add(DailySales, {'day': row['day']}, refunds=sign * row['orders'],
+             refunded_amount=sign * (row['amount'] or 0))
+
+
+def count_chunk(low, high):
+    """
+    The rollup rows of the paid orders with low < pk <= high, as Counters
+    of field values by key.
+    """
+    orders = Order.objects.filter(ordered=True, pk__gt=low, pk__lte=high)
+    granted = Q(refund_granted=True)
+    daily, items, coupons = Counter(), Counter(), Counter()
+    for row in orders.annotate(day=TruncDate('ordered_date')).values(
+            'day').annotate(
+            orders=Count('pk'),
+            units=Sum('total_quantity'),
+            revenue=Sum('payment__amount'),
+            discount_total=Sum('discount_total'),
+            coupon_total=Sum('coupon_total'),
+            refunds=Count('pk', filter=granted),
+            refunded_amount=Sum('payment__amount', filter=granted),
+    ).order_by():
+        for name in DAILY_FIELDS:
+            daily[row['day'], name] += row[name] or 0
+
+    lines = OrderItem.objects.filter(
+        order__ordered=True, order__pk__gt=low, order__pk__lte=high)
+    for row in lines.annotate(day=TruncDate('order__ordered_date')).values(
+            'day', 'item_id').annotate(
+            units=Sum('quantity'), revenue=LINE_REVENUE).order_by():
+        items[row['day'], row['item_id'], 'units'] += row['units']
+        items[row['day'], row['item_id'], 'revenue'] += row['revenue']
+
+    for row in orders.filter(coupon__isnull=False).values(
+            'coupon_id').annotate(orders=Count('pk'),
+                                  amount=Sum('coupon_total')).order_by():
+        coupons[row['coupon_id'], 'orders'] += row['orders']
+        coupons[row['coupon_id'], 'amount'] += row['amount']
+    return daily, items, coupons
+
+
+def read_rollups():
+    # The rollup rows as Counters, like count_chunk returns
+    counts = []
+    for model, keys, fields in ROLLUPS:
+        rows = Counter()
+        for row in model.objects.values_list(*keys, *fields):
+            for name, value in zip(fields, row[len(keys):]):
+                rows[(*row[:len(keys)], name)] += value
+        counts.append(rows)
+    return counts
+
+
+def _correct(model, keys, fields, recount, current):
+    # Adds the difference as increments, so whatever record_order and
+    # record_refund_changes added since `current` was read is kept
+    deltas = {}
+    for key in recount.keys() | current.keys():
+        *values, name = key
+        deltas.setdefault(tuple(values), {})[name] = (
+            recount[key] - current[key])
+    for values, changes in deltas.items():
+        _add(model, dict(zip(keys, values)), **changes)
+    model.objects.filter(**{name: 0 for name in fields}).delete()
+
+
+def rebuild_rollups(chunk_size=CHUNK_SIZE, pause=0, progress=None):
+    """
+    Recount the rollups from the orders, `chunk_size` primary keys at a
+    time with `pause` seconds between chunks. The rollups and the orders
+    are read from one snapshot, which on PostgreSQL takes no locks; only
+    the differences are then written, as increments, so payments and
+    refunds recorded meanwhile are kept. `progress(last_pk, max_pk)` is
+    called after each chunk.
+    """
+    recount = [Counter(), Counter(), Counter()]
+    # Inside a caller's transaction the reads are as consistent as it is
+    snapshot = (connection.vendor == 'postgresql' and
+                not connection.in_atomic_block)
+    with transaction.atomic():
+        if snapshot:
+            # Must come before any other query of the transaction
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL '
+                               'REPEATABLE READ READ ONLY')
+        current = read_rollups()
+        last = Order.objects.aggregate(last=Max('pk'))['last'] or 0
+        for low in range(0, last, chunk_size):
+            high = min(low + chunk_size, last)
+            for total, counts in zip(recount, count_chunk(low, high)):
+                total.update(counts)
+            if progress is not None:
+                progress(high, last)
+            if pause and high < last:
+                time.sleep(pause)
+
+    with transaction.atomic():
+        for (model, keys, fields), counts, rows in zip(
+                ROLLUPS, recount, current):
+            _correct(model, keys, fields, counts, rows)
+    return last
+
+
+def sales_report(days=30, today=None, top=10):
+    """
+    Everything the sales dashboard shows for the last `days` days, read
+    from the rollups alone on the REPORTING_DATABASE.
+    """
+    using = settings.REPORTING_DATABASE
+    today = today or timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    daily = list(DailySales.objects.using(using).filter(
+        day__gte=since, day__lte=today).order_by('-day'))
+    totals = {name: sum(getattr(row, name) for row in daily)
+              for name in DAILY_FIELDS}
+    totals['refund_rate'] = (totals['refunds'] / totals['orders']
+                             if totals['orders'] else 0)
+    top_items = ItemSales.objects.using(using).filter(
+        day__gte=since, day__lte=today).values(
+        'item_id', 'item__title').annotate(
+        units=Sum('units'), revenue=Sum('revenue')).order_by(
+        '-units', 'item_id')[:top]
+    top_coupons = CouponUsage.objects.using(using).select_related(
+        'coupon').order_by('-orders', 'coupon_id')[:top]
+    return {
+        'days': days,
+        'since': since,
+        'today': today,
+        'daily': daily,
+        'totals': totals,
+        'top_items': list(top_items),
+        'top_coupons': list(top_coupons),
+    }
@@ -0,0 +1,165 @@
+import re
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Item
+
+# SQLite keeps a copy of each item's text in an FTS5 table that the Item
+# signals update row by row; PostgreSQL uses a GIN index over the same
+# weighted tsvector expression the queries below use, so it updates with
+# every write on its own.
+SQLITE_TABLE = 'core_item_fts'
+POSTGRES_INDEX = 'core_item_search_idx'
+POSTGRES_VECTOR = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+# Control characters can't occur in the catalog text, so they mark the
+# highlighted terms until the snippet is escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+SNIPPET_WORDS = 24
+MAX_TERMS = 10
+
+SQLITE_SCHEMA = [
+    f"CREATE VIRTUAL TABLE {SQLITE_TABLE} USING fts5("
+    f"title, description, tokenize='porter unicode61')",
+]
+SQLITE_DROP = [
+    f'DROP TABLE IF EXISTS {SQLITE_TABLE}',
+]
+SQLITE_REBUILD = [
+    f'DELETE FROM {SQLITE_TABLE}',
+    f'INSERT INTO {SQLITE_TABLE}(rowid, title, description) '
+    f'SELECT id, title, description FROM core_item',
+]
+POSTGRES_SCHEMA = [
+    f'CREATE INDEX {POSTGRES_INDEX} ON core_item USING GIN '
+    f'(({POSTGRES_VECTOR}))',
+]
+POSTGRES_DROP = [
+    f'DROP INDEX IF EXISTS {POSTGRES_INDEX}',
+]
+
+SQLITE_SEARCH = f"""
+    SELECT rowid,
+           bm25({SQLITE_TABLE}, 10.0, 1.0),
+           snippet({SQLITE_TABLE}, 1, %s, %s, '...', {SNIPPET_WORDS})
+    FROM {SQLITE_TABLE}
+    WHERE {SQLITE_TABLE} MATCH %s
+    ORDER BY bm25({SQLITE_TABLE}, 10.0, 1.0), rowid
+    LIMIT %s OFFSET %s
+"""
+POSTGRES_SEARCH = f"""
+    SELECT id, rank,
+           ts_headline('english', description, query, %s)
+    FROM (
+        SELECT id, description, query,
+               ts_rank({POSTGRES_VECTOR}, query) AS rank
+        FROM core_item, to_tsquery('english', %s) AS query
+        WHERE ({POSTGRES_VECTOR}) @@ query
+        ORDER BY rank DESC, id
+        LIMIT %s OFFSET %s
+    ) AS matches
+    ORDER BY rank DESC, id
+"""
+POSTGRES_HEADLINE = (
+    f'StartSel={MATCH_START}, StopSel={MATCH_END}, '
+    f'MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}'
+)
+
+
+class SearchNotSupported(Exception):
+    pass
+
+
+def _execute(statements, params=()):
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql, params)
+
+
+def index_item(item):
+    if connection.vendor == 'sqlite':
+        unindex_item(item.pk)
+        _execute([f'INSERT INTO {SQLITE_TABLE}(rowid, title, description) '
+                  f'VALUES (%s, %s, %s)'],
+                 [item.pk, item.title, item.description])
+
+
+def unindex_item(pk):
+    if connection.vendor == 'sqlite':
+        _execute([f'DELETE FROM {SQLITE_TABLE} WHERE rowid = %s'], [pk])
+
+
+def rebuild_index():
+    # For writes that skip the Item signals, such as bulk_create
+    if connection.vendor == 'sqlite':
+        _execute(SQLITE_REBUILD)
+    elif connection.vendor == 'postgresql':
+        _execute([f'REINDEX INDEX {POSTGRES_INDEX}'])
+    else:
+        raise SearchNotSupported(connection.vendor)
+
+
+def parse_terms(query):
+    # Only word characters reach the search engine, so user input can't
+    # produce FTS5 or tsquery syntax errors
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def _sqlite_query(terms):
+    # Every term must match; the last one as a prefix for
+    # search-as-you-type
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+
+def _postgres_query(terms):
+    return ' & '.join(terms) + ':*'
+
+
+def highlight(snippet):
+    return mark_safe(
+        escape(snippet or '')
+        .replace(MATCH_START, '<mark>')
+        .replace(MATCH_END, '</mark>')
+    )
+
+
+def search_items(query, limit=20, offset=0):
+    """
+    Return up to `limit` items matching every term of `query`, best match
+    first. Each item carries `search_rank` and an HTML-safe
+    `search_snippet` of its description with the matches in <mark>.
+    """
+    terms = parse_terms(query)
+    if not terms:
+        return []
+    if connection.vendor == 'sqlite':
+        sql = SQLITE_SEARCH
+        params = [MATCH_START, MATCH_END, _sqlite_query(terms), limit,
+                  offset]
+    elif connection.vendor == 'postgresql':
+        sql = POSTGRES_SEARCH
+        params = [POSTGRES_HEADLINE, _postgres_query(terms), limit, offset]
+    else:
+        raise SearchNotSupported(connection.vendor)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        matches = cursor.fetchall()
+    items = Item.objects.in_bulk([pk for pk, _, _ in matches])
+    results = []
+    for pk, rank, snippet in matches:
+        item = items.get(pk)
+        if item is None:
+            continue
+        # bm25 scores better matches lower; flip it so both backends rank
+        # higher-is-better
+        item.search_rank = -rank if connection.vendor == 'sqlite' else rank
+        item.search_snippet = highlight(snippet)
+        results.append(item)
+    return results
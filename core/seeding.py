@@ -0,0 +1,347 @@
+import random
+import time
+from array import array
+from collections import Counter, namedtuple
+from datetime import timedelta
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, reset_queries, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .cache import bump_catalog_version
+from .facets import rebuild_facet_counts
+from .rollups import rebuild_rollups
+from .search import rebuild_index
+from .helpers import create_ref_code
+from .models import (
+    ADDRESS_CHOICES, CATEGORY_CHOICES, LABEL_CHOICES, Address, Coupon, Item,
+    Order, OrderItem, Payment, Refund)
+
+CHUNK_SIZE = 1000
+
+# Shirts sell best, then sport wear, then outerwear
+CATEGORY_WEIGHTS = (5, 3, 2)
+ADJECTIVES = (
+    'classic', 'slim', 'relaxed', 'vintage', 'striped', 'plain', 'organic',
+    'linen', 'denim', 'cotton', 'wool', 'light', 'heavy', 'waterproof')
+NOUNS = {
+    'S': ('shirt', 'tee', 'polo', 'henley', 'oxford', 'blouse'),
+    'SW': ('jersey', 'track pants', 'shorts', 'leggings', 'tank top'),
+    'OW': ('jacket', 'coat', 'parka', 'hoodie', 'blazer', 'vest'),
+}
+CITIES = ('Dhaka', 'Chittagong', 'Khulna', 'Rajshahi', 'Sylhet', 'Barisal')
+
+# Prices and discounts by item, indexed by pk - first_pk; 0 means no
+# discount. Compact enough to keep millions of items in memory.
+Catalog = namedtuple('Catalog', 'first_pk prices discounts')
+Coupons = namedtuple('Coupons', 'first_pk amounts')
+
+
+class AddressBook(namedtuple('AddressBook', 'first_pk first_user per_user')):
+    # Addresses made by seed_addresses for a contiguous range of users
+
+    def pk(self, user_id, address_type):
+        index = [choice[0] for choice in ADDRESS_CHOICES].index(address_type)
+        if index >= self.per_user:
+            return None
+        return (self.first_pk + (user_id - self.first_user) * self.per_user +
+                index)
+
+
+def _next_pk(model):
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+def _insert(model, rows, chunk_size=CHUNK_SIZE):
+    """
+    bulk_create an iterable of unsaved rows chunk by chunk, so generators
+    are never held in memory at once. Returns the number of rows.
+    """
+    rows = iter(rows)
+    inserted = 0
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return inserted
+        model.objects.bulk_create(chunk)
+        inserted += len(chunk)
+        # With DEBUG on every statement is kept in connection.queries
+        reset_queries()
+
+
+def _skewed(rng, count, skew):
+    # An index in range(count), low ones far more likely: a few best
+    # sellers and regulars, then a long tail
+    return int(count * rng.random() ** skew)
+
+
+def _price(rng):
+    # Log-normal, most items cost a few hundred, some several thousand
+    return min(max(int(rng.lognormvariate(6.5, 0.8)) // 10 * 10, 50), 50000)
+
+
+def reset_sequences(*models):
+    # Rows are inserted with explicit primary keys, so on PostgreSQL the
+    # id sequences have to be moved past them afterwards
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def seed_users(count, rng, prefix='seed', days=730):
+    User = get_user_model()
+    first = _next_pk(User)
+    password = make_password(None)
+    now = timezone.now()
+
+    def rows():
+        for pk in range(first, first + count):
+            yield User(
+                pk=pk, username=f'{prefix}{pk}',
+                email=f'{prefix}{pk}@example.com', password=password,
+                date_joined=now - timedelta(seconds=rng.randint(
+                    0, days * 86400)))
+
+    _insert(User, rows())
+    return range(first, first + count)
+
+
+def seed_items(count, rng, image='seed.jpg'):
+    first = _next_pk(Item)
+    catalog = Catalog(first, array('l'), array('l'))
+    categories = [choice[0] for choice in CATEGORY_CHOICES]
+
+    def rows():
+        for pk in range(first, first + count):
+            price = _price(rng)
+            discount_price = None
+            if rng.random() < 0.3:
+                discount_price = max(
+                    price * (100 - rng.choice((10, 15, 20, 30, 50))) //
+                    100 // 10 * 10, 10)
+            category = rng.choices(categories, CATEGORY_WEIGHTS)[0]
+            title = (f'{rng.choice(ADJECTIVES).title()} '
+                     f'{rng.choice(NOUNS.get(category, ("item",)))} {pk}')
+            catalog.prices.append(price)
+            catalog.discounts.append(discount_price or 0)
+            yield Item(
+                pk=pk,
+                title=title,
+                price=price,
+                discount_price=discount_price,
+                category=category,
+                label=rng.choice(LABEL_CHOICES)[0],
+                slug=f'item-{pk}',
+                description=(f'{title}, {rng.choice(ADJECTIVES)} and '
+                             f'{rng.choice(ADJECTIVES)}.'),
+                image=image,
+            )
+
+    _insert(Item, rows())
+    return catalog
+
+
+def seed_addresses(user_ids, rng, per_user=2):
+    """
+    Give each user in the contiguous range `user_ids` one default address
+    of each type, billing first, up to `per_user`.
+    """
+    first = _next_pk(Address)
+
+    def rows():
+        pk = first
+        for user_id in user_ids:
+            city = rng.choice(CITIES)
+            for n in range(per_user):
+                yield Address(
+                    pk=pk,
+                    user_id=user_id,
+                    street_address=f'{rng.randint(1, 999)} Seed Street',
+                    apartment_address=f'Apt {rng.randint(1, 99)}',
+                    city=city,
+                    country='BD',
+                    post_code=f'{rng.randint(1000, 9999)}',
+                    address_type=ADDRESS_CHOICES[n % len(ADDRESS_CHOICES)][0],
+                    default=n < len(ADDRESS_CHOICES),
+                )
+                pk += 1
+
+    _insert(Address, rows())
+    return AddressBook(first, user_ids[0] if user_ids else 0, per_user)
+
+
+def seed_coupons(count, rng):
+    first = _next_pk(Coupon)
+    coupons = Coupons(first, array('l'))
+
+    def rows():
+        for pk in range(first, first + count):
+            amount = rng.choice((50, 100, 100, 200, 250, 500))
+            coupons.amounts.append(amount)
+            yield Coupon(pk=pk, code=f'SEED{pk:06d}', amount=amount)
+
+    _insert(Coupon, rows())
+    return coupons
+
+
+def _order_status(rng):
+    # (being_delivered, received, refund_requested, refund_granted,
+    # refund row accepted or None)
+    roll = rng.random()
+    if roll < 0.01:
+        return True, True, True, False, False
+    if roll < 0.02:
+        return True, True, False, True, True
+    if roll < 0.025:
+        return True, True, False, False, False
+    if roll < 0.8:
+        return True, True, False, False, None
+    if roll < 0.92:
+        return True, False, False, False, None
+    return False, False, False, False, None
+
+
+def seed_orders(user_ids, catalog, count, rng, coupons=None, addresses=None,
+                open_ratio=0.05, max_lines=5, days=365,
+                chunk_size=CHUNK_SIZE):
+    """
+    Create `count` orders, oldest first over the last `days` days, for the
+    contiguous range `user_ids`, with their lines, payments and refunds.
+    Regular customers and best sellers come up far more often than the
+    rest. At most one order per user is left open, as the unique index on
+    open orders requires. Works through `chunk_size` orders at a time,
+    each committed on its own unless the caller holds a transaction, and
+    returns the number of rows made per model.
+    """
+    through = Order.items.through
+    order_pk = _next_pk(Order)
+    line_pk = _next_pk(OrderItem)
+    payment_pk = _next_pk(Payment)
+    refund_pk = _next_pk(Refund)
+    first_user = user_ids[0]
+    item_count = len(catalog.prices)
+    max_lines = min(max_lines, item_count)
+    now = timezone.now()
+    start = now - timedelta(days=days)
+    step = timedelta(days=days) / max(count, 1)
+    has_open = bytearray(len(user_ids))
+    totals = Counter()
+
+    for chunk_start in range(0, count, chunk_size):
+        payments, orders, lines, links, refunds = [], [], [], [], []
+        for n in range(chunk_start, min(chunk_start + chunk_size, count)):
+            user_index = _skewed(rng, len(user_ids), 1.5)
+            user_id = first_user + user_index
+            ordered = has_open[user_index] or rng.random() >= open_ratio
+            if not ordered:
+                has_open[user_index] = 1
+            order = Order(
+                pk=order_pk, user_id=user_id, ordered=ordered,
+                ordered_date=(start + step * n + timedelta(
+                    seconds=rng.randint(0, 3600)) if ordered else now))
+            if addresses is not None:
+                order.shipping_address_id = addresses.pk(user_id, 'S')
+                order.billing_address_id = addresses.pk(user_id, 'B')
+            if coupons and coupons.amounts and rng.random() < 0.08:
+                index = _skewed(rng, len(coupons.amounts), 2)
+                order.coupon_id = coupons.first_pk + index
+                order.coupon_total = coupons.amounts[index]
+
+            line_count = 1
+            while line_count < max_lines and rng.random() < 0.45:
+                line_count += 1
+            picked = set()
+            while len(picked) < line_count:
+                picked.add(_skewed(rng, item_count, 2))
+            for index in sorted(picked):
+                quantity = rng.choices((1, 2, 3), (80, 15, 5))[0]
+                price = catalog.prices[index]
+                discount = catalog.discounts[index]
+                order.subtotal += quantity * price
+                if discount:
+                    order.discount_total += quantity * (price - discount)
+                order.total_quantity += quantity
+                lines.append(OrderItem(
+                    pk=line_pk, user_id=user_id,
+                    item_id=catalog.first_pk + index, ordered=ordered,
+                    quantity=quantity,
+                    paid_price=quantity * (discount or price)
+                    if ordered else None))
+                links.append(through(order_id=order_pk, orderitem_id=line_pk))
+                line_pk += 1
+
+            if ordered:
+                order.ref_code = create_ref_code(rng)
+                (order.being_delivered, order.received,
+                 order.refund_requested, order.refund_granted,
+                 refund) = _order_status(rng)
+                payments.append(Payment(
+                    pk=payment_pk, stripe_charge_id=f'ch_seed_{payment_pk}',
+                    user_id=user_id, amount=max(
+                        order.subtotal - order.discount_total -
+                        order.coupon_total, 0)))
+                order.payment_id = payment_pk
+                payment_pk += 1
+                if refund is not None:
+                    refunds.append(Refund(
+                        pk=refund_pk, order_id=order_pk, accepted=refund,
+                        reason=rng.choice((
+                            'Wrong size', 'Arrived damaged',
+                            'Not as described', 'Changed my mind')),
+                        email=f'customer{user_id}@example.com'))
+                    refund_pk += 1
+            orders.append(order)
+            order_pk += 1
+
+        # Short transactions: one spanning millions of orders holds its
+        # locks and WAL until the very end
+        with transaction.atomic():
+            totals[Payment] += _insert(Payment, payments)
+            totals[Order] += _insert(Order, orders)
+            totals[OrderItem] += _insert(OrderItem, lines)
+            totals[through] += _insert(through, links)
+            totals[Refund] += _insert(Refund, refunds)
+    return totals
+
+
+def seed_shop(users=100, items=50, orders=500, coupons=10, seed=0,
+              addresses_per_user=2, days=365, progress=None):
+    """
+    Fill the database with a reproducible shop for benchmarks: the same
+    arguments on an empty database always produce the same rows, with
+    dates relative to the current time.
+    `progress(step, seconds)` is called after each step.
+    """
+    rng = random.Random(seed)
+    User = get_user_model()
+
+    def step(name, func, *args, **kwargs):
+        started = time.monotonic()
+        result = func(*args, **kwargs)
+        if progress is not None:
+            progress(name, time.monotonic() - started)
+        return result
+
+    user_ids = step('users', seed_users, users, rng)
+    catalog = step('items', seed_items, items, rng)
+    address_book = step('addresses', seed_addresses, user_ids, rng,
+                        per_user=addresses_per_user)
+    coupon_set = step('coupons', seed_coupons, coupons, rng)
+    if user_ids and catalog.prices:
+        step('orders', seed_orders, user_ids, catalog, orders, rng,
+             coupons=coupon_set, addresses=address_book, days=days)
+    reset_sequences(User, Item, Address, Coupon, Order, OrderItem, Payment,
+                    Refund)
+    # bulk_create skips the code that normally keeps the search index,
+    # facet counts, sales rollups and catalog cache up to date
+    step('search index', rebuild_index)
+    step('facet counts', rebuild_facet_counts)
+    step('sales rollups', rebuild_rollups)
+    bump_catalog_version()
+    return user_ids
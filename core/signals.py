@@ -0,0 +1,113 @@
+from allauth.account.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import (
+    post_delete, post_save, pre_delete, pre_save)
+from django.dispatch import receiver
+
+from . import coupons, facets, images, inventory, search
+from .cache import bump_catalog_version, invalidate_cart_summary
+from .cart import GuestCart, OrderBeingPaid, merge_quantities
+from .models import Coupon, Item, Order
+
+
+@receiver([post_save, post_delete], sender=Item)
+def item_changed(sender, instance, **kwargs):
+    # Bump after commit so a concurrent request can't re-cache the old rows
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=Item)
+def index_item(sender, instance, **kwargs):
+    # In the same transaction as the write, so a rollback undoes both
+    search.index_item(instance)
+
+
+@receiver(post_delete, sender=Item)
+def unindex_item(sender, instance, **kwargs):
+    search.unindex_item(instance.pk)
+
+
+@receiver(post_save, sender=Item)
+def build_image_variants(sender, instance, raw, **kwargs):
+    if not raw:
+        images.schedule_variants(instance)
+
+
+@receiver(pre_save, sender=Item)
+def remember_facets(sender, instance, raw, **kwargs):
+    if instance.pk and not raw:
+        instance._stored_facets = facets.stored_facet_values(instance.pk)
+
+
+@receiver(post_save, sender=Item)
+def update_facets(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    old = None if created else getattr(instance, '_stored_facets', None)
+    facets.update_facet_counts(old, facets.item_facet_values(instance))
+
+
+@receiver(pre_delete, sender=Item)
+def remove_facets(sender, instance, **kwargs):
+    # Deletes run in a transaction, which keeps the row locked
+    facets.update_facet_counts(facets.stored_facet_values(instance.pk),
+                               None)
+
+
+def _open_orders(instance):
+    if isinstance(instance, Item):
+        return Order.objects.filter(ordered=False, items__item=instance)
+    return Order.objects.filter(ordered=False, coupon=instance)
+
+
+@receiver(pre_delete, sender=Item)
+@receiver(pre_delete, sender=Coupon)
+def remember_open_orders(sender, instance, **kwargs):
+    # The rows linking the orders are gone by post_delete
+    instance._open_order_ids = list(
+        _open_orders(instance).values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_save, sender=Coupon)
+def update_open_order_totals(sender, instance, created, **kwargs):
+    # A price or coupon amount change moves the totals of open carts
+    if not created:
+        _open_orders(instance).update_totals()
+
+
+@receiver(post_delete, sender=Item)
+@receiver(post_delete, sender=Coupon)
+def update_orphaned_order_totals(sender, instance, **kwargs):
+    order_ids = getattr(instance, '_open_order_ids', None)
+    if order_ids:
+        Order.objects.filter(pk__in=order_ids).update_totals()
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+def coupon_changed(sender, instance, **kwargs):
+    coupons.invalidate(instance.code)
+
+
+@receiver([post_save, post_delete], sender=Order)
+def order_changed(sender, instance, **kwargs):
+    invalidate_cart_summary(instance.user_id)
+
+
+@receiver(pre_delete, sender=Order)
+def release_stock(sender, instance, **kwargs):
+    # Reservations are deleted with the order; their units go back first
+    inventory.release(instance)
+
+
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    # Fold the session cart into the user's open order in one transaction
+    guest_cart = GuestCart(request.session)
+    if guest_cart:
+        try:
+            merge_quantities(user, guest_cart.lines)
+        except OrderBeingPaid:
+            # Kept in the session until the next login
+            return
+        guest_cart.clear()
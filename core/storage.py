@@ -0,0 +1,44 @@
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+HASH_LENGTH = 12
+HASHED_NAME = re.compile(r'\.(?P<hash>[0-9a-f]{%d})(\.[^./]*)?$' % HASH_LENGTH)
+
+
+def content_hash(name):
+    """
+    The content hash embedded in a stored file name, or None for files
+    saved before HashedMediaStorage.
+    """
+    match = HASHED_NAME.search(os.path.basename(name))
+    return match.group('hash') if match else None
+
+
+class HashedMediaStorage(FileSystemStorage):
+    """
+    Saves uploads as name.<md5 prefix>.ext, so a file name never points at
+    different bytes and can be cached forever. Saving the same content
+    twice returns the existing file.
+    """
+
+    def hashed_name(self, name, content):
+        md5 = hashlib.md5()
+        for chunk in content.chunks():
+            md5.update(chunk)
+        content.seek(0)
+        root, ext = os.path.splitext(name)
+        return f'{root}.{md5.hexdigest()[:HASH_LENGTH]}{ext}'
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
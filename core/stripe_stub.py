@@ -0,0 +1,108 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from .payments import FAKE_DECLINED_TOKENS
+
+
+class StripeStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers POST /v1/charges the way the Stripe API does, with keep-alive,
+    idempotency keys, decline test tokens and injected latency and
+    failures, so the payment client can be benchmarked locally.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Request-Id', f'req_stub_{uuid.uuid4().hex[:14]}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, type, message, code=None):
+        self.send_json(status, {'error': {
+            'type': type, 'message': message, 'code': code}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = {key: values[0] for key, values in
+                  parse_qs(self.rfile.read(length).decode()).items()}
+        if self.path != '/v1/charges':
+            return self.send_error_json(
+                404, 'invalid_request_error', 'Unrecognized request URL')
+
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        roll = server.random()
+        if roll < server.error_rate / 2:
+            return self.send_error_json(
+                429, 'rate_limit_error', 'Too many requests', 'rate_limit')
+        elif roll < server.error_rate:
+            return self.send_error_json(
+                500, 'api_error', 'Stub server failure')
+
+        key = self.headers.get('Idempotency-Key')
+        with server.lock:
+            if key and key in server.charges:
+                return self.send_json(200, server.charges[key])
+        source = params.get('source')
+        if source in FAKE_DECLINED_TOKENS:
+            message, code = FAKE_DECLINED_TOKENS[source]
+            return self.send_error_json(402, 'card_error', message, code)
+        charge = {
+            'id': f'ch_stub_{uuid.uuid4().hex[:20]}',
+            'object': 'charge',
+            'amount': int(params.get('amount') or 0),
+            'currency': params.get('currency'),
+            'description': params.get('description'),
+            'paid': True,
+            'status': 'succeeded',
+        }
+        with server.lock:
+            server.charges[key or charge['id']] = charge
+            # Only the latest charges are kept for idempotent retries
+            while len(server.charges) > server.ledger_size:
+                server.charges.popitem(last=False)
+        self.send_json(200, charge)
+
+
+class StripeStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, error_rate=0.0, seed=None,
+                 ledger_size=10000):
+        super().__init__(address, StripeStubHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ledger_size = ledger_size
+        self.lock = threading.Lock()
+        self.charges = OrderedDict()
+        self._random = random.Random(seed)
+
+    def random(self):
+        with self.lock:
+            return self._random.random()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_stub_server(host='127.0.0.1', port=0, **kwargs):
+    server = StripeStubServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -6,8 +6,9 @@ register = template.Library()
 
 @register.filter
 def cart_item_count(user):
+    # Prefer the request-scoped {{ cart.item_count }} from the cart
+    # context processor; this filter queries on every use
     if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
+        return Order.items.through.objects.filter(
+            order__user=user, order__ordered=False).count()
     return 0
@@ -0,0 +1,58 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+register = template.Library()
+
+# Browsers without WebP support fall through to the last <img>
+SOURCE_FORMATS = ('webp',)
+FALLBACK_FORMAT = 'jpeg'
+# Width used for the plain src of the fallback <img>
+DEFAULT_WIDTH = 640
+
+
+def _variants(item):
+    manifest = item.get_image_variants()
+    if not item.image or manifest.get('source') != item.image.name:
+        return {}
+    by_format = {}
+    for variant in manifest.get('variants', []):
+        by_format.setdefault(variant['format'], []).append(variant)
+    return by_format
+
+
+def _srcset(variants):
+    return ', '.join(f"{default_storage.url(variant['name'])} "
+                     f"{variant['width']}w" for variant in variants)
+
+
+@register.simple_tag
+def image_srcset(item, fmt=FALLBACK_FORMAT):
+    return _srcset(_variants(item).get(fmt, []))
+
+
+@register.simple_tag
+def item_image(item, sizes='100vw', css_class=''):
+    """
+    A <picture> offering the item image's resized variants, e.g.
+    {% item_image item sizes="(min-width: 992px) 25vw, 100vw" css_class="img-fluid" %}.
+    Falls back to the original upload until the variants are built.
+    """
+    alt = f'Image: {item.title}'
+    variants = _variants(item)
+    fallback = variants.get(FALLBACK_FORMAT)
+    if not fallback:
+        return format_html('<img src="{}" alt="{}" class="{}" loading="lazy">',
+                           item.image.url, alt, css_class)
+
+    src = next((variant for variant in fallback
+                if variant['width'] >= DEFAULT_WIDTH), fallback[-1])
+    sources = format_html_join(
+        '', '<source type="image/{}" srcset="{}" sizes="{}">',
+        ((fmt, _srcset(variants[fmt]), sizes)
+         for fmt in SOURCE_FORMATS if fmt in variants))
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" alt="{}" '
+        'class="{}" loading="lazy"></picture>',
+        sources, default_storage.url(src['name']), _srcset(fallback),
+        sizes, alt, css_class)
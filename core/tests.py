@@ -1,3 +1,1523 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import random
+import subprocess
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.template import Context, RequestContext, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    budgets, cart, coupons, facets, images, inventory, jobs, metrics,
+    pagination, payments, rollups, search, seeding)
+from .cache import (
+    bump_catalog_version, catalog_page_key, get_catalog_version)
+from .models import (
+    Address, BulkOrderJob, ChargeJob, Coupon, CouponRedemption, CouponUsage,
+    DailySales, FacetCount, ImageVariantJob, Item, ItemSales, Order,
+    OrderItem, Payment, Refund, StockReservation)
+from .templatetags.image_tags import image_srcset
+
+# The manifest storage needs collectstatic to have run
+PLAIN_STATICFILES_STORAGE = (
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+
+
+def make_item(slug, price=100, discount_price=None):
+    return Item.objects.create(
+        title=slug, price=price, discount_price=discount_price,
+        category='S', label='P', slug=slug, description=slug,
+        image='hoodie.jpg')
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper')
+        self.shirt = make_item('shirt', price=100, discount_price=80)
+        self.hoodie = make_item('hoodie', price=250)
+
+    def assertWithinBudget(self, operation, *args):
+        with CaptureQueriesContext(connection) as ctx:
+            result = getattr(cart, operation)(self.user, *args)
+        queries = [q for q in ctx.captured_queries
+                   if 'SAVEPOINT' not in q['sql']]
+        self.assertLessEqual(len(queries), cart.QUERY_BUDGET[operation])
+        return result
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_add_item_creates_order_then_increments(self):
+        self.assertEqual(self.assertWithinBudget('add_item', 'shirt'),
+                         cart.ADDED)
+        self.assertEqual(self.assertWithinBudget('add_item', 'shirt'),
+                         cart.UPDATED)
+        self.assertEqual(self.assertWithinBudget('add_item', 'hoodie'),
+                         cart.ADDED)
+        order = self.get_order()
+        self.assertEqual(order.total_quantity, 3)
+        self.assertEqual(order.get_total(), 2 * 80 + 250)
+        order.check_totals()
+
+    def test_add_unknown_item(self):
+        with self.assertRaises(Item.DoesNotExist):
+            cart.add_item(self.user, 'missing')
+        self.assertFalse(Order.objects.exists())
+
+    def test_change_quantity(self):
+        cart.add_item(self.user, 'hoodie')
+        self.assertEqual(
+            self.assertWithinBudget('decrease_quantity', 'hoodie'),
+            cart.UNCHANGED)
+        self.assertEqual(
+            self.assertWithinBudget('increase_quantity', 'hoodie'),
+            cart.UPDATED)
+        self.assertEqual(self.get_order().total_quantity, 2)
+        self.assertEqual(
+            self.assertWithinBudget('decrease_quantity', 'hoodie'),
+            cart.UPDATED)
+        self.assertEqual(self.get_order().get_total(), 250)
+
+    def test_remove_item(self):
+        cart.add_item(self.user, 'shirt')
+        cart.add_item(self.user, 'hoodie')
+        self.assertEqual(self.assertWithinBudget('remove_item', 'shirt'),
+                         cart.REMOVED)
+        self.assertEqual(self.assertWithinBudget('remove_item', 'shirt'),
+                         cart.NOT_IN_CART)
+        order = self.get_order()
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(order.get_total(), 250)
+
+    def test_no_open_order(self):
+        for operation in ('remove_item', 'increase_quantity',
+                          'decrease_quantity'):
+            self.assertEqual(self.assertWithinBudget(operation, 'shirt'),
+                             cart.NO_ORDER)
+
+    def test_set_quantities(self):
+        cart.add_item(self.user, 'shirt')
+        order = cart.set_quantities(self.user, {'shirt': 0, 'hoodie': 3})
+        self.assertEqual(order.total_quantity, 3)
+        self.assertEqual(order.get_total(), 750)
+        order = cart.set_quantities(self.user, {'shirt': 2, 'hoodie': 1})
+        self.assertEqual(order.get_total(), 2 * 80 + 250)
+        self.get_order().check_totals()
+
+    def test_set_quantities_rejects_unknown_items(self):
+        cart.add_item(self.user, 'shirt')
+        with self.assertRaises(Item.DoesNotExist):
+            cart.set_quantities(self.user, {'shirt': 5, 'missing': 1})
+        self.assertEqual(self.get_order().total_quantity, 1)
+
+    @override_settings(CART_MAX_LINE_QUANTITY=10)
+    def test_update_cart_limits_quantities(self):
+        self.client.force_login(self.user)
+
+        def update(quantity):
+            return self.client.post(
+                reverse('core:update-cart'), content_type='application/json',
+                data={'changes': [{'slug': 'shirt', 'quantity': quantity}]})
+
+        for quantity in (11, 10 ** 12, -1):
+            response = update(quantity)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('from 0 to 10', response.json()['error'])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(update(10).json()['total_quantity'], 10)
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('shopper')
+        make_item('shirt', price=100)
+        cart.add_item(self.user, 'shirt')
+
+    def render_twice(self):
+        # The navbar badge and a second template on the same request
+        request = RequestFactory().get('/')
+        request.user = self.user
+        request.session = {}
+        return [
+            Template(source).render(RequestContext(request))
+            for source in ('{{ cart.item_count }}',
+                           '{{ cart.item_count }}:{{ cart.total }}')]
+
+    def test_loaded_once_per_request(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render_twice(), ['1', '1:100'])
+
+    @override_settings(CART_SUMMARY_CACHE_TIMEOUT=60)
+    def test_cached_until_the_cart_changes(self):
+        with self.assertNumQueries(1):
+            self.render_twice()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.render_twice(), ['1', '1:100'])
+        make_item('hoodie', price=250)
+        # The test transaction never commits, so run the callbacks now
+        with mock.patch('django.db.transaction.on_commit',
+                        lambda func, using=None: func()):
+            cart.add_item(self.user, 'hoodie')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render_twice(), ['2', '2:350'])
+
+
+@override_settings(STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class GuestCartTests(TestCase):
+    def setUp(self):
+        make_item('shirt', price=100, discount_price=80)
+        make_item('hoodie', price=250)
+
+    def visit(self, name, slug):
+        return self.client.get(reverse(name, args=[slug]))
+
+    def test_cart_lives_in_the_session(self):
+        self.visit('core:add-to-cart', 'shirt')
+        self.visit('core:add-to-cart', 'shirt')
+        self.visit('core:add-item-quantity-in-cart', 'shirt')
+        response = self.client.post(
+            reverse('core:update-cart'), content_type='application/json',
+            data={'changes': [{'slug': 'hoodie', 'quantity': 2}]})
+        self.assertEqual(response.json()['total_quantity'], 5)
+        self.assertEqual(cart.GuestCart(self.client.session).lines,
+                         {'shirt': 3, 'hoodie': 2})
+        self.assertContains(self.client.get(reverse('core:order-summary')),
+                            'hoodie')
+        self.assertFalse(Order.objects.exists())
+
+    def test_full_cart_fits_in_the_cookie(self):
+        slugs = [f'{n:03}-{"x" * 46}' for n in range(cart.MAX_BATCH_CHANGES)]
+        for slug in slugs:
+            make_item(slug)
+        response = self.client.post(
+            reverse('core:update-cart'), content_type='application/json',
+            data={'changes': [
+                {'slug': slug, 'quantity': settings.CART_MAX_LINE_QUANTITY}
+                for slug in slugs]})
+        self.assertEqual(response.status_code, 200)
+        # Only the session key goes to the browser
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME]
+        self.assertLess(len(cookie.OutputString()), 200)
+        self.assertTrue(Session.objects.filter(pk=cookie.value).exists())
+        self.assertEqual(len(cart.GuestCart(self.client.session)),
+                         len(slugs))
+
+    def test_login_merges_into_the_open_order(self):
+        user = get_user_model().objects.create_user('shopper',
+                                                    password='secret')
+        cart.add_item(user, 'shirt')
+        self.visit('core:add-to-cart', 'shirt')
+        self.visit('core:add-to-cart', 'hoodie')
+        # The merge hangs off allauth's login signal
+        response = self.client.post(reverse('account_login'), {
+            'login': 'shopper', 'password': 'secret'})
+        self.assertEqual(response.status_code, 302)
+
+        order = Order.objects.get(user=user)
+        self.assertEqual(
+            dict(order.items.values_list('item__slug', 'quantity')),
+            {'shirt': 2, 'hoodie': 1})
+        self.assertEqual(order.get_total(), 2 * 80 + 250)
+        self.assertEqual(len(cart.GuestCart(self.client.session)), 0)
+
+
+class OrderTotalsAnnotationTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        items = [make_item('plain', price=100),
+                 make_item('zero-discount', price=120, discount_price=0),
+                 make_item('discounted', price=300, discount_price=250)]
+        big_coupon = Coupon.objects.create(code='BIG', amount=1000)
+        small_coupon = Coupon.objects.create(code='SMALL', amount=50)
+        for n, coupon in enumerate((None, small_coupon, big_coupon, None)):
+            user = User.objects.create_user(f'shopper{n}')
+            order = Order.objects.create(user=user, coupon=coupon,
+                                         ordered_date=timezone.now())
+            # The last order has no lines at all
+            for quantity, item in enumerate(items[:3 - n], start=1):
+                order.items.add(OrderItem.objects.create(
+                    user=user, item=item, quantity=quantity + n))
+        # The stored totals are left at zero
+
+    @override_settings(ORDER_TOTALS_CHECK=False)
+    def test_matches_python_totals(self):
+        orders = list(Order.objects.with_totals().order_by('pk'))
+        for order in orders:
+            expected = order.recompute_totals()
+            self.assertEqual(order.get_computed_totals(), expected)
+            total = (expected['subtotal'] - expected['discount_total'] -
+                     expected['coupon_total'])
+            self.assertEqual(order.get_total(), max(total, 0))
+            self.assertEqual(order.get_total_quantity(),
+                             expected['total_quantity'])
+        self.assertEqual([order.get_total() for order in orders],
+                         [100 + 2 * 120 + 3 * 250, 2 * 100 + 3 * 120 - 50, 0, 0])
+
+    def test_paid_orders_keep_their_totals(self):
+        order = Order.objects.order_by('pk').first()
+        order.update_totals()
+        # Bypasses the signal that updates open carts
+        Item.objects.update(price=1000)
+        with self.assertRaises(AssertionError):
+            order.get_total()
+        order.ordered = True
+        self.assertEqual(order.get_total(), 100 + 2 * 120 + 3 * 250)
+
+    def test_line_prices(self):
+        lines = OrderItem.objects.with_prices().select_related('item')
+        for line in lines:
+            unannotated = OrderItem(item=line.item, quantity=line.quantity)
+            self.assertEqual(line.get_final_price(),
+                             unannotated.get_final_price())
+        self.assertEqual(sorted(line.get_final_price() for line in lines),
+                         [100, 200, 240, 300, 360, 750])
+
+    def test_totals_check_uses_annotations(self):
+        Order.objects.update_totals()
+        with self.assertNumQueries(1):
+            orders = list(Order.objects.with_totals())
+            for order in orders:
+                order.check_totals()
+                order.get_total()
+
+
+@override_settings(STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = make_item('hoodie')
+
+    def test_saving_an_item_retires_cached_pages(self):
+        self.assertContains(self.client.get(reverse('core:home')), 'hoodie')
+        # Bypasses the signal, so the cached page is still served
+        Item.objects.update(title='Winter hoodie')
+        self.assertNotContains(self.client.get(reverse('core:home')),
+                               'Winter hoodie')
+        # The test transaction never commits, so run the callbacks now
+        with mock.patch('django.db.transaction.on_commit',
+                        lambda func, using=None: func()):
+            self.item.title = 'Winter hoodie'
+            self.item.save()
+        self.assertContains(self.client.get(reverse('core:home')),
+                            'Winter hoodie')
+
+    def test_bumps_past_the_current_version(self):
+        version = get_catalog_version()
+        # A clock behind the one that set the version
+        with mock.patch('core.cache._initial_version', return_value=0):
+            bump_catalog_version()
+            bump_catalog_version()
+        self.assertEqual(get_catalog_version(), version + 2)
+
+    def test_page_keys_fit_memcached(self):
+        page_key = 'q=winter hood&category=S:cursor:' + 'x' * 200
+        key = catalog_page_key(page_key)
+        self.assertLessEqual(len(key), 250)
+        self.assertNotRegex(key, r'\s')
+        self.assertNotEqual(catalog_page_key(page_key + 'y'), key)
+
+
+@override_settings(QUERY_BUDGET_RAISE=True, STRIPE_BACKEND='fake',
+                   FAKE_STRIPE_LATENCY=0, CHARGE_JOBS_EAGER=True,
+                   STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class QueryBudgetTests(TestCase):
+    """
+    Walks through every budgeted view; QueryBudgetMiddleware raises
+    QueryBudgetExceeded as soon as one goes over budget.
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'shopper', password='secret', is_staff=True, is_superuser=True)
+        for n in range(3):
+            make_item(f'item-{n}', price=100 + n)
+        Coupon.objects.create(code='SAVE10', amount=10)
+        self.client.login(username='shopper', password='secret')
+
+    def get(self, name, *args, **kwargs):
+        return self.client.get(reverse(name, args=args), **kwargs)
+
+    def post(self, name, *args, **kwargs):
+        return self.client.post(reverse(name, args=args), **kwargs)
+
+    def check_out(self):
+        self.post('core:checkout', data={
+            'shipping_address': '1 Main Street',
+            'shipping_address2': 'Apt 1',
+            'shipping_country': 'BD',
+            'shipping_city': 'Dhaka',
+            'shipping_post': '1000',
+            'same_billing_address': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_shopping_views(self):
+        self.get('core:home')
+        self.get('core:home', data={'category': 'S'})
+        self.get('core:search', data={'q': 'item'})
+        self.get('core:product', 'item-0')
+        for slug in ('item-0', 'item-1', 'item-2'):
+            self.get('core:add-to-cart', slug)
+        self.get('core:add-item-quantity-in-cart', 'item-0')
+        self.get('core:reduce-item-quantity-in-cart', 'item-0')
+        self.post('core:update-cart', content_type='application/json',
+                  data={'changes': [{'slug': 'item-1', 'quantity': 3},
+                                    {'slug': 'item-2', 'quantity': 2}]})
+        self.get('core:remove-item-in-cart', 'item-2')
+        self.get('core:remove-from-cart', 'item-1')
+        self.get('core:order-summary')
+        self.get('core:checkout')
+        self.check_out()
+        self.post('core:add-coupon', 'checkout', data={'code': 'SAVE10'})
+        self.get('core:payment', 'stripe')
+        response = self.post('core:payment', 'stripe',
+                             data={'stripeToken': 'tok_visa'})
+        self.client.get(response['Location'])
+        order = Order.objects.get(user=self.user, ordered=True)
+        self.get('core:request-refund')
+        self.post('core:request-refund', data={
+            'ref_code': order.ref_code, 'email': 'shopper@example.com',
+            'message': 'Wrong size'})
+
+    def test_update_cart_batches(self):
+        for n in range(3, 8):
+            make_item(f'item-{n}')
+
+        def update(quantities):
+            response = self.post('core:update-cart',
+                                 content_type='application/json', data={
+                                     'changes': [
+                                         {'slug': slug, 'quantity': quantity}
+                                         for slug, quantity in
+                                         quantities.items()]})
+            self.assertEqual(response.status_code, 200)
+            return response.json()
+
+        # New lines, into a new order then an existing one
+        update({'item-0': 1, 'item-1': 2})
+        data = update({f'item-{n}': 1 for n in range(2, 8)})
+        self.assertEqual(data['item_count'], 8)
+        update({f'item-{n}': 2 for n in range(8)})
+        # Removals
+        data = update({f'item-{n}': 0 for n in range(1, 8)})
+        self.assertEqual((data['item_count'], data['total_quantity']),
+                         (1, 2))
+
+    def test_order_admin(self):
+        for slug in ('item-0', 'item-1'):
+            self.get('core:add-to-cart', slug)
+        self.check_out()
+        self.post('core:payment', 'stripe', data={'stripeToken': 'tok_visa'})
+        self.get('core:add-to-cart', 'item-2')
+        response = self.get('admin:core_order_changelist')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 2)
+        response = self.get('admin:core_order_changelist',
+                            data={'username': 'nobody'})
+        self.assertEqual(response.context['cl'].result_count, 0)
+        response = self.get('admin:core_dailysales_changelist')
+        self.assertEqual(response.context['totals']['orders'], 1)
+        self.assertEqual(response.context['top_items'][0]['units'], 1)
+
+    def test_over_budget(self):
+        budget = {'core:product': budgets.Budget(1, 0)}
+        with mock.patch.dict(budgets.VIEW_QUERY_BUDGETS, budget):
+            with self.assertRaises(budgets.QueryBudgetExceeded):
+                self.get('core:product', 'item-0')
+            with self.settings(QUERY_BUDGET_RAISE=False):
+                with self.assertLogs('core.budgets', 'WARNING'):
+                    response = self.get('core:product', 'item-0')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('queries', response['Server-Timing'])
+
+    def test_every_view_has_a_budget(self):
+        core = get_resolver().namespace_dict['core'][1]
+        names = {f'core:{name}' for name in core.reverse_dict
+                 if isinstance(name, str)}
+        self.assertEqual(names - set(budgets.VIEW_QUERY_BUDGETS), set())
+
+
+@override_settings(METRICS_TOKEN=None,
+                   STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class MetricsTests(TestCase):
+    def test_needs_a_token_in_production(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+    def test_merges_processes(self):
+        registry = metrics.Registry()
+        hits = metrics.Counter('hits_total', 'Hits.', registry=registry)
+        latency = metrics.Histogram('latency_seconds', 'Latency.',
+                                    buckets=(0.1, 1.0), registry=registry)
+        hits.inc(2, page='home')
+        latency.observe(0.05)
+        latency.observe(2.0)
+        with tempfile.TemporaryDirectory() as directory:
+            # What another worker process left behind
+            with open(os.path.join(directory, '1.json'), 'w') as f:
+                json.dump(registry.collect(), f)
+            with self.settings(METRICS_DIR=directory):
+                text = metrics.render(registry.gather())
+        self.assertIn('hits_total{page="home"} 4', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count 4', text)
+
+    def test_exited_processes_are_compacted(self):
+        registry = metrics.Registry()
+        hits = metrics.Counter('hits_total', 'Hits.', registry=registry)
+        hits.inc(3)
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            for pid in (exited.pid, 1):
+                with open(os.path.join(directory, f'{pid}.json'), 'w') as f:
+                    json.dump(registry.collect(), f)
+            with self.settings(METRICS_DIR=directory):
+                for _ in range(2):
+                    text = metrics.render(registry.gather())
+                    self.assertIn('hits_total 9', text)
+                self.assertEqual(
+                    sorted(name for name in os.listdir(directory)
+                           if name.endswith('.json')),
+                    sorted(['1.json', f'{os.getpid()}.json',
+                            metrics.EXITED_FILE]))
+
+    @override_settings(DEBUG=True)
+    def test_endpoint(self):
+        self.client.get(reverse('core:home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'http_request_duration_seconds_count{method="GET",status="2xx",'
+            'view="core:home"}', response.content.decode())
+        self.client.generic('BREW', reverse('core:home'))
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('method="other"', content)
+        self.assertNotIn('BREW', content)
+        with self.settings(METRICS_TOKEN='s3cret'):
+            self.assertEqual(
+                self.client.get(reverse('metrics')).status_code, 403)
+            self.assertEqual(self.client.get(
+                reverse('metrics'), HTTP_AUTHORIZATION='Bearer nope'
+            ).status_code, 403)
+            response = self.client.get(
+                reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200)
+
+
+class MediaTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = self.settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        for name in ('hoodie.jpg', 'hoodie.0123456789ab.jpg'):
+            with open(os.path.join(directory.name, name), 'wb') as f:
+                f.write(b'0123456789')
+
+    def get(self, name, **headers):
+        return self.client.get(reverse('media', args=[name]), **headers)
+
+    def test_whole_file(self):
+        response = self.get('hoodie.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'],
+                         f'public, max-age={settings.MEDIA_MAX_AGE}')
+        self.assertEqual(self.get('missing.jpg').status_code, 404)
+        self.assertEqual(self.get('../manage.py').status_code, 404)
+
+    def test_etag(self):
+        response = self.get('hoodie.0123456789ab.jpg')
+        self.assertEqual(response['ETag'], '"0123456789ab"')
+        self.assertIn('immutable', response['Cache-Control'])
+        # Unhashed names fall back to size and mtime
+        etag = self.get('hoodie.jpg')['ETag']
+        self.assertRegex(etag, r'^"a-[0-9a-f]+"$')
+
+        response = self.get('hoodie.jpg', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        response = self.get('hoodie.jpg', HTTP_IF_NONE_MATCH=f'W/{etag}')
+        self.assertEqual(response.status_code, 304)
+        response = self.get('hoodie.jpg', HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_ranges(self):
+        for header, body, content_range in (
+                ('bytes=2-5', b'2345', 'bytes 2-5/10'),
+                ('bytes=7-', b'789', 'bytes 7-9/10'),
+                ('bytes=-3', b'789', 'bytes 7-9/10'),
+                ('bytes=8-100', b'89', 'bytes 8-9/10')):
+            response = self.get('hoodie.jpg', HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), body)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(response['Content-Length'], str(len(body)))
+        # Several ranges, or a stale If-Range, get the whole file
+        response = self.get('hoodie.jpg', HTTP_RANGE='bytes=0-1,4-5')
+        self.assertEqual(response.status_code, 200)
+        response = self.get('hoodie.jpg', HTTP_RANGE='bytes=2-5',
+                            HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        for header in ('bytes=10-', 'bytes=20-30', 'bytes=-0'):
+            response = self.get('hoodie.jpg', HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */10')
+
+
+@override_settings(IMAGE_VARIANT_WIDTHS=(160, 320),
+                   IMAGE_VARIANT_FORMATS=('webp', 'jpeg'))
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media_root = self.settings(MEDIA_ROOT=directory.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def upload(self, color):
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 200), color).save(buffer, 'JPEG')
+        return default_storage.save('photo.jpg',
+                                    ContentFile(buffer.getvalue()))
+
+    def render(self, item):
+        return Template('{% load image_tags %}{% item_image item %}').render(
+            Context({'item': item}))
+
+    def test_worker_builds_the_variants(self):
+        item = make_item('photo')
+        item.image = self.upload('red')
+        item.save()
+        job = ImageVariantJob.objects.get(item=item)
+        self.assertEqual(job.source, item.image.name)
+        # The original upload until the worker gets to it
+        self.assertHTMLEqual(
+            self.render(item),
+            f'<img src="{item.image.url}" alt="Image: {item.title}" '
+            f'class="" loading="lazy">')
+
+        self.assertEqual(images.run_pending_variants(), 1)
+        self.assertFalse(ImageVariantJob.objects.exists())
+        item.refresh_from_db()
+        manifest = item.get_image_variants()
+        self.assertEqual(manifest['source'], item.image.name)
+        self.assertEqual((manifest['width'], manifest['height']), (400, 200))
+        self.assertEqual(
+            [(v['width'], v['height'], v['format'])
+             for v in manifest['variants']],
+            [(160, 80, 'webp'), (160, 80, 'jpeg'), (320, 160, 'webp'),
+             (320, 160, 'jpeg'), (400, 200, 'webp'), (400, 200, 'jpeg')])
+        for variant in manifest['variants']:
+            self.assertTrue(default_storage.exists(variant['name']))
+        html = self.render(item)
+        self.assertIn('<source type="image/webp"', html)
+        self.assertIn(f'srcset="{image_srcset(item, "webp")}"', html)
+
+    def test_replaced_image_variants_are_deleted(self):
+        item, twin = make_item('photo'), make_item('twin')
+        for each in (item, twin):
+            each.image = self.upload('red')
+            each.save()
+        images.run_pending_variants()
+        item.refresh_from_db()
+        old = [v['name'] for v in item.get_image_variants()['variants']]
+
+        item.image = self.upload('blue')
+        item.save()
+        images.run_pending_variants()
+        # The twin still shows the red files
+        for name in old:
+            self.assertTrue(default_storage.exists(name))
+
+        twin.refresh_from_db()
+        twin.image = item.image.name
+        twin.save()
+        images.run_pending_variants()
+        for name in old:
+            self.assertFalse(default_storage.exists(name))
+        item.refresh_from_db()
+        for variant in item.get_image_variants()['variants']:
+            self.assertTrue(default_storage.exists(variant['name']))
+
+    def test_failing_jobs_stop_after_the_last_attempt(self):
+        item = make_item('photo')
+        item.image = 'missing.jpg'
+        item.save()
+        for attempt in range(1, settings.IMAGE_JOB_MAX_ATTEMPTS + 1):
+            with self.assertLogs('core.images', 'ERROR'):
+                self.assertIsNotNone(images.run_variant_job())
+            job = ImageVariantJob.objects.get(item=item)
+            self.assertEqual(job.attempts, attempt)
+            self.assertIsNone(job.locked_at)
+            self.assertIn('missing.jpg', job.error)
+        self.assertIsNone(images.run_variant_job())
+        # A new image starts over
+        item.image = self.upload('red')
+        item.save()
+        self.assertEqual(images.run_pending_variants(), 1)
+        self.assertFalse(ImageVariantJob.objects.exists())
+
+
+@override_settings(STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class HomePaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.items = [make_item(f'item-{n:02}') for n in range(12)]
+
+    def get(self, **params):
+        return self.client.get(reverse('core:home'), params)
+
+    def test_keyset_pages(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get()
+        self.assertFalse([query for query in queries
+                          if 'COUNT(' in query['sql'].upper()])
+        for item in self.items[:10]:
+            self.assertContains(response, item.title)
+        self.assertNotContains(response, 'item-10')
+        self.assertNotContains(response, 'page=')
+        next_cursor = pagination.encode_cursor('next', [self.items[9].pk])
+        self.assertContains(response, f'cursor={next_cursor}')
+
+        response = self.get(cursor=next_cursor)
+        self.assertContains(response, 'item-10')
+        self.assertContains(response, 'item-11')
+        self.assertNotContains(response, 'item-09')
+        previous_cursor = pagination.encode_cursor(
+            'prev', [self.items[10].pk])
+        self.assertContains(response, f'cursor={previous_cursor}')
+
+        response = self.get(cursor=previous_cursor)
+        self.assertContains(response, 'item-00')
+        self.assertContains(response, 'item-09')
+        self.assertNotContains(response, 'item-10')
+
+    def test_malformed_cursor(self):
+        for cursor in ('not-a-cursor', 'x' * 300,
+                       pagination.encode_cursor('sideways', [1]),
+                       pagination.encode_cursor('next', [1, 2]),
+                       pagination.encode_cursor('next', ['abc']),
+                       pagination.encode_cursor('next', [[1]])):
+            self.assertEqual(self.get(cursor=cursor).status_code, 404)
+
+
+@override_settings(STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class SearchTests(TestCase):
+    def setUp(self):
+        self.hoodie = Item.objects.create(
+            title='Winter hoodie', price=900, category='S', label='P',
+            slug='winter-hoodie', image='hoodie.jpg',
+            description='A warm <b>fleece</b> hoodie for the cold months.')
+        self.scarf = Item.objects.create(
+            title='Wool scarf', price=300, category='S', label='P',
+            slug='wool-scarf', image='scarf.jpg',
+            description='Goes well with a hoodie.')
+
+    def slugs(self, query):
+        return [item.slug for item in search.search_items(query)]
+
+    def test_follows_saves_and_deletes(self):
+        self.assertEqual(self.slugs('fleece'), ['winter-hoodie'])
+        self.hoodie.title = 'Summer tee'
+        self.hoodie.description = 'Light cotton.'
+        self.hoodie.save()
+        self.assertEqual(self.slugs('fleece'), [])
+        self.assertEqual(self.slugs('cotton'), ['winter-hoodie'])
+        self.hoodie.delete()
+        self.assertEqual(self.slugs('cotton'), [])
+        self.assertEqual(self.slugs('scarf'), ['wool-scarf'])
+
+    def test_ranks_title_matches_first(self):
+        results = search.search_items('hoodie')
+        self.assertEqual([item.slug for item in results],
+                         ['winter-hoodie', 'wool-scarf'])
+        self.assertGreater(results[0].search_rank, results[1].search_rank)
+        # Every term must match, the last one as a prefix
+        self.assertEqual(self.slugs('winter hood'), ['winter-hoodie'])
+        self.assertEqual(self.slugs('hoodie wool'), ['wool-scarf'])
+
+    def test_highlights_matches_in_an_escaped_snippet(self):
+        snippet = search.search_items('fleece')[0].search_snippet
+        self.assertIn('&lt;b&gt;<mark>fleece</mark>&lt;/b&gt;', snippet)
+        self.assertNotIn('<b>', snippet)
+        response = self.client.get(reverse('core:search'), {'q': 'fleece'})
+        self.assertContains(response, '<mark>fleece</mark>')
+
+    def test_parse_terms(self):
+        self.assertEqual(search.parse_terms('Red, HOODIE!'),
+                         ['red', 'hoodie'])
+        self.assertEqual(search.parse_terms('" OR * -:()'), ['or'])
+        for query in ('', '   ', '!!! ... ***'):
+            self.assertEqual(search.parse_terms(query), [])
+            with self.assertNumQueries(0):
+                self.assertEqual(search.search_items(query), [])
+        self.assertEqual(len(search.parse_terms('a ' * 50)),
+                         search.MAX_TERMS)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        for n, (category, label, price, discount) in enumerate((
+                ('S', 'P', 100, None), ('S', 'S', 700, 450),
+                ('SW', 'P', 1200, None), ('SW', 'D', 3000, 2000),
+                ('OW', 'P', 6000, 0), ('S', 'P', 800, None))):
+            Item.objects.create(
+                title=f'item {n}', price=price, discount_price=discount,
+                category=category, label=label, slug=f'item-{n}',
+                description='', image='item.jpg')
+
+    def stored(self):
+        return sorted(FacetCount.objects.filter(count__gt=0).values_list(
+            'category', 'label', 'price', 'discount', 'count'))
+
+    def test_counts_follow_the_filters(self):
+        for filters in ({}, {'category': 'S'}, {'label': 'P'},
+                        {'category': 'SW', 'discount': '1'},
+                        {'price': '500-1000', 'label': 'P'}):
+            counts = facets.get_facet_counts(filters)
+            for name, _, choices in facets.FACETS:
+                for value, _ in choices:
+                    # What the listing would show with this option picked
+                    listed = facets.filter_items(
+                        Item.objects.all(), {**filters, name: value})
+                    self.assertEqual(counts[name][value], listed.count(),
+                                     (filters, name, value))
+
+    def test_incremental_updates_match_rebuild(self):
+        item = Item.objects.get(slug='item-0')
+        item.category, item.price = 'OW', 2600
+        item.save()
+        item.discount_price = 900
+        item.save()
+        item.title = 'Renamed'
+        item.save()
+        Item.objects.get(slug='item-3').delete()
+        Item.objects.filter(slug='item-4').delete()
+        make_item('late', price=5000)
+        incremental = self.stored()
+        facets.rebuild_facet_counts()
+        self.assertEqual(self.stored(), incremental)
+        self.assertEqual(sum(row[-1] for row in incremental),
+                         Item.objects.count())
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        for n in range(5):
+            make_item(f'item-{n}')
+
+    def paginator(self, queryset):
+        paginator = pagination.EstimatedCountPaginator(queryset, 2)
+        paginator.estimate_threshold = 3
+        paginator.count_limit = 4
+        return paginator
+
+    def test_estimate_for_unfiltered_lists(self):
+        items = Item.objects.order_by('pk')
+        with mock.patch.object(pagination, 'estimate_count',
+                               return_value=1000):
+            self.assertEqual(self.paginator(items).count, 1000)
+            self.assertEqual(
+                self.paginator(items.filter(price=100)).count, 4)
+        with mock.patch.object(pagination, 'estimate_count',
+                               return_value=None):
+            self.assertEqual(self.paginator(items).count, 4)
+
+
+@override_settings(BULK_JOB_BATCH_SIZE=2, BULK_JOBS_EAGER=False,
+                   STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+class BulkOrderJobTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'secret')
+        for n in range(5):
+            user = User.objects.create_user(f'shopper{n}')
+            Order.objects.create(user=user, ordered=True,
+                                 ordered_date=timezone.now(),
+                                 refund_requested=n != 2)
+        self.client.login(username='admin', password='secret')
+
+    def run_action(self, query_string, select_across, pks):
+        changelist = reverse('admin:core_order_changelist')
+        return self.client.post(f'{changelist}?{query_string}', {
+            'action': 'accept_refund',
+            'select_across': select_across,
+            'index': '0',
+            '_selected_action': pks,
+        }, follow=True)
+
+    def test_runs_in_batches_and_resumes(self):
+        response = self.run_action(
+            'refund_requested__exact=1', '1',
+            Order.objects.values_list('pk', flat=True))
+        self.assertContains(response, 'will run in the background')
+        job = BulkOrderJob.objects.get()
+        # The filters are stored, not a query object
+        self.assertEqual(json.loads(job.selection),
+                         {'filters': 'refund_requested__exact=1'})
+        self.assertEqual(Order.objects.filter(refund_granted=True).count(), 0)
+
+        job = jobs.run_bulk_order_job(max_batches=1)
+        self.assertEqual((job.status, job.processed, job.total),
+                         ('pending', 2, 4))
+        self.assertEqual(Order.objects.filter(refund_granted=True).count(), 2)
+        # Picks up after the checkpoint
+        job = jobs.run_bulk_order_job()
+        self.assertEqual((job.status, job.processed), ('done', 4))
+        self.assertEqual(job.get_progress(), 100)
+        self.assertEqual(
+            set(Order.objects.filter(refund_granted=True).values_list(
+                'refund_requested', flat=True)), {False})
+        self.assertEqual(Order.objects.filter(refund_granted=True).count(), 4)
+        self.assertIsNone(jobs.run_bulk_order_job())
+
+    def test_selections(self):
+        pks = list(Order.objects.order_by('pk').values_list('pk', flat=True))
+        self.run_action('', '0', pks[:2])
+        self.run_action('username=shopper4&q=shopper', '1', pks)
+        self.assertEqual(
+            [json.loads(job.selection) for job in
+             BulkOrderJob.objects.order_by('pk')],
+            [{'pks': pks[:2]}, {'filters': 'username=shopper4&q=shopper'}])
+        self.assertEqual(jobs.run_bulk_order_job().processed, 2)
+        self.assertEqual(jobs.run_bulk_order_job().processed, 1)
+        self.assertEqual(
+            set(Order.objects.filter(refund_granted=True).values_list(
+                'user__username', flat=True)),
+            {'shopper0', 'shopper1', 'shopper4'})
+
+    def test_bad_filters_fail_the_job(self):
+        job = jobs.enqueue_bulk_order_job(
+            'accept_refund', {'filters': 'no_such_field=1'}, self.admin)
+        with self.assertLogs('core.jobs', 'ERROR'):
+            job = jobs.run_bulk_order_job(job.pk)
+        self.assertEqual(job.status, 'failed')
+        self.assertFalse(Order.objects.filter(refund_granted=True).exists())
+
+
+@override_settings(STRIPE_BACKEND='fake', FAKE_STRIPE_LATENCY=0,
+                   CHARGE_JOBS_EAGER=False)
+class ChargeJobTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('shopper')
+        self.cheap = make_item('cheap', price=100)
+        self.pricey = make_item('pricey', price=900)
+        cart.add_item(self.user, 'cheap')
+        self.order = Order.objects.get(user=self.user)
+        self.job = jobs.enqueue_charge(self.order, 'tok_visa')
+
+    def test_cart_is_locked_while_charging(self):
+        self.assertEqual(self.job.amount, 100)
+        self.assertEqual(cart.add_item(self.user, 'pricey'),
+                         cart.PAYMENT_PENDING)
+        self.assertEqual(cart.remove_item(self.user, 'cheap'),
+                         cart.PAYMENT_PENDING)
+        with self.assertRaises(cart.OrderBeingPaid):
+            cart.set_quantities(self.user, {'pricey': 1})
+
+        job = jobs.run_charge_job()
+        self.assertEqual(job.status, 'succeeded')
+        order = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(order.ordered)
+        self.assertEqual((order.get_total(), order.payment.amount),
+                         (100, 100))
+        self.assertEqual(cart.add_item(self.user, 'pricey'), cart.ADDED)
+
+    def test_changed_order_is_not_charged(self):
+        # A line slipping past the cart lock fails the job uncharged
+        line = OrderItem.objects.create(user=self.user, item=self.pricey)
+        self.order.items.add(line)
+        self.order.update_totals()
+        job = jobs.run_charge_job()
+        self.assertEqual((job.status, job.error, job.charge_id),
+                         ('failed', jobs.ORDER_CHANGED_MESSAGE, ''))
+        self.assertFalse(Order.objects.get(pk=self.order.pk).ordered)
+        self.assertFalse(Payment.objects.exists())
+        # The shopper can pay the new total
+        job = jobs.enqueue_charge(self.order, 'tok_visa')
+        self.assertEqual(job.amount, 1000)
+
+    @override_settings(STRIPE_BACKEND='fake', FAKE_STRIPE_LATENCY=0)
+    def test_price_change_during_the_charge_is_refunded(self):
+        fake = payments.FakeStripe()
+        create_charge = payments.create_charge
+
+        def charge_then_reprice(**params):
+            Item.objects.filter(pk=self.cheap.pk).update(price=50)
+            return create_charge(**params)
+
+        with mock.patch.object(payments, '_fake_stripe', fake), \
+                mock.patch.object(payments, 'create_charge',
+                                  charge_then_reprice):
+            job = jobs.run_charge_job()
+        charge = fake.charges[job.idempotency_key]
+        self.assertEqual((job.status, job.charge_id, job.error),
+                         ('failed', charge['id'],
+                          jobs.CHARGED_ORDER_CHANGED_MESSAGE))
+        refund = fake.refunds[f'{job.idempotency_key}-refund']
+        self.assertEqual((job.refund_id, refund['charge'], refund['amount']),
+                         (refund['id'], charge['id'], 100))
+        self.assertTrue(charge['refunded'])
+        self.assertFalse(Order.objects.get(pk=self.order.pk).ordered)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_failed_refund_is_logged(self):
+        def charge_then_reprice(**params):
+            Item.objects.filter(pk=self.cheap.pk).update(price=50)
+            return {'id': 'ch_repriced'}
+
+        with mock.patch.object(payments, 'create_charge',
+                               charge_then_reprice), \
+                mock.patch.object(payments, 'refund_charge', side_effect=(
+                    payments.stripe.error.APIConnectionError('down'))), \
+                self.assertLogs('core.jobs', 'ERROR'):
+            job = jobs.run_charge_job()
+        self.assertEqual((job.status, job.charge_id, job.refund_id),
+                         ('failed', 'ch_repriced', ''))
+        self.assertEqual(job.error, jobs.REFUND_FAILED_MESSAGE)
+
+    @override_settings(STRIPE_BACKEND='fake', FAKE_STRIPE_LATENCY=0)
+    def test_retries_back_off(self):
+        error = payments.stripe.error.APIConnectionError('down')
+        with mock.patch.object(payments, 'create_charge',
+                               side_effect=error):
+            job = jobs.run_charge_job()
+            self.assertEqual(job.status, 'pending')
+            delay = (job.run_after - timezone.now()).total_seconds()
+            self.assertTrue(settings.CHARGE_JOB_RETRY_DELAY / 2 - 1 < delay
+                            <= settings.CHARGE_JOB_RETRY_DELAY)
+            # Not handed out again before then
+            self.assertIsNone(jobs.run_charge_job())
+        ChargeJob.objects.filter(pk=job.pk).update(
+            run_after=timezone.now())
+        job = jobs.run_charge_job()
+        self.assertEqual((job.status, job.attempts), ('succeeded', 2))
+
+
+class PaymentTests(TestCase):
+    def setUp(self):
+        payments.configure_http_client()
+        sleep = mock.patch.object(payments.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def flaky(self, *errors):
+        # Raises each of `errors` in turn, then charges
+        return mock.Mock(side_effect=[*errors, {'id': 'ch_ok'}])
+
+    def test_retry_budget(self):
+        budget = payments.RetryBudget(ratio=0.5, min_retries=1, window=10)
+        with mock.patch.object(payments.time, 'monotonic', return_value=100):
+            for _ in range(4):
+                budget.record_call()
+            # min_retries plus half of the four calls
+            self.assertEqual([budget.try_spend() for _ in range(4)],
+                             [True, True, True, False])
+        # The window moved past all of them
+        with mock.patch.object(payments.time, 'monotonic', return_value=111):
+            self.assertEqual([budget.try_spend() for _ in range(2)],
+                             [True, False])
+
+    def test_retryable_errors_are_retried(self):
+        error = payments.stripe.error
+        func = self.flaky(error.APIConnectionError('down'),
+                          error.RateLimitError('slow down'))
+        self.assertEqual(payments.call_stripe('charge.create', func),
+                         {'id': 'ch_ok'})
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_other_errors_are_not_retried(self):
+        error = payments.stripe.error
+        for e, retry in ((error.CardError('declined', None, 'card_declined'),
+                          True),
+                         (error.InvalidRequestError('bad', 'amount'), True),
+                         (error.APIConnectionError('down'), False)):
+            func = self.flaky(e)
+            with self.assertRaises(type(e)):
+                payments.call_stripe('charge.create', func, retry=retry)
+            self.assertEqual(func.call_count, 1)
+        self.sleep.assert_not_called()
+
+    @override_settings(STRIPE_MAX_RETRIES=2)
+    def test_retries_stop(self):
+        down = payments.stripe.error.APIConnectionError('down')
+        func = self.flaky(down, down, down)
+        with self.assertRaises(type(down)):
+            payments.call_stripe('charge.create', func)
+        self.assertEqual(func.call_count, 3)
+        # Or sooner, once the process is out of retries
+        func = self.flaky(down)
+        with mock.patch.object(payments, '_retry_budget',
+                               payments.RetryBudget(0, 0, 10)), \
+                self.assertRaises(type(down)):
+            payments.call_stripe('charge.create', func)
+        self.assertEqual(func.call_count, 1)
+
+    @override_settings(STRIPE_RETRY_BASE_DELAY=0.25,
+                       STRIPE_RETRY_MAX_DELAY=2.0)
+    def test_retry_delay_is_jittered(self):
+        with mock.patch.object(payments.random, 'uniform',
+                               return_value=0.1) as uniform:
+            for attempt, ceiling in ((0, 0.25), (1, 0.5), (3, 2.0),
+                                     (6, 2.0)):
+                self.assertEqual(payments.retry_delay(attempt), 0.1)
+                uniform.assert_called_with(0, ceiling)
+        delays = {payments.retry_delay(3) for _ in range(20)}
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(0 <= delay <= 2.0 for delay in delays))
+
+    def test_is_retryable(self):
+        error = payments.stripe.error
+        for e, retryable in (
+                (error.APIError('oops', http_status=500), True),
+                (error.APIError('oops', http_status=None), True),
+                (error.APIError('oops', http_status=400), False),
+                (error.RateLimitError('slow down'), True),
+                (error.APIConnectionError('down'), True),
+                (error.CardError('declined', None, 'card_declined'), False),
+                (error.InvalidRequestError('bad', 'amount'), False),
+                (error.AuthenticationError('bad key'), False),
+                (ValueError('bug'), False)):
+            self.assertIs(payments.is_retryable(e), retryable, e)
+
+    @override_settings(STRIPE_CONNECT_TIMEOUT=1.5, STRIPE_READ_TIMEOUT=7,
+                       STRIPE_POOL_SIZE=4)
+    def test_http_client(self):
+        self.addCleanup(payments.configure_http_client, force=True)
+        payments.configure_http_client(force=True)
+        client = payments.stripe.default_http_client
+        self.assertEqual(client._timeout, (1.5, 7))
+        adapter = client._session.get_adapter('https://api.stripe.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertEqual(adapter.max_retries.total, 0)
+        self.assertEqual(payments.stripe.max_network_retries, 0)
+        # Kept for the process, rebuilt in a forked one
+        payments.configure_http_client()
+        self.assertIs(payments.stripe.default_http_client, client)
+        with mock.patch.object(payments.os, 'getpid', return_value=-1):
+            payments.configure_http_client()
+        self.assertIsNot(payments.stripe.default_http_client, client)
+
+    def test_fake_ledger_is_capped(self):
+        fake = payments.FakeStripe(ledger_size=2)
+        charges = [fake.create_charge(100, 'usd', 'tok_visa', '',
+                                      idempotency_key=f'key-{n}')
+                   for n in range(3)]
+        self.assertEqual(list(fake.charges), ['key-1', 'key-2'])
+        self.assertIs(fake.create_charge(100, 'usd', 'tok_visa', '',
+                                         idempotency_key='key-2'),
+                      charges[2])
+        fake.create_refund(charges[2]['id'], idempotency_key='refund')
+        with self.assertRaises(payments.stripe.error.InvalidRequestError):
+            fake.create_refund(charges[0]['id'])
+        fake.clear()
+        self.assertEqual((fake.charges, fake.refunds), ({}, {}))
+
+
+class OrderExportTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'secret')
+        shirt = Item.objects.create(title='Shirt', price=500,
+                                    discount_price=400, category='S',
+                                    label='P', slug='shirt',
+                                    description='A shirt', image='shirt.jpg')
+        for n in range(3):
+            user = User.objects.create_user(f'shopper{n}')
+            address = Address.objects.create(
+                user=user, street_address='=1+1', apartment_address='',
+                city='Dhaka', country='BD', post_code='1000',
+                address_type='S')
+            line = OrderItem.objects.create(user=user, item=shirt,
+                                            ordered=True, quantity=n + 1)
+            payment = Payment.objects.create(stripe_charge_id=f'ch_{n}',
+                                             user=user, amount=400 * (n + 1))
+            order = Order.objects.create(
+                user=user, ordered=True, ordered_date=timezone.now(),
+                shipping_address=address, payment=payment,
+                subtotal=500 * (n + 1), discount_total=100 * (n + 1),
+                total_quantity=n + 1)
+            order.items.add(line)
+        Refund.objects.create(order=order, reason='Too big', accepted=True,
+                              email='shopper2@example.com')
+        Order.objects.create(user=self.admin, ordered_date=timezone.now())
+
+    def test_command_jsonl(self):
+        out = io.StringIO()
+        # One cursor over the orders, lines and refunds once per chunk
+        with self.assertNumQueries(5):
+            call_command('export_orders', format='jsonl', chunk_size=2,
+                         stdout=out)
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([r['username'] for r in records],
+                         ['shopper0', 'shopper1', 'shopper2'])
+        last = records[-1]
+        self.assertEqual(last['total'], 1200)
+        self.assertEqual(last['items'][0]['quantity'], 3)
+        self.assertEqual(last['payment']['charge_id'], 'ch_2')
+        self.assertEqual(last['refunds'][0]['reason'], 'Too big')
+        self.assertEqual(last['shipping_address']['city'], 'Dhaka')
+
+    @override_settings(STATICFILES_STORAGE=PLAIN_STATICFILES_STORAGE)
+    def test_admin_action_csv(self):
+        self.client.login(username='admin', password='secret')
+        response = self.client.post(reverse('admin:core_order_changelist'), {
+            'action': 'export_orders_csv',
+            'index': '0',
+            '_selected_action': Order.objects.values_list('pk', flat=True),
+        })
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(
+            b''.join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['items'], 'shirt x1')
+        self.assertEqual(rows[2]['refunds_accepted'], '1')
+        # Formulas are escaped, numbers are not
+        self.assertEqual(rows[0]['shipping_street_address'], "'=1+1")
+        self.assertEqual(rows[0]['total'], '400')
+
+
+class SeedingTests(TestCase):
+    def test_orders_are_committed_chunk_by_chunk(self):
+        rng = random.Random(0)
+        users = seeding.seed_users(5, rng)
+        catalog = seeding.seed_items(5, rng)
+        insert = seeding._insert
+        calls = []
+
+        def fail_in_the_third_chunk(model, rows, **kwargs):
+            calls.append(model)
+            if calls.count(OrderItem) == 3:
+                raise IntegrityError('lost connection')
+            return insert(model, rows, **kwargs)
+
+        with mock.patch.object(seeding, '_insert', fail_in_the_third_chunk), \
+                self.assertRaises(IntegrityError):
+            seeding.seed_orders(users, catalog, 100, rng, chunk_size=20)
+        # The first two chunks stay, whole
+        self.assertEqual(Order.objects.count(), 40)
+        self.assertFalse(OrderItem.objects.filter(order__isnull=True).exists())
+        self.assertEqual(Payment.objects.count(),
+                         Order.objects.filter(ordered=True).count())
+
+
+class SalesRollupTests(TestCase):
+    def snapshot(self):
+        return (
+            list(DailySales.objects.order_by('day').values_list(
+                'day', *rollups.DAILY_FIELDS)),
+            list(ItemSales.objects.order_by('day', 'item_id').values_list(
+                'day', 'item_id', 'units', 'revenue')),
+            list(CouponUsage.objects.order_by('coupon_id').values_list(
+                'coupon_id', 'orders', 'amount')),
+        )
+
+    def test_incremental_updates_match_rebuild(self):
+        seeding.seed_shop(users=20, items=10, orders=200, coupons=3)
+        paid = Order.objects.filter(ordered=True)
+        daily = self.snapshot()[0]
+        self.assertEqual(sum(row[1] for row in daily), paid.count())
+
+        jobs.enqueue_bulk_order_job(
+            'accept_refund', {'filters': 'refund_requested__exact=1'})
+        jobs.enqueue_bulk_order_job(
+            'revert_refund_to_pending', {'pks': list(range(1, 51))})
+        jobs.run_bulk_order_job()
+        jobs.run_bulk_order_job()
+        order = Order.objects.filter(ordered=False).first()
+        job = ChargeJob.objects.create(
+            order=order, user_id=order.user_id, idempotency_key='new',
+            amount=order.get_total())
+        jobs.complete_order(job, 'ch_new')
+
+        self.assertTrue(paid.filter(refund_granted=True).exists())
+        incremental = self.snapshot()
+        rollups.rebuild_rollups(chunk_size=7)
+        self.assertEqual(self.snapshot(), incremental)
+        report = rollups.sales_report(days=366)
+        self.assertEqual(report['totals']['orders'], paid.count())
+        self.assertEqual(report['totals']['refunds'],
+                         paid.filter(refund_granted=True).count())
+
+    def pay(self, order, key):
+        job = ChargeJob.objects.create(
+            order=order, user_id=order.user_id, idempotency_key=key,
+            amount=order.get_total())
+        jobs.complete_order(job, f'ch_{key}')
+
+    def test_rebuild_keeps_changes_made_during_the_scan(self):
+        seeding.seed_shop(users=20, items=10, orders=200, coupons=3)
+        scanned = Order.objects.filter(pk__lte=100)
+
+        def change_orders(done, last):
+            if done != 100:
+                return
+            # An order already scanned is refunded, another one paid, and
+            # one placed after the scan began is paid
+            refunded = Order.objects.filter(pk=scanned.filter(
+                ordered=True, refund_granted=False).first().pk)
+            rollups.record_refund_changes(refunded, True)
+            refunded.update(refund_granted=True)
+            self.pay(scanned.filter(ordered=False).first(), 'old')
+            order = Order.objects.create(
+                user=get_user_model().objects.create_user('late'),
+                ordered_date=timezone.now())
+            order.items.add(OrderItem.objects.create(
+                user=order.user, item=Item.objects.first(), quantity=2))
+            order.update_totals()
+            self.pay(order, 'new')
+
+        before = self.snapshot()
+        rollups.rebuild_rollups(chunk_size=100, progress=change_orders)
+        after = self.snapshot()
+        self.assertNotEqual(after, before)
+        self.assertEqual(sum(row[1] for row in after[0]),
+                         Order.objects.filter(ordered=True).count())
+        # Nothing to correct any more
+        rollups.rebuild_rollups(chunk_size=100)
+        self.assertEqual(self.snapshot(), after)
+
+    def test_price_changes_leave_past_sales_alone(self):
+        item = make_item('shirt', price=100)
+        user = get_user_model().objects.create_user('shopper')
+        order = Order.objects.create(user=user, ordered_date=timezone.now())
+        order.items.add(OrderItem.objects.create(user=user, item=item,
+                                                 quantity=2))
+        order.update_totals()
+        self.pay(order, 'shirt')
+        Item.objects.filter(pk=item.pk).update(price=300)
+        rollups.rebuild_rollups()
+        self.assertEqual(
+            list(ItemSales.objects.values_list('units', 'revenue')),
+            [(2, 200)])
+
+
+@override_settings(STRIPE_BACKEND='fake', FAKE_STRIPE_LATENCY=0,
+                   CHARGE_JOBS_EAGER=True)
+class CouponTests(TestCase):
+    def setUp(self):
+        coupons.clear_local_cache()
+        self.item = make_item('shirt', price=500)
+        self.coupon = Coupon.objects.create(code='FLASH', amount=100,
+                                            max_redemptions=2, max_per_user=1)
+
+    def make_order(self, username):
+        user = get_user_model().objects.create_user(username)
+        order = Order.objects.create(user=user, coupon=self.coupon,
+                                     ordered_date=timezone.now())
+        order.items.add(OrderItem.objects.create(user=user, item=self.item))
+        order.update_totals()
+        return order
+
+    def test_lookups_are_cached(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(coupons.find_coupon('FLASH').pk, self.coupon.pk)
+            self.assertIsNone(coupons.find_coupon('NOPE'))
+            self.assertIsNone(coupons.find_coupon('not a code'))
+        coupons.clear_local_cache()
+        with self.assertNumQueries(0):
+            self.assertEqual(coupons.find_coupon('FLASH').amount, 100)
+            self.assertIsNone(coupons.find_coupon('NOPE'))
+        # Saving drops both the shared and the local copy
+        Coupon.objects.create(code='NOPE', amount=5)
+        self.assertEqual(coupons.find_coupon('NOPE').amount, 5)
+
+    def test_validity(self):
+        user = get_user_model().objects.create_user('shopper')
+        now = timezone.now()
+        for fields, message in (
+                ({'active': False}, 'does not exist'),
+                ({'valid_until': now}, 'expired'),
+                ({'valid_from': now + timezone.timedelta(hours=1)},
+                 'not valid yet'),
+                ({'redemptions': 2}, 'run out')):
+            coupon = Coupon(code='X', amount=1, max_redemptions=2, **fields)
+            with self.assertRaisesMessage(coupons.CouponUnavailable,
+                                          message):
+                coupons.check_coupon(coupon, user, now=now)
+        coupons.check_coupon(self.coupon, user)
+
+    def test_redemptions_never_pass_the_limit(self):
+        first, second, third = (self.make_order(name)
+                                for name in ('ann', 'bob', 'cat'))
+        jobs.enqueue_charge(first, 'tok_visa')
+        # A declined charge gives its redemption back
+        job = jobs.enqueue_charge(second, 'tok_chargeDeclined')
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(Coupon.objects.get().redemptions, 1)
+        jobs.enqueue_charge(third, 'tok_visa')
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.redemptions, 2)
+
+        with self.assertRaisesMessage(coupons.CouponUnavailable, 'run out'):
+            jobs.enqueue_charge(second, 'tok_visa')
+        second.refresh_from_db()
+        self.assertIsNone(second.coupon)
+        self.assertEqual(second.get_total(), 500)
+        self.assertEqual(CouponRedemption.objects.count(), 2)
+        self.assertEqual(Coupon.objects.get().redemptions, 2)
+
+    def test_per_user_limit(self):
+        self.coupon.max_redemptions = None
+        self.coupon.save()
+        order = self.make_order('ann')
+        jobs.enqueue_charge(order, 'tok_visa')
+        again = Order.objects.create(user=order.user, coupon=self.coupon,
+                                     ordered_date=timezone.now())
+        with self.assertRaisesMessage(coupons.CouponUnavailable,
+                                      'already used'):
+            coupons.check_coupon(self.coupon, order.user, again)
+        with self.assertRaises(coupons.CouponUnavailable):
+            coupons.redeem(again)
+
+
+@override_settings(STRIPE_BACKEND='fake', FAKE_STRIPE_LATENCY=0,
+                   CHARGE_JOBS_EAGER=True)
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.item = make_item('drop', price=300)
+        inventory.set_stock(self.item, 5, shards=4)
+        self.ann, self.bob = (get_user_model().objects.create_user(name)
+                              for name in ('ann', 'bob'))
+
+    def stock(self):
+        return inventory.stock_level(self.item.pk)
+
+    def held(self, status='reserved'):
+        return sum(StockReservation.objects.filter(
+            status=status).values_list('quantity', flat=True))
+
+    def test_cart_reserves_and_releases(self):
+        cart.set_quantities(self.ann, {'drop': 4})
+        # Took the last units of several shards
+        self.assertEqual((self.stock(), self.held()), (1, 4))
+        with self.assertRaisesMessage(inventory.OutOfStock, 'drop'):
+            cart.set_quantities(self.bob, {'drop': 2})
+        self.assertFalse(OrderItem.objects.filter(user=self.bob).exists())
+        self.assertEqual(cart.add_item(self.bob, 'drop'), cart.ADDED)
+        self.assertEqual(cart.add_item(self.bob, 'drop'), cart.OUT_OF_STOCK)
+        self.assertEqual(cart.increase_quantity(self.ann, 'drop'),
+                         cart.OUT_OF_STOCK)
+        self.assertEqual(OrderItem.objects.get(user=self.bob).quantity, 1)
+        self.assertEqual(OrderItem.objects.get(user=self.ann).quantity, 4)
+
+        cart.decrease_quantity(self.ann, 'drop')
+        self.assertEqual((self.stock(), self.held()), (1, 4))
+        cart.remove_item(self.ann, 'drop')
+        Order.objects.filter(user=self.bob).delete()
+        self.assertEqual((self.stock(), self.held()), (5, 0))
+
+    def test_payment_commits_the_stock(self):
+        cart.set_quantities(self.ann, {'drop': 2})
+        order = Order.objects.get(user=self.ann)
+        job = jobs.enqueue_charge(order, 'tok_visa')
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual((self.stock(), self.held('committed')), (3, 2))
+        self.assertIsNone(StockReservation.objects.get().expires_at)
+        # Sold units never expire
+        later = timezone.now() + timezone.timedelta(days=1)
+        self.assertEqual(inventory.release_expired(now=later), 0)
+
+    def test_expired_reservations_are_swept(self):
+        cart.set_quantities(self.ann, {'drop': 2})
+        self.assertEqual(inventory.release_expired(), 0)
+        later = timezone.now() + timezone.timedelta(
+            seconds=settings.INVENTORY_RESERVATION_TIMEOUT + 1)
+        self.assertEqual(inventory.release_expired(now=later), 1)
+        self.assertEqual((self.stock(), self.held()), (5, 0))
+
+        # Paying takes the units again, if there are any left
+        order = Order.objects.get(user=self.ann)
+        cart.set_quantities(self.bob, {'drop': 4})
+        with self.assertRaisesMessage(inventory.OutOfStock, 'drop'):
+            jobs.enqueue_charge(order, 'tok_visa')
+        self.assertFalse(ChargeJob.objects.exists())
+        cart.remove_item(self.bob, 'drop')
+        jobs.enqueue_charge(order, 'tok_visa')
+        self.assertEqual((self.stock(), self.held('committed')), (3, 2))
+
+    @override_settings(CHARGE_JOBS_EAGER=False)
+    def test_units_of_orders_being_charged_are_kept(self):
+        cart.set_quantities(self.ann, {'drop': 2})
+        order = Order.objects.get(user=self.ann)
+        jobs.enqueue_charge(order, 'tok_visa')
+        later = timezone.now() + timezone.timedelta(days=1)
+        self.assertEqual(inventory.release_expired(now=later), 0)
+        jobs.run_pending_charges()
+        self.assertEqual((self.stock(), self.held('committed')), (3, 2))
+
+    def test_shards_are_locked_in_order(self):
+        # Carts sharing items must lock their rows in the same order, or
+        # two of them can deadlock
+        other = make_item('other', price=100)
+        inventory.set_stock(other, 5, shards=4)
+        locked = []
+
+        def record(lock):
+            def wrapper(item_id, shard, quantity):
+                locked.append((item_id, shard))
+                return lock(item_id, shard, quantity)
+            return wrapper
+
+        # Without probes every reservation drains shards one by one
+        with mock.patch.object(inventory, 'PROBES', 0), \
+                mock.patch.object(inventory, '_take',
+                                  record(inventory._take)), \
+                mock.patch.object(inventory, '_give_back',
+                                  record(inventory._give_back)):
+            cart.set_quantities(self.ann, {'other': 3, 'drop': 3})
+            self.assertEqual(len(locked), 4)
+            self.assertEqual(locked, sorted(locked))
+            del locked[:]
+            cart.set_quantities(self.ann, {'other': 0, 'drop': 0})
+            self.assertEqual(len(locked), 4)
+            self.assertEqual(locked, sorted(locked))
+
+            order = Order.objects.get(user=self.ann)
+            cart.set_quantities(self.ann, {'other': 1})
+            # Lines changed behind the cart's back; the payment puts the
+            # reservations right
+            OrderItem.objects.filter(order=order).update(quantity=3)
+            order.items.add(OrderItem.objects.create(
+                user=self.ann, item=self.item, quantity=2))
+            del locked[:]
+            inventory.reserve_order(order)
+            self.assertEqual(len(locked), 3)
+            self.assertEqual(locked, sorted(locked))
+        self.assertEqual((self.stock(), inventory.stock_level(other.pk)),
+                         (3, 2))
+
+    def test_untracked_items_never_run_out(self):
+        make_item('shirt')
+        cart.set_quantities(self.ann, {'shirt': 1000})
+        self.assertEqual(cart.add_item(self.ann, 'shirt'), cart.UPDATED)
+        self.assertFalse(StockReservation.objects.exists())
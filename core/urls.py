@@ -2,16 +2,19 @@ from django.urls import path
 
 from .views import (
     HomeView,
+    SearchView,
     ItemDetailView,
     add_to_cart,
     remove_from_cart,
     OrderSummary,
     CheckoutView,
     PaymentView,
+    PaymentStatusView,
     RequestRefundView,
     add_item_quantity_in_cart,
     reduce_item_quantity_in_cart,
     remove_item_in_cart,
+    update_cart,
     add_coupon,
 )
 
@@ -20,10 +23,13 @@ app_name = 'core'
 
 urlpatterns = [
     path('', HomeView.as_view(), name='home'),
+    path('search/', SearchView.as_view(), name='search'),
     path('product/<slug>', ItemDetailView.as_view(), name='product'),
     path('order-summary/', OrderSummary.as_view(), name='order-summary'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
     path('payment/<payment_option>', PaymentView.as_view(), name='payment'),
+    path('payment/status/<int:pk>', PaymentStatusView.as_view(),
+         name='payment-status'),
     path('add-to-cart/<slug>', add_to_cart, name='add-to-cart'),
     path('remove-from-cart/<slug>', remove_from_cart, name='remove-from-cart'),
     path('add-item-quantity-in-cart/<slug>',
@@ -32,6 +38,7 @@ urlpatterns = [
          reduce_item_quantity_in_cart, name='reduce-item-quantity-in-cart'),
     path('remove-item-in-cart/<slug>',
          remove_item_in_cart, name='remove-item-in-cart'),
+    path('update-cart/', update_cart, name='update-cart'),
     path('add-coupon/<slug>', add_coupon,
          name='add-coupon'),
     path('request-refund/', RequestRefundView.as_view(), name='request-refund'),
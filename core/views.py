@@ -1,40 +1,121 @@
+from django.conf import settings
 from django.contrib import messages
 from django.views.generic import ListView, DetailView, View
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
-from django.conf import settings
-import stripe
-import random
-import string
+from django.db import transaction
+from django.views.decorators.http import require_POST
+import copy
+import json
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
-from .forms import CheckoutForm, CouponForm, RefundForm
+from .models import Item, Order, Address, Refund, ChargeJob
+from .forms import CheckoutForm, CouponForm, ItemFilterForm, RefundForm
 from django.core.exceptions import ObjectDoesNotExist
-from . import helpers
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
-
-
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+from . import budgets, cart, coupons, helpers, inventory, jobs, search
+from .cart import get_open_order
+from .cache import get_catalog_page, set_catalog_page
+from .facets import build_facets, filter_items, filter_query, get_facet_counts
+from .pagination import KeysetPaginationMixin
 
 
-class HomeView(ListView):
+class HomeView(KeysetPaginationMixin, ListView):
     model = Item
     paginate_by = 10
     template_name = 'home.html'
+    catalog_template_name = 'snippets/catalog.html'
+    pagination_mode = 'keyset'
+
+    def get_filters(self):
+        form = ItemFilterForm(self.request.GET)
+        if not form.is_valid():
+            raise Http404('Invalid filter.')
+        return form.get_filters()
+
+    def get_queryset(self):
+        return filter_items(super().get_queryset(), self.filters)
+
+    def get_context_data(self, **kwargs):
+        # Counts come from the FacetCount table, not from the listing
+        kwargs.setdefault('facets', build_facets(
+            self.filters, get_facet_counts(self.filters)))
+        kwargs.setdefault('filter_query', filter_query(self.filters))
+        return super().get_context_data(**kwargs)
+
+    def get_catalog_page_key(self):
+        filters = filter_query(self.filters)
+        if self.get_pagination_mode() == 'keyset':
+            cursor = self.request.GET.get(self.cursor_kwarg) or ''
+            if len(cursor) > 200:
+                return None
+            return f'{filters}:cursor:{cursor}'
+        page = self.request.GET.get(self.page_kwarg) or 1
+        try:
+            return f'{filters}:page:{int(page)}'
+        except ValueError:
+            # Let 'last' and invalid values take the uncached path
+            return None
+
+    def render_catalog(self):
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        # Rendered without the request so no per-user data (cart badge,
+        # csrf token) ends up in the shared cached fragment
+        return render_to_string(self.catalog_template_name, context)
 
+    def get(self, request, *args, **kwargs):
+        self.filters = self.get_filters()
+        page_key = self.get_catalog_page_key()
+        catalog = None
+        if page_key is not None:
+            catalog = get_catalog_page(page_key)
+        if catalog is None:
+            catalog = self.render_catalog()
+            if page_key is not None:
+                set_catalog_page(page_key, catalog)
+        return render(request, self.template_name, {
+            'catalog': mark_safe(catalog),
+        })
+
+
+class SearchView(View):
+    template_name = 'search.html'
+    paginate_by = 12
+    max_page = 50
 
-class OrderSummary(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '').strip()
+        try:
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            raise Http404('Invalid page.')
+        # Ranking has to score every match, so deep offsets get no cheaper
+        if not 1 <= page <= self.max_page:
+            raise Http404('Invalid page.')
+        results = search.search_items(
+            query,
+            limit=self.paginate_by + 1,
+            offset=(page - 1) * self.paginate_by,
+        )
+        return render(request, self.template_name, {
+            'query': query,
+            'object_list': results[:self.paginate_by],
+            'page': page,
+            'has_next': (len(results) > self.paginate_by and
+                         page < self.max_page),
+        })
+
+
+class OrderSummary(View):
     def get(self, request, *args, **kwargs):
         context = {
             "order": None
         }
-        order_qs = Order.objects.filter(user=request.user, ordered=False)
-        if order_qs.exists():
-            context["order"] = order_qs[0]
+        context["order"] = cart.get_cart_order(request)
         return render(request, 'order_summary.html', context)
 
 
@@ -55,7 +136,9 @@ class CheckoutView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         try:
             # form
-            order = Order.objects.get(user=request.user, ordered=False)
+            order = get_open_order(request)
+            if order is None:
+                raise Order.DoesNotExist
             form = CheckoutForm()
             context = {
                 "form": form,
@@ -101,7 +184,6 @@ class CheckoutView(LoginRequiredMixin, View):
                     )
                     if address_qs.exists():
                         shipping_address = address_qs[0]
-                        shipping_address.save()
                     else:
                         messages.warning(
                             'No default shipping address available.')
@@ -146,9 +228,8 @@ class CheckoutView(LoginRequiredMixin, View):
                 # Check if billing address same as shipping address
                 # If so create a billing address the same as shipping but with pk:None
                 if same_billing_address:
-                    billing_address = shipping_address
+                    billing_address = copy.copy(shipping_address)
                     billing_address.pk = None
-                    billing_address.save()
                     billing_address.address_type = 'B'
                     billing_address.save()
                 elif use_default_billing:
@@ -160,7 +241,6 @@ class CheckoutView(LoginRequiredMixin, View):
                     )
                     if address_qs.exists():
                         billing_address = address_qs[0]
-                        billing_address.save()
                     else:
                         messages.warning(
                             'No default billing address available.')
@@ -224,7 +304,9 @@ class PaymentView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         if self.kwargs['payment_option'] == 'stripe':
             try:
-                order = Order.objects.get(user=request.user, ordered=False)
+                order = get_open_order(request)
+                if order is None:
+                    raise Order.DoesNotExist
                 if order.billing_address:
                     context = {
                         'order': order,
@@ -237,7 +319,7 @@ class PaymentView(LoginRequiredMixin, View):
                         request, "You have not added a billing address")
                     return redirect("core:checkout")
             except ObjectDoesNotExist:
-                message.error(request, "You do not have an active order")
+                messages.error(request, "You do not have an active order")
                 return redirect('/')
         else:
             messages.warning(request, "Invalid payment method")
@@ -245,222 +327,154 @@ class PaymentView(LoginRequiredMixin, View):
 
     def post(self, request, *args, **kwargs):
         if self.kwargs['payment_option'] == 'stripe':
-            order = Order.objects.get(user=request.user, ordered=False)
+            try:
+                order = Order.objects.get(user=request.user, ordered=False)
+            except ObjectDoesNotExist:
+                messages.warning(request, "You do not have an active order")
+                return redirect('/')
+            # `source` is obtained with Stripe.js; see https://stripe.com/docs/payments/accept-a-payment-charges#web-create-token
             token = self.request.POST.get('stripeToken')
-            amount = order.get_total()
-            description = f"Charge for {request.user.username} on order ID {order.id}"
+            # The charge itself runs in the background worker
             try:
-                print(
-                    f"amount: {amount}, source: {token}, description: {description}")
-                # `source` is obtained with Stripe.js; see https://stripe.com/docs/payments/accept-a-payment-charges#web-create-token
-                charge = stripe.Charge.create(
-                    amount=amount,
-                    currency="bdt",
-                    source=token,
-                    description=description,
-                )
-                order.ordered = True
-
-                # create payment
-                payment = Payment()
-                payment.stripe_charge_id = charge['id']
-                payment.user = request.user
-                payment.amount = amount
-                payment.save()
-
-                # assign payment to order
-                order.payment = payment
-                order.ref_code = create_ref_code()
-                order_items = order.items.all()
-                order_items.update(ordered=True)
-                for order_item in order_items:
-                    order_item.save()
-                order.save()
-
-                messages.success(request, "Your order was successful")
-
-            # Error handling
-            except stripe.error.CardError as e:
-                # Since it's a decline, stripe.error.CardError will be caught
-                # print('Status is: %s' % e.http_status)
-                # print('Type is: %s' % e.error.type)
-                # print('Code is: %s' % e.error.code)
-                # # param is '' in this case
-                # print('Param is: %s' % e.error.param)
-                # print('Message is: %s' % e.error.message)
-                messages.warning(request, f"{e.error.message}")
-
-            except stripe.error.RateLimitError as e:
-                # Too many requests made to the API too quickly
-                messages.warning(request, "Rate limit error")
-
-            except stripe.error.InvalidRequestError as e:
-                # Invalid parameters were supplied to Stripe's API
-                messages.warning(request, "Invalid parameters")
-            except stripe.error.AuthenticationError as e:
-                # Authentication with Stripe's API failed
-                # (maybe you changed API keys recently)
-                messages.warning(request, "Not authenticated")
-
-            except stripe.error.APIConnectionError as e:
-                # Network communication with Stripe failed
-                messages.warning(request, "Network error")
-
-            except stripe.error.StripeError as e:
-                # Display a very generic error to the user, and maybe send
-                # yourself an email
+                job = jobs.enqueue_charge(order, token)
+            except coupons.CouponUnavailable as e:
                 messages.warning(
-                    request, "Something went wrong. You were not charged. Please try again.")
-
-            except Exception as e:
-                # Something else happened, completely unrelated to Stripe
-                # TODO: send an email to ourselves because it is on our end
+                    request, f"{e} It was removed from your order, please "
+                    "check the new total.")
+                return redirect('core:payment', payment_option='stripe')
+            except inventory.OutOfStock as e:
                 messages.warning(
-                    request, "A serious error occured. Technical team has been automatically notified.")
-            finally:
-                return redirect('/')
+                    request, f"{e} Please update your cart.")
+                return redirect('core:order-summary')
+            return redirect('core:payment-status', pk=job.pk)
+        messages.warning(request, "Invalid payment method")
+        return redirect('core:checkout')
+
+
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(ChargeJob, pk=self.kwargs['pk'],
+                                user=request.user)
+        if request.GET.get('format') == 'json':
+            return JsonResponse({
+                'status': job.status,
+                'error': job.error,
+            })
+        if job.status == 'succeeded':
+            messages.success(request, "Your order was successful")
+            return redirect('/')
+        elif job.status == 'failed':
+            messages.warning(request, job.error)
+            return redirect('core:payment', payment_option='stripe')
+        return render(request, 'payment_status.html', {'job': job})
 
 
-@login_required
 def add_to_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # check if an unordered Order exists for user
-    order_item, created = OrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False
-    )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated.")
-            return redirect("core:product", slug=slug)
-        else:
-            messages.info(request, "This item was added to your cart.")
-            order.items.add(order_item)
-            order_item.quantity = 1
-            order_item.save()
-            return redirect("core:product", slug=slug)
+    try:
+        result = cart.for_request(request).add_item(slug)
+    except Item.DoesNotExist:
+        raise Http404("No Item matches the given query.")
+    if result == cart.OUT_OF_STOCK:
+        messages.warning(request, "Sorry, this item is out of stock.")
+    elif result == cart.PAYMENT_PENDING:
+        messages.warning(request, str(cart.OrderBeingPaid()))
+    elif result == cart.UPDATED:
+        messages.info(request, "This item quantity was updated.")
     else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
         messages.info(request, "This item was added to your cart.")
-        return redirect("core:product", slug=slug)
-
-
-@login_required
-def remove_from_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # check if an unordered Order exists for user
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item, _ = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False
-            )
-            order.items.remove(order_item)
-            messages.info(request, "This item was removed from your cart.")
-            return redirect("core:product", slug=slug)
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect("core:product", slug=slug)
+    return redirect("core:product", slug=slug)
+
+
+def _cart_miss(request, result, slug):
+    if result == cart.PAYMENT_PENDING:
+        messages.warning(request, str(cart.OrderBeingPaid()))
+        return redirect("core:order-summary")
+    if result == cart.OUT_OF_STOCK:
+        messages.warning(request, "Sorry, there are no more of this item.")
+        return redirect("core:order-summary")
+    if result == cart.NOT_IN_CART:
+        messages.info(request, "This item was not in your cart.")
     else:
         # add a message saying the user doesn't have an order
         messages.info(request, "You do not have an active order.")
+    return redirect("core:product", slug=slug)
+
+
+def remove_from_cart(request, slug):
+    result = cart.for_request(request).remove_item(slug)
+    if result == cart.REMOVED:
+        messages.info(request, "This item was removed from your cart.")
         return redirect("core:product", slug=slug)
+    return _cart_miss(request, result, slug)
 
 
-@login_required
 def reduce_item_quantity_in_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # check if an unordered order exists for user
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item, _ = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False
-            )
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-                messages.info(request, "This item quantity was updated.")
-                return redirect("core:order-summary")
-            else:
-                return redirect("core:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect("core:product", slug=slug)
-    else:
-        # add a message saying the user doesn't have an order
-        messages.info(request, "You do not have an active order.")
-        return redirect("core:product", slug=slug)
+    result = cart.for_request(request).decrease_quantity(slug)
+    if result == cart.UPDATED:
+        messages.info(request, "This item quantity was updated.")
+        return redirect("core:order-summary")
+    elif result == cart.UNCHANGED:
+        return redirect("core:order-summary")
+    return _cart_miss(request, result, slug)
 
 
-@login_required
 def add_item_quantity_in_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # check if an unordered order exists for user
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item, _ = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False
-            )
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "This item quantity was updated.")
-            return redirect("core:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect("core:product", slug=slug)
-    else:
-        # add a message saying the user doesn't have an order
-        messages.info(request, "You do not have an active order.")
-        return redirect("core:product", slug=slug)
+    result = cart.for_request(request).increase_quantity(slug)
+    if result == cart.UPDATED:
+        messages.info(request, "This item quantity was updated.")
+        return redirect("core:order-summary")
+    return _cart_miss(request, result, slug)
 
 
-@login_required
 def remove_item_in_cart(request, slug):
-    item = get_object_or_404(Item, slug=slug)
-    # check if an unordered Order exists for user
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item, _ = OrderItem.objects.get_or_create(
-                item=item,
-                user=request.user,
-                ordered=False
-            )
-            order.items.remove(order_item)
-            messages.info(request, "This item was removed from your cart.")
-            return redirect("core:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart.")
-            return redirect("core:product", slug=slug)
-    else:
-        # add a message saying the user doesn't have an order
-        messages.info(request, "You do not have an active order.")
-        return redirect("core:product", slug=slug)
+    result = cart.for_request(request).remove_item(slug)
+    if result == cart.REMOVED:
+        messages.info(request, "This item was removed from your cart.")
+        return redirect("core:order-summary")
+    return _cart_miss(request, result, slug)
+
+
+def _parse_cart_changes(body):
+    try:
+        changes = json.loads(body.decode())['changes']
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+        raise ValueError('Expected a JSON object with a "changes" list.')
+    if not isinstance(changes, list) or not changes:
+        raise ValueError('"changes" must be a non-empty list.')
+    if len(changes) > cart.MAX_BATCH_CHANGES:
+        raise ValueError(
+            f'At most {cart.MAX_BATCH_CHANGES} changes are accepted.')
+    quantities = {}
+    for change in changes:
+        try:
+            slug, quantity = change['slug'], change['quantity']
+        except (KeyError, TypeError):
+            raise ValueError('Each change needs a "slug" and a "quantity".')
+        if (not isinstance(slug, str) or not isinstance(quantity, int) or
+                isinstance(quantity, bool) or
+                not 0 <= quantity <= settings.CART_MAX_LINE_QUANTITY):
+            raise ValueError(
+                'Quantities must be whole numbers from 0 to '
+                f'{settings.CART_MAX_LINE_QUANTITY}.')
+        quantities[slug] = quantity
+    return quantities
+
+
+@require_POST
+def update_cart(request):
+    # Body: {"changes": [{"slug": "hoodie", "quantity": 2}, ...]}
+    # A quantity of 0 removes the line. All changes apply or none do.
+    try:
+        quantities = _parse_cart_changes(request.body)
+        budgets.allow(request, cart.new_line_queries(len(quantities)))
+        order = cart.for_request(request).set_quantities(quantities)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Item.DoesNotExist as e:
+        return JsonResponse({'error': f'Unknown items: {e}'}, status=400)
+    data = cart.CartSummary.from_order(order).as_dict()
+    data['total_quantity'] = order.get_total_quantity() if order else 0
+    return JsonResponse(data)
 
 
 @login_required
@@ -472,33 +486,25 @@ def add_coupon(request, slug):
             try:
                 code = form.cleaned_data.get('code')
                 order = Order.objects.get(user=request.user, ordered=False)
-                coupon = get_coupon(request, code, prev_path)
-                if coupon == None:
-                    raise ValueError
-                order.coupon = coupon
-                order.save()
+                coupon = coupons.find_coupon(code)
+                coupons.check_coupon(coupon, request.user, order)
+                with transaction.atomic():
+                    order.coupon = coupon
+                    order.save()
+                    order.update_totals()
                 messages.success(request, "Successfully added coupon")
                 return redirect(f'core:{helpers.replace_dash_with_slash(prev_path)}')
             except ObjectDoesNotExist:
                 messages.warning(request, "You do not have an active order.")
                 return redirect("/")
-            except ValueError:
-                messages.warning(request, "This coupon does not exist.")
+            except coupons.CouponUnavailable as e:
+                messages.warning(request, str(e))
                 return redirect(helpers.replace_dash_with_slash(prev_path))
     else:
         # TODO: raise error
         return None
 
 
-@login_required
-def get_coupon(request, code, prev_path):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
-        return
-
-
 class RequestRefundView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         form = RefundForm()
@@ -30,6 +30,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.budgets.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,6 +58,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'core.context_processors.cart',
             ],
         },
     },
@@ -75,6 +78,53 @@ DATABASES = {
 }
 
 
+# Database alias the sales dashboard reads the rollups from; production
+# points it at a replica when REPORTING_DATABASE_URL is set
+REPORTING_DATABASE = 'default'
+
+# Sessions, guest carts included (core.cart.GuestCart), stay on the server
+# so a full cart can't outgrow a cookie and a session can be revoked. Reads
+# come from the cache; only changes write to the database.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds a rendered catalog page is kept. Saving or deleting an Item
+# bumps the catalog version, which retires cached pages early.
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Seconds a user's cart summary (navbar badge) is cached between requests.
+# 0 disables it; only worth enabling with a memory-backed shared cache.
+CART_SUMMARY_CACHE_TIMEOUT = 0
+
+# Largest quantity of one item the cart update API accepts
+CART_MAX_LINE_QUANTITY = 100
+
+# Seconds coupons are cached by code in the shared cache, and unknown
+# codes remembered as such; each process also keeps the codes it looked
+# up for COUPON_LOCAL_CACHE_TIMEOUT. Saving a coupon invalidates it.
+COUPON_CACHE_TIMEOUT = 5 * 60
+COUPON_NEGATIVE_CACHE_TIMEOUT = 60
+COUPON_LOCAL_CACHE_TIMEOUT = 5
+
+# Stock of items with Item.stock_shards > 0 (core.inventory) is split over
+# that many rows; INVENTORY_SHARDS is what set_stock() uses by default.
+# Units in a cart are held for INVENTORY_RESERVATION_TIMEOUT seconds after
+# the last change, and for INVENTORY_PAYMENT_HOLD once payment starts;
+# the worker gives expired holds back.
+INVENTORY_SHARDS = 8
+INVENTORY_RESERVATION_TIMEOUT = 20 * 60
+INVENTORY_PAYMENT_HOLD = 30 * 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -120,6 +170,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Uploads are stored as name.<hash>.ext and served by core.media with
+# immutable caching; older unhashed uploads get MEDIA_MAX_AGE plus
+# validators (manage.py hash_media renames them)
+DEFAULT_FILE_STORAGE = 'core.storage.HashedMediaStorage'
+MEDIA_MAX_AGE = 60 * 60
+MEDIA_IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
 
 # Simplified static file serving.
 # https://warehouse.python.org/project/whitenoise/
@@ -142,4 +198,70 @@ LOGIN_REDIRECT_URL = '/'
 # CRISPY FORMS
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# Compare the stored Order totals with a full recompute on every read
+# and raise on a mismatch. Only meant for development and tests.
+ORDER_TOTALS_CHECK = False
+
+# Raise instead of logging a warning when a request runs more queries
+# than its budget in core.budgets.VIEW_QUERY_BUDGETS
+QUERY_BUDGET_RAISE = False
+
+# Metrics served at /metrics. Set METRICS_DIR to a directory shared by
+# all gunicorn workers and run_worker on the host (emptied before they
+# start) to report them all; without it each process only reports
+# itself. METRICS_TOKEN has to be sent as "Authorization: Bearer ...";
+# without one the endpoint is only served with DEBUG on.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = 5
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
 STRIPE_SECRET_KEY = "sk_test_4eC39HqLyjWDarjtT1zdp7dc"
+
+# 'stripe' talks to the Stripe API, 'fake' charges in-process without
+# network access (for load tests), waiting FAKE_STRIPE_LATENCY seconds
+STRIPE_BACKEND = 'stripe'
+FAKE_STRIPE_LATENCY = 0.3
+# Charges and refunds the fake remembers for idempotent retries
+FAKE_STRIPE_LEDGER_SIZE = 10000
+
+# Stripe HTTP client. STRIPE_API_BASE can point at the local stub server
+# (manage.py stripe_stub_server) for benchmarks.
+STRIPE_API_BASE = None
+STRIPE_POOL_SIZE = 10
+STRIPE_CONNECT_TIMEOUT = 3.05
+STRIPE_READ_TIMEOUT = 20
+STRIPE_MAX_RETRIES = 2
+STRIPE_RETRY_BASE_DELAY = 0.25
+STRIPE_RETRY_MAX_DELAY = 2.0
+# Retries allowed per window: 10% of calls plus a floor of 10
+STRIPE_RETRY_BUDGET_RATIO = 0.1
+STRIPE_RETRY_BUDGET_MIN = 10
+STRIPE_RETRY_BUDGET_WINDOW = 10
+
+# Charges run in the worker process (manage.py run_worker). Set
+# CHARGE_JOBS_EAGER to run them inside the request instead.
+CHARGE_JOBS_EAGER = False
+CHARGE_JOB_MAX_ATTEMPTS = 3
+# Seconds a job waits before its first retry, doubled for each one after
+CHARGE_JOB_RETRY_DELAY = 30
+# Seconds before a job stuck in 'processing' is handed out again
+CHARGE_JOB_TIMEOUT = 5 * 60
+
+# Admin bulk actions on orders (core.models.BulkOrderJob) also run in the
+# worker, BULK_JOB_BATCH_SIZE orders per committed batch and at most
+# BULK_JOB_MAX_BATCHES batches before charges get a turn again.
+BULK_JOBS_EAGER = False
+BULK_JOB_BATCH_SIZE = 1000
+BULK_JOB_MAX_BATCHES = 10
+# Seconds without a finished batch before a running job is handed out again
+BULK_JOB_TIMEOUT = 5 * 60
+
+# Resized copies of Item.image, queued on each save and built by the
+# worker (manage.py generate_image_variants backfills them). Set
+# IMAGE_VARIANTS_EAGER to build them after the request's commit instead.
+IMAGE_VARIANT_WIDTHS = (160, 320, 640, 960)
+IMAGE_VARIANT_FORMATS = ('webp', 'jpeg')
+IMAGE_VARIANTS_EAGER = False
+IMAGE_JOB_MAX_ATTEMPTS = 3
+# Seconds before a job claimed by a worker that died is handed out again
+IMAGE_JOB_TIMEOUT = 5 * 60
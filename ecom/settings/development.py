@@ -13,6 +13,10 @@ else:
 
 DEBUG = True
 
+ORDER_TOTALS_CHECK = True
+
+QUERY_BUDGET_RAISE = True
+
 ALLOWED_HOSTS = []
 
 
@@ -1,3 +1,4 @@
+import dj_database_url
 import django_heroku
 from .base import *
 
@@ -11,3 +12,21 @@ ALLOWED_HOSTS = ['*']
 
 # Activate Django-Heroku
 django_heroku.settings(locals())
+
+# Keep reporting reads off the primary that serves checkout
+if os.environ.get('REPORTING_DATABASE_URL'):
+    DATABASES['reporting'] = dj_database_url.parse(
+        os.environ['REPORTING_DATABASE_URL'], conn_max_age=600)
+    DATABASES['reporting']['TEST'] = {'MIRROR': 'default'}
+    REPORTING_DATABASE = 'reporting'
+
+# Share cached pages, sessions and the catalog version across workers
+# and dynos. Memcached keeps a cache hit off the database, which would
+# otherwise take two round trips per home page (version, then page).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get(
+            'MEMCACHED_SERVERS', '127.0.0.1:11211').split(','),
+    }
+}
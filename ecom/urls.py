@@ -1,10 +1,18 @@
+import re
+
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
+
+from core.media import serve_media
+from core.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    re_path(r'^%s(?P<path>.*)$' % re.escape(settings.MEDIA_URL.lstrip('/')),
+            serve_media, name='media'),
+    path('metrics', metrics_view, name='metrics'),
     path('accounts/', include('allauth.urls')),
     path('', include('core.urls', namespace='core')),
 ]
@@ -12,7 +20,5 @@ urlpatterns = [
 if settings.DEBUG:
     import debug_toolbar
     urlpatterns += [path('__debug__/', include(debug_toolbar.urls))]
-    urlpatterns += static(settings.MEDIA_URL,
-                          document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL,
                           document_root=settings.STATIC_ROOT)
@@ -1,2 +1,2 @@
 python manage.py makemigrations;
-python manage.py migrate;
\ No newline at end of file
+python manage.py migrate;